@@ -0,0 +1,35 @@
+"""Store the stemmed term frequencies of posts
+
+Revision ID: 1f3b8d5c7a20
+Revises: 4a7e2c9d6b13
+Create Date: 2018-07-03 10:46:52.119804
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f3b8d5c7a20'
+down_revision = '4a7e2c9d6b13'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    # Existing posts get their terms when their ideas' keywords are computed.
+    with context.begin_transaction():
+        op.create_table(
+            'post_term_frequency',
+            sa.Column('post_id', sa.Integer, sa.ForeignKey(
+                'content.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('langs', sa.String(100), primary_key=True),
+            sa.Column('terms', sa.Text, nullable=False))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('post_term_frequency')
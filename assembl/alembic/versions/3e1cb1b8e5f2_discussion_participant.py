@@ -0,0 +1,48 @@
+"""Table of discussion participants
+
+Revision ID: 3e1cb1b8e5f2
+Revises: 8d704ad414e4
+Create Date: 2018-06-12 10:41:23.318572
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e1cb1b8e5f2'
+down_revision = '8d704ad414e4'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'discussion_participant',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('user_id', sa.Integer, sa.ForeignKey(
+                'agent_profile.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('contributor', sa.Boolean, nullable=False,
+                      server_default='false'),
+            sa.Column('reader', sa.Boolean, nullable=False,
+                      server_default='false'),
+            sa.UniqueConstraint('discussion_id', 'user_id'))
+
+    # Backfill
+    from assembl import models as m
+    db = m.get_session_maker()()
+    with transaction.manager:
+        for discussion in db.query(m.Discussion):
+            discussion.rebuild_participants()
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('discussion_participant')
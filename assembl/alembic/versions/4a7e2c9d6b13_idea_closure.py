@@ -0,0 +1,47 @@
+"""Closure table of the idea hierarchy
+
+Revision ID: 4a7e2c9d6b13
+Revises: 5c0d2ab4e1f7
+Create Date: 2018-06-27 15:21:08.204716
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a7e2c9d6b13'
+down_revision = '5c0d2ab4e1f7'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_closure',
+            sa.Column('ancestor_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('descendant_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('depth', sa.Integer, nullable=False))
+        op.create_index(
+            'ix_idea_closure_descendant', 'idea_closure',
+            ['descendant_id', 'depth'])
+
+    # Backfill from the live idea links
+    from assembl import models as m
+    from assembl.lib.sqla import mark_changed
+    db = m.get_session_maker()()
+    with transaction.manager:
+        m.IdeaClosure.rebuild(db.connection())
+        mark_changed(db)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('idea_closure')
@@ -0,0 +1,62 @@
+"""Index email references, to thread new emails incrementally
+
+Revision ID: 5c0d2ab4e1f7
+Revises: 3e1cb1b8e5f2
+Create Date: 2018-06-20 11:02:37.418530
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c0d2ab4e1f7'
+down_revision = '3e1cb1b8e5f2'
+
+from email.parser import HeaderParser
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+from assembl.lib.sqla_types import CoerceUnicode
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'email_reference',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('email_id', sa.Integer, sa.ForeignKey(
+                'email.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('position', sa.Integer, nullable=False),
+            sa.Column('message_id', CoerceUnicode, nullable=False,
+                      index=True))
+        op.create_index(
+            'ix_email_in_reply_to', 'email', ['in_reply_to'])
+
+    # Backfill from the stored headers
+    from assembl import models as m
+    from assembl.lib.sqla import mark_changed
+    db = m.get_session_maker()()
+    parser = HeaderParser()
+    with transaction.manager:
+        values = []
+        for (email_id, in_reply_to, blob) in db.query(
+                m.Email.id, m.Email.in_reply_to, m.Email.imported_blob):
+            references = parser.parsestr(blob).get('References', '')
+            message_ids = m.AbstractMailbox.parse_references(
+                references.decode('utf-8', 'replace'), in_reply_to)
+            values.extend(
+                dict(email_id=email_id, position=position,
+                     message_id=message_id)
+                for (position, message_id) in enumerate(message_ids))
+        if values:
+            db.execute(m.EmailReference.__table__.insert(), values)
+            mark_changed(db)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_index('ix_email_in_reply_to', 'email')
+        op.drop_table('email_reference')
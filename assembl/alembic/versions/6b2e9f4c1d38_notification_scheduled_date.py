@@ -0,0 +1,29 @@
+"""When rate limited notifications are scheduled to be sent
+
+Revision ID: 6b2e9f4c1d38
+Revises: 1f3b8d5c7a20
+Create Date: 2018-07-05 15:12:40.318516
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6b2e9f4c1d38'
+down_revision = '1f3b8d5c7a20'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.add_column('notification', sa.Column(
+            'scheduled_date', sa.DateTime, nullable=True))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_column('notification', 'scheduled_date')
@@ -0,0 +1,168 @@
+"""Caching of users' roles and permissions.
+
+Roles and permissions are computed by :py:mod:`assembl.auth.util`
+on almost every request. Results are memoized for the current request,
+and shared between requests of this process for a few seconds.
+ORM listeners on roles and permissions (in :py:mod:`assembl.models.auth`)
+invalidate both through :py:func:`permissions_changed`."""
+from threading import Lock
+from time import time
+import logging
+
+from sqlalchemy import event
+from sqlalchemy.orm.session import object_session, Session
+
+from ..lib import config
+
+log = logging.getLogger('assembl')
+
+_missing = object()
+
+
+class PermissionCache(object):
+    """Process-wide cache of roles and permissions, with a time to live.
+
+    Entries are keyed by (kind, user_id, discussion_id, ...).
+    A generation counter is bumped on every invalidation, so values
+    computed while permissions were changing are not stored."""
+
+    stats_interval = 300
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = Lock()
+        self.generation = 0
+        self.request_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._last_log = time()
+
+    def get(self, key):
+        entry = self.entries.get(key, None)
+        if entry is not None and entry[0] > time():
+            return entry[1]
+        return _missing
+
+    def set(self, key, value, generation):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (time() + self.ttl, value)
+
+    def invalidate(self, user_id=None, discussion_id=None):
+        """Forget the permissions of a user and/or in a discussion.
+        Global roles have no discussion, and are always forgotten."""
+        with self.lock:
+            self.generation += 1
+            if user_id is None and discussion_id is None:
+                self.entries.clear()
+                return
+            for key in self.entries.keys():
+                if user_id is not None and key[1] != user_id:
+                    continue
+                if discussion_id is not None and key[2] not in (
+                        discussion_id, None):
+                    continue
+                del self.entries[key]
+
+    def lookup(self, key, builder, memo=None, shareable=True):
+        """Get a value from the request memo, then the shared cache,
+        then from the builder function."""
+        if memo is not None:
+            value = memo.get(key, _missing)
+            if value is not _missing:
+                self.request_hits += 1
+                return value
+        value = self.get(key)
+        if value is _missing:
+            self.misses += 1
+            generation = self.generation
+            value = builder()
+            if shareable:
+                self.set(key, value, generation)
+        else:
+            self.shared_hits += 1
+        if memo is not None:
+            memo[key] = value
+        if time() - self._last_log > self.stats_interval:
+            self._last_log = time()
+            log.debug("permission cache: %(request_hits)d request hits, "
+                      "%(shared_hits)d shared hits, %(misses)d misses, "
+                      "hit rate %(hit_rate).2f" % self.stats())
+        return value
+
+    def stats(self):
+        "Hits (in the request memo or shared cache) and misses"
+        lookups = self.request_hits + self.shared_hits + self.misses
+        return {
+            "request_hits": self.request_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": float(lookups - self.misses) / lookups
+            if lookups else 0.0,
+        }
+
+
+_permission_cache = None
+
+
+def get_permission_cache():
+    global _permission_cache
+    if _permission_cache is None:
+        _permission_cache = PermissionCache(
+            int(config.get('permissions.cache_ttl', 30) or 0))
+    return _permission_cache
+
+
+def _request_memo():
+    from pyramid.threadlocal import get_current_request
+    req = get_current_request()
+    if req is None:
+        return None
+    memo = getattr(req, "permission_memo", None)
+    if memo is None:
+        memo = req.permission_memo = {}
+    return memo
+
+
+def cached_permissions(db, kind, user_id, discussion_id, builder, *args):
+    """Memoized result of ``builder()``, keyed by the other arguments.
+
+    Nothing is shared while the session has uncommitted role
+    or permission changes."""
+    return get_permission_cache().lookup(
+        (kind, user_id, discussion_id) + args, builder, _request_memo(),
+        not db.info.get('permission_changes', None))
+
+
+def permissions_changed(target, user_id=None, discussion_id=None):
+    """Invalidate cached permissions now, and again at the end of the
+    transaction, so values computed from uncommitted changes are dropped."""
+    get_permission_cache().invalidate(user_id, discussion_id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('permission_changes', set()).add(
+            (user_id, discussion_id))
+    memo = _request_memo()
+    if memo is not None:
+        memo.clear()
+
+
+def _end_of_transaction(session):
+    changes = session.info.pop('permission_changes', None)
+    if changes:
+        cache = get_permission_cache()
+        for (user_id, discussion_id) in changes:
+            cache.invalidate(user_id, discussion_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def permissions_after_commit(session):
+    _end_of_transaction(session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def permissions_after_rollback(session):
+    _end_of_transaction(session)
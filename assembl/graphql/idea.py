@@ -1,5 +1,4 @@
 import os.path
-from collections import defaultdict
 from random import sample as random_sample
 from random import shuffle as random_shuffle
 
@@ -15,13 +14,13 @@ from sqlalchemy.orm import joinedload
 from assembl import models
 from assembl.auth import IF_OWNED, CrudPermissions
 from assembl.auth.util import get_permissions
-from assembl.models.action import SentimentOfPost
 
 from .document import Document
 from .langstring import (LangStringEntry, LangStringEntryInput,
                          langstring_from_input_entries, resolve_langstring,
                          resolve_langstring_entries,
                          update_langstring_from_input_entries)
+from .loaders import agent_profiles_by_id, get_loader
 from .types import SecureObjectType, SQLAlchemyUnion
 from .user import AgentProfile
 from .utils import (
@@ -195,10 +194,12 @@ class Idea(SecureObjectType, SQLAlchemyObjectType):
 
         participant_ids = [row[0] for row in query]
         num_participants = len(participant_ids)
-        participants = [models.AgentProfile.get(participant_id) for participant_id in participant_ids]
-        return VoteResults(
-            num_participants=num_participants,
-            participants=participants)
+        return get_loader(
+            context, 'agent_profiles', agent_profiles_by_id
+        ).load_many(participant_ids).then(
+            lambda participants: VoteResults(
+                num_participants=num_participants,
+                participants=participants))
 
     @classmethod
     def is_type_of(cls, root, context, info):
@@ -279,31 +280,11 @@ class Idea(SecureObjectType, SQLAlchemyObjectType):
                 query = query.options(*models.Content.subqueryload_options())
             else:
                 query = query.options(*models.Content.joinedload_options())
-            post_ids = query.with_entities(models.Post.id).subquery()
         else:
             query = query.with_entities(models.Post.id, models.Post.publication_state)
-            query = query.all()  # execute the query only once, we iter again below
-            post_ids = [id for id, _ in query]
-
-        # do only one sql query to calculate sentiment_counts
-        # instead of doing one query for each post
-        if 'sentimentCounts' in fields.get('edges', {}).get('node', {}):
-            sentiment_counts = discussion.db.query(
-                models.Post.id, models.SentimentOfPost.type, func.count(
-                    models.SentimentOfPost.id)
-            ).join(models.SentimentOfPost).filter(
-                models.Post.id.in_(post_ids),
-                models.SentimentOfPost.tombstone_condition()
-            ).group_by(models.Post.id, models.SentimentOfPost.type)
-            sentiment_counts_by_post_id = defaultdict(dict)
-            for (post_id, sentiment_type, sentiment_count) in sentiment_counts:
-                sentiment_counts_by_post_id[post_id][
-                    sentiment_type[SentimentOfPost.TYPE_PREFIX_LEN:]
-                ] = sentiment_count
-            # set sentiment_counts_by_post_id on the request to use it
-            # in Post's resolve_sentiment_counts
-            context.sentiment_counts_by_post_id = sentiment_counts_by_post_id
 
+        # sentiment counts of the posts are loaded together,
+        # see PostInterface.resolve_sentiment_counts
         if sentiments_only:
             from .post import Post
             query = [Post(id=id, publication_state=publication_state) for id, publication_state in query]
@@ -318,9 +299,9 @@ class Idea(SecureObjectType, SQLAlchemyObjectType):
 
     def resolve_contributors(self, args, context, info):
         contributor_ids = [cid for (cid,) in self.get_contributors_query()]
-        contributors = [models.AgentProfile.get(
-            cid) for cid in contributor_ids]
-        return contributors
+        return get_loader(
+            context, 'agent_profiles', agent_profiles_by_id
+        ).load_many(contributor_ids)
 
     def resolve_announcement(self, args, context, info):
         return self.get_applicable_announcement()
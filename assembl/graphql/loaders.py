@@ -0,0 +1,106 @@
+"""Batch loading of data for graphql resolvers.
+
+Resolvers ask a loader of the request for the data of their object,
+instead of querying it themselves. Keys asked for while a level of the
+query is resolved are gathered, and loaded with a single ``IN`` query.
+"""
+from collections import defaultdict
+
+from promise import Promise
+from promise.dataloader import DataLoader
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.functions import count
+
+from assembl import models
+from assembl.models.action import SentimentOfPost
+
+
+class QueryLoader(DataLoader):
+    """Loads values with a function taking a list of keys and returning
+    a dictionary of values by key. Missing keys get the default value.
+
+    Values are not cached between batches, as the same request may
+    run mutations and queries."""
+
+    def __init__(self, batch_query, default=None):
+        super(QueryLoader, self).__init__(cache=False)
+        self.batch_query = batch_query
+        self.default = default
+
+    def batch_load_fn(self, keys):
+        values = self.batch_query(list(set(keys)))
+        return Promise.resolve(
+            [values.get(key, self.default) for key in keys])
+
+
+def get_loader(context, name, batch_query, default=None):
+    "The loader of this name for the request, created if needed"
+    loaders = getattr(context, 'graphql_loaders', None)
+    if loaders is None:
+        loaders = context.graphql_loaders = {}
+    loader = loaders.get(name, None)
+    if loader is None:
+        loader = loaders[name] = QueryLoader(batch_query, default)
+    return loader
+
+
+def agent_profiles_by_id(ids):
+    db = models.AgentProfile.default_db
+    return {profile.id: profile for profile in db.query(
+        models.AgentProfile).filter(models.AgentProfile.id.in_(ids))}
+
+
+def extracts_by_post_id(post_ids):
+    db = models.Extract.default_db
+    extracts = defaultdict(list)
+    for extract in db.query(models.Extract).filter(
+            models.Extract.content_id.in_(post_ids)
+            ).options(joinedload(models.Extract.text_fragment_identifiers)
+            ).order_by(models.Extract.creation_date):
+        extracts[extract.content_id].append(extract)
+    return extracts
+
+
+def sentiment_counts_by_post_id(post_ids):
+    db = SentimentOfPost.default_db
+    sentiment_counts = defaultdict(dict)
+    for (post_id, sentiment_type, sentiment_count) in db.query(
+            SentimentOfPost.post_id, SentimentOfPost.type,
+            count(SentimentOfPost.id)
+            ).filter(SentimentOfPost.post_id.in_(post_ids),
+                     SentimentOfPost.tombstone_condition()
+            ).group_by(SentimentOfPost.post_id, SentimentOfPost.type):
+        sentiment_counts[post_id][
+            sentiment_type[SentimentOfPost.TYPE_PREFIX_LEN:]
+        ] = sentiment_count
+    return sentiment_counts
+
+
+def sentiments_of_user_by_post_id(user_id):
+    def batch_query(post_ids):
+        db = SentimentOfPost.default_db
+        return {sentiment.post_id: sentiment for sentiment in db.query(
+            SentimentOfPost).filter(
+                SentimentOfPost.actor_id == user_id,
+                SentimentOfPost.post_id.in_(post_ids),
+                SentimentOfPost.tombstone_date == None)}  # noqa: E711
+    return batch_query
+
+
+def original_locales_by_langstring_id(langstring_ids):
+    "The locale of the first entry which is not machine translated"
+    Locale = models.Locale
+    LangStringEntry = models.LangStringEntry
+    db = LangStringEntry.default_db
+    locales = {}
+    for (langstring_id, locale_id) in db.query(
+            LangStringEntry.langstring_id, LangStringEntry.locale_id
+            ).filter(LangStringEntry.langstring_id.in_(langstring_ids),
+                     LangStringEntry.tombstone_date == None  # noqa: E711
+            ).order_by(LangStringEntry.id):
+        if langstring_id in locales:
+            continue
+        locale_code = Locale.code_for_id(locale_id)
+        if not Locale.locale_is_machine_translated(locale_code):
+            locales[langstring_id] = locale_code
+    return locales
@@ -8,12 +8,13 @@ from graphene_sqlalchemy import SQLAlchemyObjectType
 from pyramid.httpexceptions import HTTPUnauthorized
 from pyramid.i18n import TranslationStringFactory
 from pyramid.security import Everyone
-from sqlalchemy.orm import joinedload
+from sqlalchemy import inspect
 
 from assembl import models
 from assembl.auth import P_DELETE_MY_POST, P_DELETE_POST, CrudPermissions
 from assembl.auth.util import get_permissions
 from assembl.lib.clean_input import sanitize_html, sanitize_text
+from assembl.tasks.translate import translate_later
 from assembl.models.auth import (LanguagePreferenceCollection,
                                  LanguagePreferenceCollectionWithDefault)
 from jwzthreading import restrip_pat
@@ -23,6 +24,9 @@ from .document import Document
 from .idea import Idea
 from .langstring import (LangStringEntry, resolve_best_langstring_entries,
                          resolve_langstring)
+from .loaders import (
+    get_loader, extracts_by_post_id, original_locales_by_langstring_id,
+    sentiment_counts_by_post_id, sentiments_of_user_by_post_id)
 from .sentiment import SentimentCounts, SentimentTypes
 from .types import SecureObjectType, SQLAlchemyInterface
 from .user import AgentProfile
@@ -101,11 +105,8 @@ class PostInterface(SQLAlchemyInterface):
         return self.id
 
     def resolve_extracts(self, args, context, info):
-        return self.db.query(models.Extract
-            ).join(models.Content, models.Extract.content == self
-            ).options(joinedload(models.Extract.text_fragment_identifiers)
-            ).order_by(models.Extract.creation_date
-            ).all()
+        return get_loader(
+            context, 'extracts', extracts_by_post_id, ()).load(self.id)
 
     def resolve_subject(self, args, context, info):
         # Use self.subject and not self.get_subject() because we still
@@ -122,6 +123,8 @@ class PostInterface(SQLAlchemyInterface):
         if request.authenticated_userid == Everyone:
             # anonymous cannot trigger translations
             return
+        if post.discussion.translation_service().canTranslate is None:
+            return
         if locale:
             lpc = LanguagePreferenceCollectionWithDefault(locale)
         else:
@@ -134,7 +137,9 @@ class PostInterface(SQLAlchemyInterface):
                 continue
             target_locale = target_locale.code
             if not ls.closest_entry(target_locale):
-                post.maybe_translate(lpc)
+                # translations will come through the changes socket
+                translate_later(request, [post.id], locale)
+                return
 
     def resolve_subject_entries(self, args, context, info):
         # Use self.subject and not self.get_subject() because we still
@@ -151,30 +156,35 @@ class PostInterface(SQLAlchemyInterface):
         return body
 
     def resolve_sentiment_counts(self, args, context, info):
-        # get the sentiment counts from the cache if it exists instead of
-        # tiggering a sql query
-        cache = getattr(context, 'sentiment_counts_by_post_id', None)
-        if cache is not None:
+        def to_sentiment_counts(counts):
             sentiment_counts = {
                 name: 0 for name in models.SentimentOfPost.all_sentiments
             }
-            sentiment_counts.update(cache[self.id])
-        else:
-            sentiment_counts = self.sentiment_counts
+            sentiment_counts.update(counts)
+            return SentimentCounts(
+                dont_understand=sentiment_counts['dont_understand'],
+                disagree=sentiment_counts['disagree'],
+                like=sentiment_counts['like'],
+                more_info=sentiment_counts['more_info'],
+            )
 
-        return SentimentCounts(
-            dont_understand=sentiment_counts['dont_understand'],
-            disagree=sentiment_counts['disagree'],
-            like=sentiment_counts['like'],
-            more_info=sentiment_counts['more_info'],
-        )
+        return get_loader(
+            context, 'sentiment_counts', sentiment_counts_by_post_id, {}
+        ).load(self.id).then(to_sentiment_counts)
 
     def resolve_my_sentiment(self, args, context, info):
-        my_sentiment = self.my_sentiment
-        if my_sentiment is None:
+        user_id = context.authenticated_userid
+        if user_id is None:
             return None
 
-        return my_sentiment.name.upper()
+        def to_sentiment_type(my_sentiment):
+            if my_sentiment is None:
+                return None
+            return my_sentiment.name.upper()
+
+        return get_loader(
+            context, 'my_sentiment', sentiments_of_user_by_post_id(user_id)
+        ).load(self.id).then(to_sentiment_type)
 
     def resolve_indirect_idea_content_links(self, args, context, info):
         # example:
@@ -209,11 +219,21 @@ class PostInterface(SQLAlchemyInterface):
         return self.publication_state.name
 
     def resolve_original_locale(self, args, context, info):
-        entry = self.body.first_original()
-        if entry:
-            return entry.locale_code
+        if self.body_id is None:
+            return u''
+
+        if 'body' not in inspect(self).unloaded and \
+                'entries' not in inspect(self.body).unloaded:
+            # already loaded with the post, no need to query
+            entry = self.body.first_original()
+            if entry:
+                return entry.locale_code
+
+            return u''
 
-        return u''
+        return get_loader(
+            context, 'original_locale', original_locales_by_langstring_id,
+            u'').load(self.body_id)
 
 
 class Post(SecureObjectType, SQLAlchemyObjectType):
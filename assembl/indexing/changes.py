@@ -20,10 +20,9 @@ sqlalchemy is first (key is "~sqlalchemy..."), elasticsearch is second
   for elasticsearch data manager.
 - elasticsearch tpc_vote() does nothing
 - sqlalchemy tpc_finish() does nothing
-- elasticsearch tpc_finish() write to elasticsearch. If an exception occurs,
-  tpc_abort will be called on all resources managers, but here the changes are
-  already committed to postgres, so it actually doesn't really do anything.
-  But you get a 500 http code.
+- elasticsearch tpc_finish() gives the changes to the indexing queue
+  (see queue.py), which writes them to a journal and returns. A background
+  thread sends them to elasticsearch, so requests never wait on it.
 
 For the savepoint stuff, you can actually at any moment in your code use
 `savepoint = transaction.savepoint()` and if there is an exception,
@@ -31,14 +30,13 @@ rollback with `savepoint.rollback()` to return the transaction to this saved
 state. For postgres, this is implemented with nested transaction if supported.
 
 If an object is modified several times during the transaction, only the last
-modification (including all previous changes) is kept. There is only a single
-request to elasticsearch at the end of the transaction.
-We are using the elasticsearch bulk REST api to index several documents
-in one request. It's just a PUT request and it returns immediately.
-The indexing in elasticsearch is then done asynchronously.
-If by any bad luck, the elasticsearch is not responding, the postgres database
-and elasticsearch will be out of sync. We can always reindex completely the
-elasticsearch index to sync it again with the postgres database.
+modification (including all previous changes) is kept. The indexing queue
+also merges changes to the same object across transactions, and sends them
+with the elasticsearch bulk REST api.
+If elasticsearch is not responding, the queue retries until it is back,
+and the journal keeps the changes if the process stops in the meantime.
+We can still reindex completely the elasticsearch index to sync it again
+with the postgres database.
 """
 
 import logging
@@ -48,12 +46,11 @@ import os
 from transaction.interfaces import ISavepointDataManager, IDataManagerSavepoint
 from zope.interface import implementer
 import transaction
-from elasticsearch.helpers import bulk
 
 from assembl.lib import config
+from .queue import get_indexing_queue
 from .settings import get_index_settings
 from .utils import (
-    connect,
 #    create_index_and_mapping,
     get_uid,
     get_data,
@@ -178,18 +175,12 @@ class ElasticChanges(threading.local):
                     yield action
 
             actions = get_actions(self._index, self._unindex)
-            es = connect()
-            bulk(es, actions, chunk_size=self._settings['chunk_size'],
-                raise_on_error=False)
-            # set raise_on_error=False to not raise a BulkIndexError and so a transaction error (shouldn't happen in tpc_finish)
-            # when we try to unindex an idea that was not indexed (this is
-            # the case for hidden ideas associated to a synthesis)
-            # Example of item in unindex:
-            # {'idea:2580': {'_parent': None, 'doc_type': 'idea'}
-            # and the resulting error:
-            # {u'delete': {u'status': 404, u'_type': u'idea', u'_index': u'assembl',
-            # u'_shards': {u'successful': 1, u'failed': 0, u'total': 1},
-            # u'_version': 1, u'result': u'not_found', u'found': False, u'_id': u'idea:2580'}}
+            try:
+                get_indexing_queue().put(list(actions))
+            except Exception:
+                # Changes are already committed to postgres
+                logger.error("Could not queue indexing actions",
+                             exc_info=True)
 
         self._clear()
 
@@ -0,0 +1,313 @@
+"""
+Asynchronous sending of indexing actions to elasticsearch.
+
+After a transaction is committed, :py:class:`assembl.indexing.changes.ElasticChanges`
+gives its actions to the :py:class:`IndexingQueue` of the process, which
+appends them to a journal file before returning. A background thread then
+sends pending actions in batches with `streaming_bulk`, merging actions on
+the same document across transactions, and retrying with exponential
+backoff when elasticsearch is unreachable, overloaded or failing.
+
+The journal is made of segment files: a new one is started whenever a
+batch is taken, and a segment is deleted once all its actions are sent,
+so the journal only holds actions which may still be pending.
+
+Each process has its own journal segments, locked while the process runs.
+Segments left by processes which died with pending actions are taken over
+by the next process that starts a queue, so actions are not lost.
+"""
+
+import atexit
+import fcntl
+import logging
+import os
+from collections import OrderedDict, deque
+from glob import glob
+from threading import Condition, Lock, Thread
+from time import sleep, time
+
+import simplejson as json
+from elasticsearch.helpers import streaming_bulk
+
+from assembl.lib import config
+from .settings import get_index_settings
+from .utils import connect
+
+logger = logging.getLogger('assembl.indexing')
+
+
+class IndexingQueue(object):
+    """Durable queue of elasticsearch bulk actions, drained by a thread.
+
+    :param journal_dir: directory of the journal files
+    :param chunk_size: maximum number of actions in a bulk request
+    :param max_pending: above this many pending actions, committing
+        transactions wait (up to ``max_wait`` seconds) for the queue to drain
+    """
+
+    stats_interval = 60
+    max_backoff = 60
+
+    def __init__(self, journal_dir, chunk_size=500, max_pending=50000,
+                 max_wait=1.0, client=None):
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.client = client
+        # (enqueue time, action, journal segment)
+        self.pending = deque()
+        self.condition = Condition()
+        self.sending = 0
+        self.sending_since = None
+        self.stopping = False
+        self.thread = None
+        # counters
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.last_error = None
+        self._last_log = time()
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        self.journal_dir = journal_dir
+        # Unique, even if a dead process had the same pid
+        self.journal_prefix = 'indexing-%d-%d' % (
+            os.getpid(), time() * 1000)
+        # segment number -> [open file, number of unsent actions]
+        self.segments = OrderedDict()
+        self.segment = -1
+        self.rotate()
+        self.recover()
+
+    def segment_path(self, segment):
+        return os.path.join(self.journal_dir, '%s-%d.journal' % (
+            self.journal_prefix, segment))
+
+    @property
+    def journal(self):
+        return self.segments[self.segment][0]
+
+    @property
+    def journal_path(self):
+        "The segment where new actions are written"
+        return self.segment_path(self.segment)
+
+    def rotate(self):
+        "Write new actions to a new segment"
+        self.segment += 1
+        journal = open(self.segment_path(self.segment), 'a')
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.segments[self.segment] = [journal, 0]
+
+    def actions_done(self, entries):
+        "Delete the old segments whose actions are all sent"
+        for (enqueued, action, segment) in entries:
+            self.segments[segment][1] -= 1
+        for segment, (journal, unsent) in self.segments.items():
+            if segment != self.segment and not unsent:
+                os.unlink(self.segment_path(segment))
+                journal.close()
+                del self.segments[segment]
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="indexing_queue")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        "Try to send pending actions, then stop the thread"
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def put(self, actions):
+        """Journal actions and queue them for sending.
+        Waits a little if too many actions are pending."""
+        if not actions:
+            return
+        lines = ''.join(json.dumps(action) + '\n' for action in actions)
+        with self.condition:
+            if len(self.pending) > self.max_pending:
+                logger.warning(
+                    "%d indexing actions pending" % len(self.pending))
+                self.condition.wait(self.max_wait)
+            self.journal.write(lines)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.segments[self.segment][1] += len(actions)
+            now = time()
+            self.pending.extend(
+                (now, action, self.segment) for action in actions)
+            self.condition.notify_all()
+
+    def recover(self):
+        "Take over the journals of dead processes"
+        own_paths = set(self.segment_path(segment)
+                        for segment in self.segments)
+        for path in glob(os.path.join(self.journal_dir, 'indexing-*.journal')):
+            if path in own_paths:
+                continue
+            with open(path, 'r+') as journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # still in use by a live process
+                    continue
+                actions = []
+                for line in journal:
+                    try:
+                        actions.append(json.loads(line))
+                    except ValueError:
+                        # a partly written last line
+                        logger.warning("Invalid line in " + path)
+                if actions:
+                    logger.info("Recovering %d indexing actions from %s" % (
+                        len(actions), path))
+                self.put(actions)
+                os.unlink(path)
+
+    @staticmethod
+    def merge(actions):
+        "Keep only the last action on each document, in order of last action"
+        by_doc = OrderedDict()
+        for action in actions:
+            key = (action['_index'], action['_type'], action['_id'])
+            by_doc.pop(key, None)
+            by_doc[key] = action
+        return by_doc.values()
+
+    def next_batch(self):
+        with self.condition:
+            while not self.pending and not self.stopping:
+                self.condition.wait(self.stats_interval)
+                self.log_stats()
+            batch = []
+            if self.pending:
+                self.sending_since = self.pending[0][0]
+            while self.pending and len(batch) < self.chunk_size:
+                batch.append(self.pending.popleft())
+            if self.segments[self.segment][1]:
+                self.rotate()
+            self.sending = len(batch)
+            return batch
+
+    def run(self):
+        backoff = min(1, self.max_backoff)
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                break
+            actions = [action for (enqueued, action, segment) in batch]
+            try:
+                retry = self.send(actions)
+            except Exception as e:
+                retry = actions
+                self.last_error = repr(e)
+                logger.warning("Could not send indexing actions: %s" % (e,))
+            retry_ids = set(id(action) for action in retry)
+            with self.condition:
+                # Before newer actions on the same documents
+                self.pending.extendleft(reversed([
+                    entry for entry in batch if id(entry[1]) in retry_ids]))
+                self.actions_done([
+                    entry for entry in batch
+                    if id(entry[1]) not in retry_ids])
+                self.sending = 0
+                self.sending_since = None
+                self.condition.notify_all()
+            if retry:
+                self.retries += 1
+                if self.stopping:
+                    # keep them in the journal for the next process
+                    return
+                logger.warning("Retrying %d indexing actions in %ds" % (
+                    len(retry), backoff))
+                sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                backoff = min(1, self.max_backoff)
+            if time() - self._last_log > self.stats_interval:
+                self.log_stats()
+
+    @staticmethod
+    def is_retryable(status):
+        "Rejected because elasticsearch is overloaded, or shard errors"
+        return status == 429 or status >= 500
+
+    def send(self, batch):
+        """Send actions, and return those which should be retried"""
+        client = self.client or connect()
+        merged = self.merge(batch)
+        by_doc = {(action['_index'], action['_type'], action['_id']): action
+                  for action in merged}
+        retry = []
+        for ok, item in streaming_bulk(
+                client, merged, chunk_size=self.chunk_size,
+                raise_on_error=False):
+            if ok:
+                self.sent += 1
+                continue
+            (op_type, result) = item.popitem()
+            status = result.get('status', 500)
+            if op_type == 'delete' and status == 404:
+                # unindexing something that was not indexed,
+                # e.g. hidden ideas associated to a synthesis
+                self.sent += 1
+                continue
+            action = by_doc.get((result.get('_index', None),
+                                 result.get('_type', None),
+                                 result.get('_id', None)), None)
+            if action is not None and self.is_retryable(status):
+                retry.append(action)
+                self.last_error = repr(result.get('error', None))
+                continue
+            self.failed += 1
+            logger.error("Could not %s %s: %s" % (
+                op_type, result.get('_id', None), result.get('error', None)))
+        return retry
+
+    def stats(self):
+        "Counters, and lag: pending actions and age of the oldest one"
+        with self.condition:
+            oldest = self.sending_since
+            if oldest is None and self.pending:
+                oldest = self.pending[0][0]
+            return {
+                "pending": len(self.pending) + self.sending,
+                "lag_seconds": time() - oldest if oldest else 0.0,
+                "sent": self.sent,
+                "failed": self.failed,
+                "retries": self.retries,
+                "last_error": self.last_error,
+            }
+
+    def log_stats(self):
+        self._last_log = time()
+        logger.debug("indexing queue: %(pending)d pending, lag %(lag_seconds)"
+                     ".1fs, %(sent)d sent, %(failed)d failed, "
+                     "%(retries)d retries" % self.stats())
+
+
+_queue = None
+_queue_lock = Lock()
+
+
+def get_indexing_queue():
+    """The indexing queue of this process (restarted after a fork)"""
+    global _queue
+    with _queue_lock:
+        if _queue is None or _queue.pid != os.getpid():
+            _queue = IndexingQueue(
+                config.get('elasticsearch_journal_dir', 'var/indexing'),
+                get_index_settings(config)['chunk_size'])
+            _queue.pid = os.getpid()
+            _queue.start()
+    return _queue
+
+
+@atexit.register
+def stop_indexing_queue():
+    if _queue is not None and _queue.pid == os.getpid():
+        _queue.stop()
@@ -0,0 +1,106 @@
+"""Fan-out of the changes socket messages to browser connections.
+
+The :py:mod:`assembl.tasks.changes_router` keeps a single subscription
+per discussion, and this module distributes each message to the
+connections of that discussion. Private entries are split by user once
+per message, so each connection only gets precomputed data."""
+from collections import defaultdict
+
+import simplejson as json
+
+
+def split_private(data):
+    """Split a changeset by the users allowed to see its private entries.
+
+    Returns the data to send to users without private entries,
+    and a dictionary of the data to send to each user with private entries.
+    Data is None if there is nothing to send."""
+    if '@private' not in data:
+        return data, {}
+    entries = json.loads(data)
+    public = []
+    by_user = defaultdict(list)
+    for entry in entries:
+        user_id = entry.get('@private', None)
+        if user_id is None:
+            public.append(entry)
+            for user_entries in by_user.itervalues():
+                user_entries.append(entry)
+        else:
+            if user_id not in by_user:
+                by_user[user_id] = public[:]
+            by_user[user_id].append(entry)
+    return (json.dumps(public) if public else None,
+            {user_id: json.dumps(user_entries)
+             for (user_id, user_entries) in by_user.iteritems()})
+
+
+class DiscussionChannel(object):
+    "The connections listening to the changes of a discussion"
+
+    def __init__(self, discussion):
+        self.discussion = discussion
+        self.connections = set()
+
+    def dispatch(self, data, broadcast):
+        """Send data to all connections, through the broadcast function,
+        which takes a list of connections and a message."""
+        public_data, private_data = split_private(data)
+        if not private_data:
+            if public_data is not None and self.connections:
+                broadcast(self.connections, public_data)
+            return
+        groups = defaultdict(list)
+        for connection in self.connections:
+            groups[private_data.get(connection.userId, public_data)].append(
+                connection)
+        for payload, connections in groups.iteritems():
+            if payload is not None:
+                broadcast(connections, payload)
+
+
+class ChangesFanout(object):
+    """Routes messages of the changes socket to discussion channels.
+
+    :param subscribe: function to subscribe to a discussion's messages
+    :param unsubscribe: function to unsubscribe from a discussion's messages
+    :param broadcast: function sending a message to a list of connections
+    """
+
+    def __init__(self, subscribe, unsubscribe, broadcast):
+        self.subscribe = subscribe
+        self.unsubscribe = unsubscribe
+        self.broadcast = broadcast
+        self.channels = {}
+        self.messages = 0
+
+    def add(self, connection):
+        discussion = str(connection.discussion)
+        channel = self.channels.get(discussion, None)
+        if channel is None:
+            channel = self.channels[discussion] = DiscussionChannel(discussion)
+            self.subscribe(discussion)
+        channel.connections.add(connection)
+
+    def remove(self, connection):
+        discussion = str(connection.discussion)
+        channel = self.channels.get(discussion, None)
+        if channel is None:
+            return
+        channel.connections.discard(connection)
+        if not channel.connections:
+            del self.channels[discussion]
+            self.unsubscribe(discussion)
+
+    def on_recv(self, frames):
+        "Receive a multipart message: discussion, order, data"
+        discussion, data = frames[0], frames[-1]
+        self.messages += 1
+        if discussion == '*':
+            channels = self.channels.values()
+        else:
+            # subscriptions are prefixes, check the exact discussion
+            channel = self.channels.get(discussion, None)
+            channels = [channel] if channel else []
+        for channel in channels:
+            channel.dispatch(data, self.broadcast)
@@ -0,0 +1,95 @@
+"""Asynchronous read permission checks for the changes router.
+
+The :py:mod:`assembl.tasks.changes_router` asks the web application
+whether a user can read a discussion before subscribing a connection.
+Those checks must not block the IOLoop, so they use an asynchronous
+HTTP client, a bounded number of concurrent requests, and a TTL cache,
+so a reconnection storm does not flood the web application."""
+from collections import deque
+from time import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient
+from tornado.locks import Semaphore
+
+
+class ReadPermissionChecker(object):
+    """Checks (with caching) that users can read discussions.
+
+    :param server_url: base url of the web application
+    :param ttl: seconds to remember a permission
+    :param max_concurrent: maximum number of simultaneous checks
+    """
+
+    def __init__(self, server_url, ttl=60, max_concurrent=10,
+                 http_client=None):
+        self.server_url = server_url
+        self.ttl = ttl
+        self.semaphore = Semaphore(max_concurrent)
+        self.http_client = http_client or AsyncHTTPClient()
+        # (discussion, user_id) -> (expiry time, permission)
+        self.cache = {}
+        # checks in progress, shared by identical requests
+        self.pending = {}
+        self.latencies = deque(maxlen=1000)
+        self.hits = 0
+        self.misses = 0
+
+    def permission_url(self, discussion, user_id):
+        return '%s/api/v1/discussion/%s/permissions/read/u/%s' % (
+            self.server_url, discussion, user_id)
+
+    @gen.coroutine
+    def can_read(self, discussion, user_id):
+        key = (discussion, user_id)
+        entry = self.cache.get(key, None)
+        if entry is not None and entry[0] > time():
+            self.hits += 1
+            raise gen.Return(entry[1])
+        self.misses += 1
+        future = self.pending.get(key, None)
+        if future is not None:
+            result = yield future
+            raise gen.Return(result)
+        future = self.pending[key] = Future()
+        try:
+            result = yield self._check(discussion, user_id)
+            future.set_result(result)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.pending[key]
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def _check(self, discussion, user_id):
+        with (yield self.semaphore.acquire()):
+            start = time()
+            response = yield self.http_client.fetch(
+                self.permission_url(discussion, user_id), raise_error=False)
+            self.latencies.append(time() - start)
+        if response.code != 200:
+            # Do not cache errors
+            raise gen.Return(False)
+        result = response.body == 'true'
+        self.cache[(discussion, user_id)] = (time() + self.ttl, result)
+        raise gen.Return(result)
+
+    def expire(self):
+        "Forget expired permissions"
+        now = time()
+        for key, (expiry, result) in self.cache.items():
+            if expiry <= now:
+                del self.cache[key]
+
+    def stats(self):
+        "Cache hits and misses, and latency of recent checks, in seconds"
+        latencies = sorted(self.latencies)
+        stats = {"hits": self.hits, "misses": self.misses,
+                 "checks": len(latencies)}
+        if latencies:
+            stats["mean_latency"] = sum(latencies) / len(latencies)
+            stats["p95_latency"] = latencies[int(len(latencies) * 0.95)]
+        return stats
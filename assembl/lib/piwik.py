@@ -1,3 +1,7 @@
+from datetime import date as date_type, datetime, timedelta
+from threading import Event, Lock
+from time import time
+
 import requests
 from pyramid.settings import asbool
 
@@ -238,3 +242,105 @@ def piwik_Actions_get(piwik_url, piwik_api_token, idSite, period, date):
         raise Exception("Matomo request json body doesn't have a nb_pageviews key")
 
     return content
+
+
+class AnalyticsCache(object):
+    """Process-wide cache of Matomo reporting calls.
+
+    Entries are keyed by (piwik url, site, period, date, method).
+    Reports of date ranges which are over do not change, and are kept
+    indefinitely; others are kept ``ttl`` seconds. Concurrent identical
+    calls wait for the first one instead of querying Matomo again."""
+
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = Lock()
+        # key -> (expiry time or None, value)
+        self.entries = {}
+        # key -> [Event, value, exception] of calls in progress
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_complete(period, date):
+        """Whether the date or date range is over.
+        Yesterday is not, the site's timezone may be behind ours."""
+        if period not in ('range', 'day'):
+            return False
+        try:
+            end = datetime.strptime(date.split(',')[-1], '%Y-%m-%d').date()
+        except ValueError:
+            # today, yesterday, last7...
+            return False
+        return end < date_type.today() - timedelta(days=1)
+
+    def get(self, key, fetch, permanent=False):
+        "The cached value for key, or the result of ``fetch()``"
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and (entry[0] is None or entry[0] > time()):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            call = self.pending.get(key, None)
+            is_owner = call is None
+            if is_owner:
+                call = self.pending[key] = [Event(), None, None]
+        if not is_owner:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = fetch()
+        except Exception as e:
+            # errors are not cached
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+                if call[2] is None and (permanent or self.ttl > 0):
+                    if len(self.entries) >= self.max_entries:
+                        self.expire()
+                    self.entries[key] = (
+                        None if permanent else time() + self.ttl, call[1])
+            call[0].set()
+        return call[1]
+
+    def expire(self):
+        "Forget expired reports, or everything if still too many"
+        now = time()
+        for key, (expiry, value) in self.entries.items():
+            if expiry is not None and expiry <= now:
+                del self.entries[key]
+        if len(self.entries) >= self.max_entries:
+            self.entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self.entries)}
+
+
+_analytics_cache = None
+
+
+def get_analytics_cache():
+    global _analytics_cache
+    if _analytics_cache is None:
+        from . import config
+        _analytics_cache = AnalyticsCache(
+            int(config.get('web_analytics_piwik_cache_ttl', 300) or 0))
+    return _analytics_cache
+
+
+def cached_piwik_call(method, piwik_url, piwik_api_token, idSite, period, date):
+    """Call one of the reporting functions above, e.g.
+    piwik_Actions_get, through the analytics cache."""
+    cache = get_analytics_cache()
+    return cache.get(
+        (piwik_url, idSite, period, date, method.__name__),
+        lambda: method(piwik_url, piwik_api_token, idSite, period, date),
+        cache.is_complete(period, date))
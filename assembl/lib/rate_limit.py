@@ -0,0 +1,70 @@
+"""Token buckets, to rate limit actions shared by several processes.
+
+Each bucket refills one token every ``interval`` seconds, up to ``burst``
+tokens. Instead of waiting for a token, callers reserve the next one and
+get the delay after which they may act, so they can schedule the action
+for later. With a redis url, buckets are kept in redis and shared by all
+processes; otherwise they are local to the process."""
+from threading import Lock
+from time import time
+
+# KEYS[1]: bucket key. ARGV: now, interval, burst.
+# The bucket holds the time at which it will be full again.
+_RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local full_at = tonumber(redis.call('get', KEYS[1]) or '0')
+if full_at < now then
+    full_at = now
+end
+local delay = full_at - now - (burst - 1) * interval
+if delay < 0 then
+    delay = 0
+end
+full_at = full_at + interval
+redis.call('set', KEYS[1], tostring(full_at), 'ex', math.ceil(full_at - now) + 1)
+return tostring(delay)
+"""
+
+
+class TokenBuckets(object):
+    """Rate limiting by key, with a token bucket per key.
+
+    :param redis_url: redis server keeping the buckets, if shared
+    :param prefix: prefix of the redis keys of the buckets
+    """
+
+    def __init__(self, redis_url=None, prefix='assembl:rate:'):
+        self.prefix = prefix
+        self.lock = Lock()
+        # key -> time at which the bucket is full
+        self.full_at = {}
+        self.redis = None
+        if redis_url:
+            from redis import StrictRedis
+            self.redis = StrictRedis.from_url(redis_url)
+            self.reserve_script = self.redis.register_script(_RESERVE_SCRIPT)
+
+    def reserve(self, key, interval, burst=1, now=None):
+        """Take a token from the bucket of key, and return the delay
+        in seconds after which it can be used (0 if it can be now)."""
+        if interval <= 0:
+            return 0
+        now = time() if now is None else now
+        if self.redis is not None:
+            return float(self.reserve_script(
+                keys=[self.prefix + key], args=[repr(now), interval, burst]))
+        with self.lock:
+            full_at = max(self.full_at.get(key, 0), now)
+            delay = max(full_at - now - (burst - 1) * interval, 0)
+            self.full_at[key] = full_at + interval
+            if len(self.full_at) > 10000:
+                self.expire(now)
+            return delay
+
+    def expire(self, now):
+        "Forget full buckets"
+        for key, full_at in self.full_at.items():
+            if full_at <= now:
+                del self.full_at[key]
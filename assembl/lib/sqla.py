@@ -41,7 +41,7 @@ from graphene.relay import Node
 
 from .parsedatetime import parse_datetime
 from ..view_def import get_view_def
-from .zmqlib import get_pub_socket, send_changes
+from .zmqlib import publish_changes
 from ..auth import *
 from .decl_enums import EnumSymbol, DeclEnumType
 from .utils import get_global_base_url
@@ -212,6 +212,159 @@ class TableLockCreationThread(Thread):
             self.exception = e
 
 
+# Compiled generic_json plans, by (class, view_def_name).
+# Values are (view_def, plan), so a reloaded view_def invalidates the plan.
+_json_plans = {}
+
+
+def _translate_to_json(v, view_name, user_id, permissions, base_uri):
+    if isinstance(v, Base):
+        p = getattr(v, 'user_can', None)
+        if p and not v.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            return None
+        if view_name:
+            return v.generic_json(
+                view_name, user_id, permissions, base_uri)
+        else:
+            return v.uri(base_uri)
+    elif isinstance(v, (
+            str, unicode, int, long, float, bool, types.NoneType)):
+        return v
+    elif isinstance(v, EnumSymbol):
+        return v.name
+    elif isinstance(v, datetime):
+        return v.isoformat() + "Z"
+    elif isinstance(v, dict):
+        v = {_translate_to_json(k, view_name, user_id, permissions, base_uri):
+             _translate_to_json(val, view_name, user_id, permissions, base_uri)
+             for k, val in v.items()}
+        return {k: val for (k, val) in v.items()
+                if val is not None}
+    elif isinstance(v, Iterable):
+        v = [_translate_to_json(i, view_name, user_id, permissions, base_uri)
+             for i in v]
+        return [x for x in v if x is not None]
+    else:
+        raise NotImplementedError("Cannot translate", v)
+
+
+def _json_literal_step(name, literal):
+    value = loads(literal)
+    if isinstance(value, (list, dict)):
+        # mutable: give each result its own copy
+        def step(ob, result, user_id, permissions, base_uri):
+            result[name] = loads(literal)
+    else:
+        def step(ob, result, user_id, permissions, base_uri):
+            result[name] = value
+    return step
+
+
+def _json_constant_step(name, value):
+    def step(ob, result, user_id, permissions, base_uri):
+        result[name] = value
+    return step
+
+
+def _json_self_step(name, view_name):
+    if view_name:
+        def step(ob, result, user_id, permissions, base_uri):
+            r = ob.generic_json(view_name, user_id, permissions, base_uri)
+            if r is not None:
+                result[name] = r
+    else:
+        def step(ob, result, user_id, permissions, base_uri):
+            result[name] = ob.uri()
+    return step
+
+
+def _json_method_step(name, method_name, view_name):
+    def step(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, method_name)()
+        result[name] = _translate_to_json(
+            val, view_name, user_id, permissions, base_uri)
+    return step
+
+
+def _json_attribute_step(name, prop_name, view_name):
+    def step(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, prop_name)
+        if val is not None:
+            val = _translate_to_json(
+                val, view_name, user_id, permissions, base_uri)
+        if val is not None:
+            result[name] = val
+    return step
+
+
+def _json_fkey_step(name, fkey_name, target_cls, use_base_uri, as_list):
+    """Give the uri of a many-to-one relation from the foreign key,
+    without fetching the target object."""
+    def step(ob, result, user_id, permissions, base_uri):
+        ob_id = getattr(ob, fkey_name)
+        if not use_base_uri:
+            result[name] = target_cls.uri_generic(ob_id)
+            return
+        uri = target_cls.uri_generic(ob_id, base_uri) if ob_id else None
+        if as_list:
+            result[name] = [uri] if uri else []
+        else:
+            result[name] = uri
+    return step
+
+
+def _json_object_step(name, prop_name, view_name, as_list):
+    def step(ob, result, user_id, permissions, base_uri):
+        target = getattr(ob, prop_name)
+        val = None
+        if view_name:
+            if target and target.user_can(
+                    user_id, CrudPermissions.READ, permissions):
+                val = target.generic_json(
+                    view_name, user_id, permissions, base_uri)
+                if val is None:
+                    # Keep the key absent, as the target is unreadable
+                    return
+        elif target:
+            val = target.uri(base_uri)
+        if as_list:
+            result[name] = [val] if val is not None else []
+        else:
+            result[name] = val
+    return step
+
+
+def _json_collection_step(name, prop_name, view_name, as_dict):
+    def step(ob, result, user_id, permissions, base_uri):
+        vals = [v for v in getattr(ob, prop_name)
+                if v.user_can(user_id, CrudPermissions.READ, permissions)]
+        if not view_name:
+            result[name] = [v.uri(base_uri) for v in vals]
+        elif as_dict:
+            result[name] = {
+                v.uri(base_uri): v.generic_json(
+                    view_name, user_id, permissions, base_uri)
+                for v in vals}
+        else:
+            result[name] = [
+                v.generic_json(view_name, user_id, permissions, base_uri)
+                for v in vals]
+    return step
+
+
+def _json_default_column_step(name):
+    def step(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, name)
+        if val:
+            if type(val) == datetime:
+                val = val.isoformat() + "Z"
+            result[name] = val
+        else:
+            result[name] = None
+    return step
+
+
 class BaseOps(object):
     """Base class for SQLAlchemy models in Assembl.
 
@@ -635,21 +788,21 @@ class BaseOps(object):
             view_def[my_typename] = local_view
         return local_view
 
-    def generic_json(
-            self, view_def_name='default', user_id=None,
-            permissions=(P_READ, ), base_uri='local:'):
-        """Return a representation of this object as a JSON object,
-        according to the given view_def and access control."""
-        user_id = user_id or Everyone
-        if not self.user_can(user_id, CrudPermissions.READ, permissions):
-            return None
-        view_def = get_view_def(view_def_name or 'default')
-        my_typename = self.external_typename()
-        result = {}
-        local_view = self.expand_view_def(view_def)
+    @classmethod
+    def compile_json_plan(cls, view_def_name='default'):
+        """Compile the serialization plan of this class for a view_def.
+
+        The plan is a list of steps, each a callable taking
+        ``(instance, result, user_id, permissions, base_uri)`` and
+        filling the result dict. All the mapper and view_def
+        introspection is done here, once.
+        Returns None if the class is not represented in the view_def."""
+        view_def = get_view_def(view_def_name)
+        my_typename = cls.external_typename()
+        local_view = cls.expand_view_def(view_def)
         if not local_view:
             return None
-        mapper = self.__class__.__mapper__
+        mapper = cls.__mapper__
         relns = {r.key: r for r in mapper.relationships}
         cols = {c.key: c for c in mapper.columns}
         fkeys = {c for c in mapper.columns if c.foreign_keys}
@@ -660,11 +813,12 @@ class BaseOps(object):
         fkey_of_reln = {r.key: r._calculated_foreign_keys
                         for r in mapper.relationships}
         methods = dict(pyinspect.getmembers(
-            self.__class__, lambda m: pyinspect.ismethod(m)
+            cls, lambda m: pyinspect.ismethod(m)
             and m.func_code.co_argcount == 1))
         properties = dict(pyinspect.getmembers(
-            self.__class__, lambda p: pyinspect.isdatadescriptor(p)))
+            cls, lambda p: pyinspect.isdatadescriptor(p)))
         known = set()
+        plan = []
         for name, spec in local_view.iteritems():
             if name == "_default":
                 continue
@@ -697,7 +851,7 @@ class BaseOps(object):
                         view_def_name, my_typename, name)
                 if subspec[0] == "'":
                     # literals.
-                    result[name] = loads(subspec[1:])
+                    plan.append(_json_literal_step(name, subspec[1:]))
                     continue
                 if ':' in subspec:
                     prop_name, view_name = subspec.split(':', 1)
@@ -712,48 +866,12 @@ class BaseOps(object):
                 assert get_view_def(view_name),\
                     "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
                         view_def_name, my_typename, name, view_name)
-            #print prop_name, name, view_name
-
-            def translate_to_json(v):
-                if isinstance(v, Base):
-                    p = getattr(v, 'user_can', None)
-                    if p and not v.user_can(
-                            user_id, CrudPermissions.READ, permissions):
-                        return None
-                    if view_name:
-                        return v.generic_json(
-                            view_name, user_id, permissions, base_uri)
-                    else:
-                        return v.uri(base_uri)
-                elif isinstance(v, (
-                        str, unicode, int, long, float, bool, types.NoneType)):
-                    return v
-                elif isinstance(v, EnumSymbol):
-                    return v.name
-                elif isinstance(v, datetime):
-                    return v.isoformat() + "Z"
-                elif isinstance(v, dict):
-                    v = {translate_to_json(k): translate_to_json(val)
-                         for k, val in v.items()}
-                    return {k: val for (k, val) in v.items()
-                            if val is not None}
-                elif isinstance(v, Iterable):
-                    v = [translate_to_json(i) for i in v]
-                    return [x for x in v if x is not None]
-                else:
-                    raise NotImplementedError("Cannot translate", v)
 
             if prop_name == 'self':
-                if view_name:
-                    r = self.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if r is not None:
-                        result[name] = r
-                else:
-                    result[name] = self.uri()
+                plan.append(_json_self_step(name, view_name))
                 continue
             elif prop_name == '@view':
-                result[name] = view_def_name
+                plan.append(_json_constant_step(name, view_def_name))
                 continue
             elif prop_name[0] == '&':
                 prop_name = prop_name[1:]
@@ -762,8 +880,7 @@ class BaseOps(object):
                         view_def_name, my_typename, name, prop_name)
                 # Function call. PLEASE RETURN JSON, Base objects,
                 # or list or dicts thereof
-                val = getattr(self, prop_name)()
-                result[name] = translate_to_json(val)
+                plan.append(_json_method_step(name, prop_name, view_name))
                 continue
             elif prop_name in cols:
                 assert not view_name,\
@@ -776,28 +893,20 @@ class BaseOps(object):
                     "in viewdef %s, class %s, dict for literal property %s" % (
                         view_def_name, my_typename, prop_name)
                 known.add(prop_name)
-                val = getattr(self, prop_name)
-                if val is not None:
-                    val = translate_to_json(val)
-                if val is not None:
-                    result[name] = val
+                plan.append(_json_attribute_step(name, prop_name, None))
                 continue
             elif prop_name in properties:
                 known.add(prop_name)
                 if view_name or (prop_name not in fkey_of_reln) or (
                         relns[prop_name].direction != MANYTOONE):
-                    val = getattr(self, prop_name)
-                    if val is not None:
-                        val = translate_to_json(val)
-                    if val is not None:
-                        result[name] = val
+                    plan.append(_json_attribute_step(
+                        name, prop_name, view_name))
                 else:
-                    fkeys = list(fkey_of_reln[prop_name])
-                    assert(len(fkeys) == 1)
-                    fkey = fkeys[0]
-                    result[name] = relns[prop_name].mapper.class_.uri_generic(
-                        getattr(self, fkey.key))
-
+                    reln_fkeys = list(fkey_of_reln[prop_name])
+                    assert(len(reln_fkeys) == 1)
+                    plan.append(_json_fkey_step(
+                        name, reln_fkeys[0].key,
+                        relns[prop_name].mapper.class_, False, False))
                 continue
             assert prop_name in relns,\
                     "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
@@ -806,75 +915,28 @@ class BaseOps(object):
             # Add derived prop?
             reln = relns[prop_name]
             if reln.uselist:
-                vals = getattr(self, prop_name)
-                if view_name:
-                    if isinstance(spec, dict):
-                        result[name] = {
-                            ob.uri(base_uri):
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)}
-                    else:
-                        result[name] = [
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)]
-                else:
+                if not view_name:
                     assert not isinstance(spec, dict),\
                         "in viewdef %s, class %s, dict without viewname for %s" % (
                             view_def_name, my_typename, name)
-                    result[name] = [
-                        ob.uri(base_uri) for ob in vals
-                        if ob.user_can(
-                            user_id, CrudPermissions.READ, permissions)]
+                plan.append(_json_collection_step(
+                    name, prop_name, view_name, isinstance(spec, dict)))
                 continue
             assert not isinstance(spec, dict),\
                 "in viewdef %s, class %s, dict for non-list relation %s" % (
                     view_def_name, my_typename, prop_name)
+            as_list = isinstance(spec, list)
             if view_name:
-                ob = getattr(self, prop_name)
-                if ob and ob.user_can(
-                        user_id, CrudPermissions.READ, permissions):
-                    val = ob.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if val is not None:
-                        if isinstance(spec, list):
-                            result[name] = [val]
-                        else:
-                            result[name] = val
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
+                plan.append(_json_object_step(
+                    name, prop_name, view_name, as_list))
+            elif len(reln._calculated_foreign_keys) == 1 \
+                    and reln._calculated_foreign_keys < fkeys:
+                # shortcut, avoid fetch
+                fkey = list(reln._calculated_foreign_keys)[0]
+                plan.append(_json_fkey_step(
+                    name, fkey.name, reln.mapper.class_, True, as_list))
             else:
-                uri = None
-                if len(reln._calculated_foreign_keys) == 1 \
-                        and reln._calculated_foreign_keys < fkeys:
-                    # shortcut, avoid fetch
-                    fkey = list(reln._calculated_foreign_keys)[0]
-                    ob_id = getattr(self, fkey.name)
-                    if ob_id:
-                        uri = reln.mapper.class_.uri_generic(
-                            ob_id, base_uri)
-                else:
-                    ob = getattr(self, prop_name)
-                    if ob:
-                        uri = ob.uri(base_uri)
-                if uri:
-                    if isinstance(spec, list):
-                        result[name] = [uri]
-                    else:
-                        result[name] = uri
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
+                plan.append(_json_object_step(name, prop_name, None, as_list))
 
         if local_view.get('_default') is not False:
             for name, col in cols.items():
@@ -885,21 +947,41 @@ class BaseOps(object):
                     name = as_rel.key
                     if name in known:
                         continue
-                    else:
-                        ob_id = getattr(self, col.key)
-                        if ob_id:
-                            result[name] = as_rel.mapper.class_.uri_generic(
-                                ob_id, base_uri)
-                        else:
-                            result[name] = None
+                    plan.append(_json_fkey_step(
+                        name, col.key, as_rel.mapper.class_, True, False))
                 else:
-                    ob = getattr(self, name)
-                    if ob:
-                        if type(ob) == datetime:
-                            ob = ob.isoformat() + "Z"
-                        result[name] = ob
-                    else:
-                        result[name] = None
+                    plan.append(_json_default_column_step(name))
+        return plan
+
+    @classmethod
+    def get_json_plan(cls, view_def_name='default'):
+        """Get the compiled serialization plan of this class for a view_def.
+
+        Plans are cached per (class, view_def_name), and recompiled
+        if the view_def was reloaded."""
+        view_def = get_view_def(view_def_name)
+        key = (cls, view_def_name)
+        cached = _json_plans.get(key, None)
+        if cached is not None and cached[0] is view_def:
+            return cached[1]
+        plan = cls.compile_json_plan(view_def_name)
+        _json_plans[key] = (view_def, plan)
+        return plan
+
+    def generic_json(
+            self, view_def_name='default', user_id=None,
+            permissions=(P_READ, ), base_uri='local:'):
+        """Return a representation of this object as a JSON object,
+        according to the given view_def and access control."""
+        user_id = user_id or Everyone
+        if not self.user_can(user_id, CrudPermissions.READ, permissions):
+            return None
+        plan = self.get_json_plan(view_def_name or 'default')
+        if plan is None:
+            return None
+        result = {}
+        for step in plan:
+            step(self, result, user_id, permissions, base_uri)
         return result
 
     dummy_context = DummyContext()
@@ -1761,33 +1843,39 @@ def before_commit_listener(session):
     info = session.connection().info
     if 'cdict' in info:
         changes = defaultdict(list)
+        keys = defaultdict(list)
         for ((uri, view_def), (discussion, target)) in \
                 info['cdict'].iteritems():
             discussion = bytes(discussion or "*")
             json = target.generic_json(view_def)
             if json:
                 changes[discussion].append(json)
+                keys[discussion].append((uri, view_def))
         del info['cdict']
         session.cdict2 = changes
+        session.cdict2_keys = keys
     else:
         print "EMPTY CDICT!"
 
 
 def after_commit_listener(session):
     """After commit, actually send the Json representation of changed objects
-    to the :py:mod:`assembl.tasks.changes_router`, through 0MQ."""
-    if not getattr(session, 'zsocket', None):
-        session.zsocket = get_pub_socket()
+    to the :py:mod:`assembl.tasks.changes_router`, through 0MQ.
+
+    Sending is done by the publisher thread, which coalesces changes."""
     if getattr(session, 'cdict2', None):
+        keys = getattr(session, 'cdict2_keys', {})
         for discussion, changes in session.cdict2.iteritems():
-            send_changes(session.zsocket, discussion, changes)
+            publish_changes(discussion, changes, keys.get(discussion, None))
         del session.cdict2
+        session.cdict2_keys = None
 
 
 def session_rollback_listener(session):
     """In case of rollback, forget about object changes."""
     if getattr(session, 'cdict2', None):
         del session.cdict2
+        session.cdict2_keys = None
 
 
 def engine_rollback_listener(connection):
@@ -1,21 +1,34 @@
 """ZMQ setup for the changes socket"""
 import atexit
+import logging
+from collections import OrderedDict
 from itertools import count
+from os import getpid
+from Queue import Queue, Empty
+from threading import Thread, Lock
 
+import simplejson as json
 import zmq
 import zmq.devices
-from time import sleep
+from time import sleep, time
 
 context = zmq.Context.instance()
+log = logging.getLogger('assembl')
 
 INTERNAL_SOCKET = 'inproc://assemblchanges'
 CHANGES_SOCKET = None
 MULTIPLEX = True
 INITED = False
 DISPATCHER = None
+# Changesets published within this many seconds are sent together
+COALESCE_WINDOW = 0.05
+# How long to wait for a subscriber before sending anyway
+READY_TIMEOUT = 1.0
 
 _counter = count()
 _active_sockets = []
+_publisher = None
+_publisher_lock = Lock()
 
 
 def start_dispatch_thread():
@@ -37,44 +50,175 @@ def start_dispatch_thread():
 def stop_sockets():
     #print "STOPPING SOCKETS"
     global CHANGES_SOCKET, MULTIPLEX, INITED, DISPATCHER
+    if _publisher is not None:
+        _publisher.stop()
     for socket in _active_sockets:
         socket.close()
     INITED = False
 
 
-def get_pub_socket():
+def get_pub_socket(ready_timeout=None):
+    """Create a publishing socket on the changes socket.
+
+    This is an XPUB socket, so we can know when a subscriber is there
+    (avoiding the "slow joiner" symptom) instead of sleeping.
+    http://zguide.zeromq.org/page:all#Getting-the-Message-Out
+    """
     if MULTIPLEX:
         start_dispatch_thread()
-    socket = context.socket(zmq.PUB)
+    socket = context.socket(zmq.XPUB)
     if MULTIPLEX:
         socket.connect(INTERNAL_SOCKET)
     else:
         socket.connect(CHANGES_SOCKET)
     _active_sockets.append(socket)
-    # Related to "slow joiner" symptom
-    # http://zguide.zeromq.org/page:all#Getting-the-Message-Out
-    # It would be better to get the "ready" signal back but this is
-    # adequate for now.
-    sleep(0.2)
+    if ready_timeout is None:
+        ready_timeout = READY_TIMEOUT
+    # Wait for the first subscription to reach us
+    if socket.poll(int(ready_timeout * 1000), zmq.POLLIN):
+        drain_subscriptions(socket)
+    else:
+        log.warning("No subscriber on the changes socket")
     return socket
 
 
+def drain_subscriptions(socket):
+    "Read the subscription messages received by an XPUB socket"
+    try:
+        while True:
+            socket.recv(zmq.NOBLOCK)
+    except zmq.Again:
+        pass
+
+
 def send_changes(socket, discussion, changeset):
     order = _counter.next()
+    data = json.dumps(changeset)
     socket.send(discussion, zmq.SNDMORE)
     socket.send(str(order), zmq.SNDMORE)
-    socket.send_json(changeset)
-    print "sent", order, discussion, changeset
-
-
-def configure_zmq(sockdef, multiplex):
-    global CHANGES_SOCKET, MULTIPLEX
+    socket.send(data)
+    return len(discussion) + len(data)
+
+
+class ChangesPublisher(Thread):
+    """Publishes changesets to the changes socket from a single thread.
+
+    Changesets published within a short window are coalesced into one
+    message per discussion, keeping only the last version of each object
+    representation (by ``@id``, view_def and ``@private`` recipient).
+    Keeps counters of messages and bytes sent."""
+
+    stats_interval = 60
+
+    def __init__(self, window=None):
+        super(ChangesPublisher, self).__init__(name="changes_publisher")
+        self.daemon = True
+        self.window = COALESCE_WINDOW if window is None else window
+        self.queue = Queue()
+        self.messages = 0
+        self.bytes = 0
+        self._last_stats = (time(), 0, 0)
+        self._last_log = time()
+
+    def publish(self, discussion, changes, keys=None):
+        self.queue.put((discussion, changes, keys))
+
+    def stop(self, timeout=1.0):
+        self.queue.put(None)
+        self.join(timeout)
+
+    @staticmethod
+    def coalesce(pending, discussion, changes, keys=None):
+        """Add changes to the pending changes of a discussion.
+        keys are the (uri, view_def) of each change, if known."""
+        by_id = pending.setdefault(discussion, OrderedDict())
+        if keys is None:
+            keys = [(change.get('@id', None), None) for change in changes]
+        for (uri, view_def), change in zip(keys, changes):
+            # The same object may be sent in many views, and to many users
+            key = (uri, view_def, change.get('@private', None)
+                   ) if uri else id(change)
+            # last write wins, in the order of the last write
+            by_id.pop(key, None)
+            by_id[key] = change
+
+    def run(self):
+        socket = get_pub_socket()
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            pending = OrderedDict()
+            self.coalesce(pending, *item)
+            deadline = time() + self.window
+            while True:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                self.coalesce(pending, *item)
+            drain_subscriptions(socket)
+            for discussion, by_id in pending.iteritems():
+                try:
+                    self.bytes += send_changes(
+                        socket, discussion, by_id.values())
+                    self.messages += 1
+                except Exception as e:
+                    log.error("Could not send changes: %s" % (e,))
+            if time() - self._last_log > self.stats_interval:
+                self._last_log = time()
+                log.debug("changes socket: %(messages_per_second).1f msg/s, "
+                          "%(bytes_per_second).1f bytes/s" % self.stats())
+
+    def stats(self):
+        """Messages and bytes sent, in total and per second
+        since the last call."""
+        now = time()
+        (last_time, last_messages, last_bytes) = self._last_stats
+        messages, bytes = self.messages, self.bytes
+        self._last_stats = (now, messages, bytes)
+        elapsed = max(now - last_time, 1e-6)
+        return {
+            "messages": messages,
+            "bytes": bytes,
+            "messages_per_second": (messages - last_messages) / elapsed,
+            "bytes_per_second": (bytes - last_bytes) / elapsed,
+        }
+
+
+def get_publisher():
+    """The changes publisher of this process (restarted after a fork)"""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None or _publisher.pid != getpid():
+            _publisher = ChangesPublisher()
+            _publisher.pid = getpid()
+            _publisher.start()
+    return _publisher
+
+
+def publish_changes(discussion, changes, keys=None):
+    get_publisher().publish(discussion, changes, keys)
+
+
+def configure_zmq(sockdef, multiplex, coalesce_window=None):
+    global CHANGES_SOCKET, MULTIPLEX, COALESCE_WINDOW
     assert isinstance(sockdef, str)
     CHANGES_SOCKET = sockdef
     MULTIPLEX = multiplex
+    if coalesce_window is not None:
+        COALESCE_WINDOW = coalesce_window
 
 
 def includeme(config):
     settings = config.registry.settings
     configure_zmq(settings['changes.socket'],
-                  settings['changes.multiplex'])
+                  settings['changes.multiplex'],
+                  float(settings.get('changes.coalesce_window', 0.05)))
@@ -174,12 +174,14 @@ from .mail import (  # noqa: E402, F401
     AbstractFilesystemMailbox,
     AbstractMailbox,
     Email,
+    EmailReference,
     IMAPMailbox,
     MaildirMailbox,
     MailingList,
 )
 from .idea import (  # noqa: E402, F401
     Idea,
+    IdeaClosure,
     IdeaLink,
     RootIdea,
 )
@@ -340,6 +342,10 @@ from .section import Section  # noqa: E402, F401
 from .vote_session import VoteSession  # noqa: E402, F401
 from .landing_page import LandingPageModuleType, LandingPageModule  # noqa: E402, F401
 
+# Last, as it needs all content link classes, and registers cache listeners.
+from .path_utils import DiscussionGlobalData  # noqa: E402, F401
+from .keywords import PostTermFrequency  # noqa: E402, F401
+
 
 def includeme(config):
     config.include('.langstrings')
@@ -19,7 +19,7 @@ from abc import abstractproperty
 
 from . import DiscussionBoundBase, DiscussionBoundTombstone, TombstonableMixin, Post
 from ..lib.sqla import DuplicateHandling
-from .auth import User
+from .auth import User, participant_added
 from .generic import Content
 from .discussion import Discussion
 from .idea import Idea
@@ -243,6 +243,14 @@ class MoreInfoSentimentOfPost(SentimentOfPost):
         return 'more_info'
 
 
+@event.listens_for(ViewPost, 'after_insert', propagate=True)
+def record_reader(mapper, connection, target):
+    discussion_id = select([Content.discussion_id]).where(
+        Content.id == target.post_id).as_scalar()
+    participant_added(
+        connection, discussion_id, target.actor_id, reader=True)
+
+
 @event.listens_for(SentimentOfPost, 'after_insert', propagate=True)
 def send_post_to_socket(mapper, connection, target):
     target.post.send_to_changes(view_def="aux_data")
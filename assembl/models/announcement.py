@@ -21,7 +21,7 @@ from assembl.auth import (
     P_ADD_IDEA,
     P_EDIT_IDEA
 )
-from .auth import AgentProfile
+from .auth import AgentProfile, track_participation
 
 
 class Announcement(DiscussionBoundBase):
@@ -107,6 +107,7 @@ class Announcement(DiscussionBoundBase):
 
 LangString.setup_ownership_load_event(
     Announcement, ['title', 'body'])
+track_participation(Announcement, 'creator_id')
 
 
 class IdeaAnnouncement(Announcement):
@@ -14,13 +14,16 @@ from sqlalchemy import (
     String,
     ForeignKey,
     Enum,
-    event
+    event,
+    inspect
 )
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy.orm.session import Session
 
 from ..lib.antivirus import get_antivirus
+from ..lib.raven_client import capture_exception
 from ..lib.sqla_types import CoerceUnicode
-from ..lib.sqla import DuplicateHandling
+from ..lib.sqla import DuplicateHandling, mark_changed
 from ..lib.sqla_types import URLString
 from ..lib.hash_fs import get_hashfs
 from ..lib.abc import classproperty
@@ -29,7 +32,7 @@ from .post import Post
 from .idea import Idea
 from .resource import Resource
 from .vote_session import VoteSession
-from .auth import AgentProfile
+from .auth import AgentProfile, track_participation
 from assembl.auth import (
     CrudPermissions, P_READ, P_ADMIN_DISC, P_ADD_POST,
     P_SYSADMIN, P_EDIT_POST, P_ADD_IDEA, P_EDIT_IDEA, P_MANAGE_RESOURCE)
@@ -233,25 +236,61 @@ class File(Document):
             # somewhat random
             return extensions[0]
 
+    @classmethod
+    def known_virus_status(cls, db, file_identity):
+        """The status of a checked file with that content, if any"""
+        status = db.query(cls.av_checked).filter(
+            cls.file_identity == file_identity,
+            cls.av_checked != AntiVirusStatus.unchecked.name).first()
+        return status[0] if status else None
+
+    @classmethod
+    def virus_check_identity(cls, db, file_identity, antivirus=None):
+        """Check the unchecked files with that content for viruses, unless
+        a file with the same content was already checked.
+        Returns the status, or None if another process is checking them."""
+        status = cls.known_virus_status(db, file_identity)
+        unchecked = db.query(cls.id).filter_by(
+            file_identity=file_identity,
+            av_checked=AntiVirusStatus.unchecked.name)
+        # Lock rows to avoid multiple antivirus processes
+        file_ids = [id for (id,) in unchecked.with_for_update(
+            skip_locked=True)]
+        if not file_ids:
+            return status
+        if status is None:
+            antivirus = antivirus or get_antivirus()
+            safe = antivirus.check(cls.path_of(file_identity))
+            status = (AntiVirusStatus.passed.name if safe
+                      else AntiVirusStatus.failed.name)
+        db.query(cls).filter(cls.id.in_(file_ids)).update(
+            {cls.av_checked: status}, synchronize_session='fetch')
+        mark_changed(db)
+        return status
+
     def ensure_virus_checked(self, antivirus=None):
         "Check if the file has viruses"
-        antivirus = antivirus or get_antivirus()
-        # Lock row to avoid multiple antivirus processes
-        (status,) = self.db.query(File.av_checked).filter_by(id=self.id).with_for_update().first()
-        if status == AntiVirusStatus.failed.unchecked.name:
-            safe = antivirus.check(self.path)
-            status = AntiVirusStatus.passed.name if safe else AntiVirusStatus.failed.name
-            self.av_checked = status
-        return status
+        if self.av_checked == AntiVirusStatus.unchecked.name:
+            self.virus_check_identity(
+                self.db, self.file_identity, antivirus)
+        return self.av_checked
+
+    @property
+    def requires_virus_check(self):
+        return self.discussion.preferences['requires_virus_check']
 
     @property
     def infected(self):
-        if self.av_checked == AntiVirusStatus.unchecked.name:
-            needs_check = self.discussion.preferences['requires_virus_check']
-            if needs_check:
-                self.ensure_virus_checked()
         return self.av_checked == AntiVirusStatus.failed.name
 
+    @property
+    def virus_check_pending(self):
+        """Whether the file cannot be served until it is checked.
+        Files are checked in the background, see
+        :py:mod:`assembl.tasks.antivirus`"""
+        return (self.av_checked == AntiVirusStatus.unchecked.name and
+                self.requires_virus_check)
+
     @Document.external_url.getter
     def external_url(self):
         """
@@ -262,6 +301,61 @@ class File(Document):
         return self.discussion.compose_external_uri('documents', self.id, 'data')
 
 
+@event.listens_for(File, 'before_update', propagate=True)
+def file_content_changed(mapper, connection, target):
+    if inspect(target).attrs.file_identity.history.has_changes():
+        target.av_checked = AntiVirusStatus.unchecked.name
+        object_session(target).info.setdefault(
+            'files_to_check', set()).add(target.id)
+
+
+@event.listens_for(File, 'after_insert', propagate=True)
+def file_created(mapper, connection, target):
+    object_session(target).info.setdefault(
+        'files_to_check', set()).add(target.id)
+
+
+@event.listens_for(Session, 'before_commit')
+def files_before_commit(session):
+    """Give new files the status of checked files with the same content,
+    and queue the others for the antivirus if their discussion requires it.
+    """
+    if not session.info.get('files_to_check', None):
+        return
+    session.flush()
+    file_ids = session.info.pop('files_to_check')
+    to_scan = session.info.setdefault('files_to_scan', set())
+    for f in session.query(File).filter(
+            File.id.in_(file_ids),
+            File.file_identity != None,  # noqa: E711
+            File.av_checked == AntiVirusStatus.unchecked.name):
+        if not f.requires_virus_check:
+            continue
+        status = File.known_virus_status(session, f.file_identity)
+        if status:
+            f.av_checked = status
+        else:
+            to_scan.add(f.file_identity)
+
+
+@event.listens_for(Session, 'after_commit')
+def files_after_commit(session):
+    file_identities = session.info.pop('files_to_scan', None)
+    if file_identities:
+        from ..tasks.antivirus import scan_files
+        try:
+            scan_files.delay(sorted(file_identities))
+        except Exception:
+            # They will be queued again when downloaded
+            capture_exception()
+
+
+@event.listens_for(Session, 'after_rollback')
+def files_after_rollback(session):
+    session.info.pop('files_to_check', None)
+    session.info.pop('files_to_scan', None)
+
+
 class Attachment(DiscussionBoundBase):
     """
     Represents a Document or file, local to the database or (more typically)
@@ -327,6 +421,9 @@ class Attachment(DiscussionBoundBase):
         return self.document.external_url
 
 
+track_participation(Attachment, 'creator_id')
+
+
 class DiscussionAttachment(Attachment):
     __mapper_args__ = {
         'polymorphic_identity': 'discussion_attachment',
@@ -28,8 +28,10 @@ from sqlalchemy import (
     UniqueConstraint
 )
 from pyramid.httpexceptions import HTTPBadRequest, HTTPUnauthorized
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import (
     relationship, backref, deferred)
+from sqlalchemy.orm.session import object_session, Session
 from sqlalchemy.orm.attributes import NO_VALUE
 from sqlalchemy.sql.functions import count
 
@@ -53,6 +55,7 @@ from ..auth import (
     R_PARTICIPANT,
     SYSTEM_ROLES
 )
+from ..auth.permission_cache import permissions_changed
 from .langstrings import Locale
 
 
@@ -650,6 +653,112 @@ def send_user_to_socket_for_asid(mapper, connection, target):
         connection, CrudOperation.UPDATE, target.discussion_id)
 
 
+class DiscussionParticipant(Base):
+    """The users who took part in a discussion, by contributing or reading.
+
+    Maintained by ORM listeners (see :py:func:`track_participation`),
+    so participants can be listed and counted without going through
+    all contributions. Users with global roles and the discussion creator
+    are not included, see
+    :py:meth:`assembl.models.discussion.Discussion.get_participants_query`.
+    """
+    __tablename__ = 'discussion_participant'
+    __table_args__ = (
+        UniqueConstraint('discussion_id', 'user_id'), )
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey(
+        'agent_profile.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    # Has a role in the discussion or contributed content
+    contributor = Column(Boolean, nullable=False, default=False,
+                         server_default='false')
+    # Has read posts
+    reader = Column(Boolean, nullable=False, default=False,
+                    server_default='false')
+
+
+def participant_added(connection, discussion_id, user_id, reader=False):
+    """Record a participant, from a flush listener.
+
+    The discussion_id may be a scalar subquery.
+    Returns whether this is a new participant (of this kind)."""
+    if discussion_id is None or user_id is None:
+        return False
+    column = 'reader' if reader else 'contributor'
+    table = DiscussionParticipant.__table__
+    statement = insert(table).values(
+        discussion_id=discussion_id, user_id=user_id, **{column: True})
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.discussion_id, table.c.user_id],
+        set_={column: True},
+        where=(table.c[column] == False))  # noqa: E712
+    return connection.execute(statement).rowcount > 0
+
+
+def participant_maybe_removed(target, discussion_id, user_id):
+    """A contribution was removed or changed hands: check at commit time
+    whether its user still takes part in the discussion."""
+    session = object_session(target)
+    if session is not None and discussion_id and user_id:
+        session.info.setdefault('participants_to_check', set()).add(
+            (discussion_id, user_id))
+
+
+def track_participation(cls, *user_attributes, **kwargs):
+    """Maintain :py:class:`DiscussionParticipant` with the users referred
+    to by instances of this class.
+
+    :param on_insert: also record participants on insert (set to False
+        when an existing insert listener calls :py:func:`participant_added`)
+    """
+    def added(mapper, connection, target):
+        for attribute in user_attributes:
+            participant_added(
+                connection, target.discussion_id, getattr(target, attribute))
+
+    def updated(mapper, connection, target):
+        attrs = inspect(target).attrs
+        for attribute in user_attributes:
+            history = attrs[attribute].history
+            for user_id in history.added or ():
+                participant_added(connection, target.discussion_id, user_id)
+            for user_id in history.deleted or ():
+                participant_maybe_removed(
+                    target, target.discussion_id, user_id)
+
+    def removed(mapper, connection, target):
+        for attribute in user_attributes:
+            participant_maybe_removed(
+                target, target.discussion_id, getattr(target, attribute))
+
+    if kwargs.get('on_insert', True):
+        event.listen(cls, 'after_insert', added, propagate=True)
+    event.listen(cls, 'after_update', updated, propagate=True)
+    event.listen(cls, 'after_delete', removed, propagate=True)
+
+
+@event.listens_for(Session, 'before_commit')
+def check_removed_participants(session):
+    if not session.info.get('participants_to_check', None):
+        return
+    session.flush()
+    from .discussion import Discussion
+    for (discussion_id, user_id) in session.info.pop(
+            'participants_to_check', ()):
+        discussion = session.query(Discussion).get(discussion_id)
+        if discussion is not None:
+            discussion.update_participant(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_removed_participants(session):
+    session.info.pop('participants_to_check', None)
+
+
 class User(AgentProfile):
     """
     A user of the platform.
@@ -1230,6 +1339,7 @@ class UserRole(Base, PrivateObjectMixin):
 @event.listens_for(UserRole, 'after_insert', propagate=True)
 @event.listens_for(UserRole, 'after_delete', propagate=True)
 def send_user_to_socket_for_user_role(mapper, connection, target):
+    permissions_changed(target, target.user_id)
     user = target.user
     if not target.user:
         user = User.get(target.user_id)
@@ -1237,6 +1347,11 @@ def send_user_to_socket_for_user_role(mapper, connection, target):
     user.send_to_changes(connection, CrudOperation.UPDATE)
 
 
+@event.listens_for(UserRole, 'after_update', propagate=True)
+def user_role_updated(mapper, connection, target):
+    permissions_changed(target, target.user_id)
+
+
 class LocalUserRole(DiscussionBoundBase, PrivateObjectMixin):
     """The role that a user has in the context of a discussion"""
     __tablename__ = 'local_user_role'
@@ -1352,6 +1467,7 @@ class LocalUserRole(DiscussionBoundBase, PrivateObjectMixin):
 @event.listens_for(LocalUserRole, 'after_insert', propagate=True)
 def send_user_to_socket_for_local_user_role(
         mapper, connection, target):
+    permissions_changed(target, target.user_id, target.discussion_id)
     user = target.user
     if not target.user:
         user = User.get(target.user_id)
@@ -1360,6 +1476,15 @@ def send_user_to_socket_for_local_user_role(
         connection, CrudOperation.UPDATE, target.discussion_id, "private")
 
 
+track_participation(LocalUserRole, 'user_id')
+
+
+@event.listens_for(LocalUserRole, 'after_update', propagate=True)
+def local_user_role_updated(mapper, connection, target):
+    # e.g. a role request being accepted
+    permissions_changed(target, target.user_id, target.discussion_id)
+
+
 class Permission(Base):
     """A permission that a user may have"""
     __tablename__ = 'permission'
@@ -1408,6 +1533,13 @@ class DiscussionPermission(DiscussionBoundBase):
         return (cls.discussion_id == discussion_id, )
 
 
+@event.listens_for(DiscussionPermission, 'after_insert', propagate=True)
+@event.listens_for(DiscussionPermission, 'after_update', propagate=True)
+@event.listens_for(DiscussionPermission, 'after_delete', propagate=True)
+def discussion_permission_changed(mapper, connection, target):
+    permissions_changed(target, discussion_id=target.discussion_id)
+
+
 def create_default_permissions(discussion):
     session = discussion.db
     permissions = {p.name: p for p in session.query(Permission).all()}
@@ -165,6 +165,20 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
         return json.dumps([
             Post.uri_generic(id) for id in self.read_post_ids(user_id)])
 
+    def wake_sources(self):
+        """Ask the sources to look for new content, without waiting.
+        Each source is woken at most every ``sources.min_wake_interval``
+        seconds, however many requests call this."""
+        from ..tasks.source_reader import should_wake
+        for source in self.sources:
+            if not should_wake(source.id):
+                continue
+            try:
+                source.import_content(only_new=True)
+            except Exception:
+                log.error("Could not wake source %d" % (source.id,),
+                          exc_info=True)
+
     def import_from_sources(self, only_new=True):
         for source in self.sources:
             # refresh after calling
@@ -756,8 +770,10 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
             if phase.start <= now <= (phase.end or now):
                 return phase
 
-    def get_participants_query(self, ids_only=False, include_readers=False, current_user=None):
-        from .auth import AgentProfile, LocalUserRole
+    def _participation_queries(self, user_id=None):
+        """Queries of the ids of users who contributed to the discussion,
+        and of users who read its posts, optionally only for one user."""
+        from .auth import LocalUserRole
         from .generic import Content
         from .post import Post
         from .action import ViewPost
@@ -768,34 +784,88 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
         attachment = with_polymorphic(Attachment, [Attachment])
         extract = with_polymorphic(Extract, [Extract])
         db = self.db
+
+        def user_query(column, *conditions):
+            query = db.query(column.label('user_id')).filter(*conditions)
+            if user_id is not None:
+                query = query.filter(column == user_id)
+            return query
+
+        contributions = [
+            user_query(LocalUserRole.user_id,
+                       LocalUserRole.discussion_id == self.id),
+            user_query(post.creator_id, post.discussion_id == self.id),
+            user_query(extract.creator_id, extract.discussion_id == self.id),
+            user_query(extract.owner_id, extract.discussion_id == self.id),
+            user_query(Announcement.creator_id,
+                       Announcement.discussion_id == self.id),
+            user_query(attachment.creator_id,
+                       attachment.discussion_id == self.id),
+        ]
+        readings = user_query(ViewPost.actor_id).join(
+            Content, Content.id == ViewPost.post_id).filter(
+            Content.discussion_id == self.id)
+        return contributions[0].union(*contributions[1:]), readings.distinct()
+
+    def get_participants_query(self, ids_only=False, include_readers=False, current_user=None):
+        from .auth import AgentProfile, DiscussionParticipant
+        db = self.db
+        participants = db.query(
+            DiscussionParticipant.user_id.label('user_id')).filter(
+            DiscussionParticipant.discussion_id == self.id)
+        if not include_readers:
+            participants = participants.filter(
+                DiscussionParticipant.contributor == True)  # noqa: E712
         queries = [
-            db.query(LocalUserRole.user_id.label('user_id')).filter(
-                LocalUserRole.discussion_id == self.id),
-            db.query(post.creator_id.label('user_id')).filter(
-                post.discussion_id == self.id),
-            db.query(extract.creator_id.label('user_id')).filter(
-                extract.discussion_id == self.id),
-            db.query(extract.owner_id.label('user_id')).filter(
-                extract.discussion_id == self.id),
-            db.query(Announcement.creator_id.label('user_id')).filter(
-                Announcement.discussion_id == self.id),
-            db.query(attachment.creator_id.label('user_id')).filter(
-                attachment.discussion_id == self.id),
+            participants,
             db.query(UserRole.user_id.label('user_id')),
         ]
         if self.creator_id is not None:
             queries.append(db.query(literal(self.creator_id).label('user_id')))
         if current_user is not None:
             queries.append(db.query(literal(current_user).label('user_id')))
-        if include_readers:
-            queries.append(db.query(ViewPost.actor_id.label('user_id')).join(
-                Content, Content.id == ViewPost.post_id).filter(
-                Content.discussion_id == self.id))
         query = queries[0].union(*queries[1:]).distinct()
         if ids_only:
             return query
         return db.query(AgentProfile).filter(AgentProfile.id.in_(query))
 
+    def update_participant(self, user_id):
+        """Check whether a user still takes part in the discussion,
+        after one of their contributions was removed."""
+        from .auth import DiscussionParticipant
+        contributions, readings = self._participation_queries(user_id)
+        contributor = contributions.first() is not None
+        reader = readings.first() is not None
+        participant = self.db.query(DiscussionParticipant).filter_by(
+            discussion_id=self.id, user_id=user_id).first()
+        if not (contributor or reader):
+            if participant is not None:
+                self.db.delete(participant)
+            return
+        if participant is None:
+            participant = DiscussionParticipant(
+                discussion_id=self.id, user_id=user_id)
+            self.db.add(participant)
+        participant.contributor = contributor
+        participant.reader = reader
+
+    def rebuild_participants(self):
+        """Recompute all the participants of the discussion
+        from their contributions and readings."""
+        from .auth import DiscussionParticipant
+        contributions, readings = self._participation_queries()
+        contributors = {user_id for (user_id,) in contributions
+                        if user_id is not None}
+        readers = {user_id for (user_id,) in readings if user_id is not None}
+        self.db.query(DiscussionParticipant).filter_by(
+            discussion_id=self.id).delete(synchronize_session=False)
+        self.db.bulk_insert_mappings(DiscussionParticipant, [
+            dict(discussion_id=self.id, user_id=user_id,
+                 contributor=user_id in contributors,
+                 reader=user_id in readers)
+            for user_id in contributors | readers])
+        return len(contributors | readers)
+
     def get_participants(self, ids_only=False):
         query = self.get_participants_query(ids_only)
         if ids_only:
@@ -980,7 +1050,8 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
         """
         from assembl.lib.piwik import (
             piwik_VisitsSummary_getSumVisitsLength,
-            piwik_Actions_get
+            piwik_Actions_get,
+            cached_piwik_call
         )
 
         start, end = self.get_dates_in_discussion_life_bounds(start_date, end_date, force_bounds=True)
@@ -1008,7 +1079,7 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
         period = "range"
         date = ",".join([date_to_piwik_date(start), date_to_piwik_date(end)])
 
-        # For debates with lots of visitors we will probably want to cache piwik responses, using redis for example.
+        # Responses are cached by the process, see assembl.lib.piwik.AnalyticsCache
         if only_fields:
             should_query_visits_length = False
             should_query_actions = False
@@ -1020,14 +1091,14 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
             if should_query_visits_length:
                 sum_visits_length = None
                 try:
-                    sum_visits_length = piwik_VisitsSummary_getSumVisitsLength(piwik_url, piwik_api_token, piwik_id_site, period, date)
+                    sum_visits_length = cached_piwik_call(piwik_VisitsSummary_getSumVisitsLength, piwik_url, piwik_api_token, piwik_id_site, period, date)
                 except:
                     raise ValueError("Analytics server responded with an error")
                 result["sum_visits_length"] = sum_visits_length
             if should_query_actions:
                 actions = None
                 try:
-                    actions = piwik_Actions_get(piwik_url, piwik_api_token, piwik_id_site, period, date)
+                    actions = cached_piwik_call(piwik_Actions_get, piwik_url, piwik_api_token, piwik_id_site, period, date)
                 except:
                     raise ValueError("Analytics server responded with an error")
                 if "nb_uniq_pageviews" not in actions or "nb_pageviews" not in actions:
@@ -1037,12 +1108,12 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
             return result
         else:
             try:
-                sum_visits_length = piwik_VisitsSummary_getSumVisitsLength(piwik_url, piwik_api_token, piwik_id_site, period, date)
+                sum_visits_length = cached_piwik_call(piwik_VisitsSummary_getSumVisitsLength, piwik_url, piwik_api_token, piwik_id_site, period, date)
             except:
                 raise ValueError("Analytics server responded with an error")
 
             try:
-                actions = piwik_Actions_get(piwik_url, piwik_api_token, piwik_id_site, period, date)
+                actions = cached_piwik_call(piwik_Actions_get, piwik_url, piwik_api_token, piwik_id_site, period, date)
             except:
                 raise ValueError("Analytics server responded with an error")
 
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Defining the idea and links between ideas."""
 
+from array import array
 from itertools import chain
 from collections import defaultdict
 from abc import ABCMeta, abstractmethod
@@ -18,14 +19,18 @@ from sqlalchemy import (
     Float,
     DateTime,
     ForeignKey,
+    Index,
     select,
     func,
+    event,
+    inspect,
 )
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.associationproxy import association_proxy
 from pyramid.i18n import TranslationStringFactory
 
 from ..nlp.wordcounter import WordCounter
-from . import DiscussionBoundBase, HistoryMixin
+from . import Base, DiscussionBoundBase, HistoryMixin
 from .discussion import Discussion
 from .langstrings import LangString
 from ..auth import (
@@ -53,7 +58,8 @@ class IdeaVisitor(object):
 
     The visit is started by :py:meth:`Idea.visit_ideas_depth_first`,
     :py:meth:`Idea.visit_ideas_breadth_first` or
-    :py:meth:`Idea.visit_idea_ids_depth_first`
+    :py:meth:`Idea.visit_idea_ids_depth_first`, and run by
+    :py:class:`IdeaTree`
 
     .. _Visitor: https://sourcemaking.com/design_patterns/visitor
     """
@@ -89,6 +95,182 @@ class AppendingVisitor(IdeaVisitor):
         return self.ideas
 
 
+class IdeaTree(object):
+    """A compact, array-based idea tree, for iterative visits by id.
+
+    Nodes are numbered in depth-first order from the root, so the
+    descendants of node ``i`` are the nodes ``i + 1`` to
+    ``subtree_ends[i] - 1``. For each node we keep the idea id, the
+    parent node (-1 for the root) and the level; the children of node
+    ``i`` are ``children[child_offsets[i]:child_offsets[i + 1]]``, in
+    link order.
+
+    :param children_dict: child ids by parent id, as given by
+        :py:meth:`Idea.children_dict`
+    :param root_id: the root of the tree, by default the root of
+        the ``children_dict``
+
+    An idea reachable through many parents is placed under the first
+    one in depth-first order, as in the recursive visits.
+    """
+
+    def __init__(self, children_dict, root_id=None):
+        if root_id is None:
+            root_id = children_dict[None][0]
+        self.ids = array('l')
+        self.parents = array('l')
+        self.levels = array('l')
+        self.index_of = {}
+        stack = [(root_id, -1, 0)]
+        while stack:
+            idea_id, parent, level = stack.pop()
+            if idea_id in self.index_of:
+                continue
+            index = len(self.ids)
+            self.index_of[idea_id] = index
+            self.ids.append(idea_id)
+            self.parents.append(parent)
+            self.levels.append(level)
+            stack.extend(
+                (child_id, index, level + 1)
+                for child_id in reversed(children_dict.get(idea_id, ()))
+                if child_id not in self.index_of)
+        size = len(self.ids)
+        # Children grouped by parent; node order keeps the link order.
+        self.child_offsets = array('l', [0]) * (size + 1)
+        for parent in self.parents[1:]:
+            self.child_offsets[parent + 1] += 1
+        for index in xrange(size):
+            self.child_offsets[index + 1] += self.child_offsets[index]
+        self.children = array('l', [0]) * (size - 1)
+        next_positions = self.child_offsets[:-1]
+        for index in xrange(1, size):
+            parent = self.parents[index]
+            self.children[next_positions[parent]] = index
+            next_positions[parent] += 1
+        self.subtree_ends = array('l', xrange(1, size + 1))
+        for index in xrange(size - 1, 0, -1):
+            parent = self.parents[index]
+            if self.subtree_ends[index] > self.subtree_ends[parent]:
+                self.subtree_ends[parent] = self.subtree_ends[index]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def descendant_ids(self, idea_id, inclusive=True):
+        index = self.index_of[idea_id]
+        start = index if inclusive else index + 1
+        return self.ids[start:self.subtree_ends[index]].tolist()
+
+    def visit_depth_first(self, idea_visitor, get_node=None, root_index=0):
+        """Visit the subtree of a node with an explicit stack.
+
+        Same protocol as the recursive visits: ``visit_idea`` is called
+        on the way down and ``end_visit`` on the way up, with the truthy
+        results of the children's ``end_visit``.
+
+        :param get_node: gives what the visitor receives for a node
+            index; the idea id by default
+        :returns: the result of ``end_visit`` on the root"""
+        get_node = get_node or self.ids.__getitem__
+        cut = IdeaVisitor.CUT_VISIT
+        offsets = self.child_offsets
+        children = self.children
+        levels = self.levels
+        base_level = levels[root_index]
+
+        def enter(index, prev_result):
+            result = idea_visitor.visit_idea(
+                get_node(index), levels[index] - base_level, prev_result)
+            position = offsets[index + 1] if result is cut else offsets[index]
+            # node index, visit result, child results, next child position
+            return [index, result, [], position]
+
+        stack = [enter(root_index, None)]
+        while True:
+            frame = stack[-1]
+            index, result, child_results, position = frame
+            if position < offsets[index + 1]:
+                frame[3] = position + 1
+                stack.append(enter(children[position], result))
+                continue
+            stack.pop()
+            node = get_node(index)
+            end_result = idea_visitor.end_visit(
+                node, levels[index] - base_level, result, child_results)
+            if not stack:
+                return end_result
+            if end_result:
+                stack[-1][2].append((node, end_result))
+
+    def visit_breadth_first(self, idea_visitor, get_node=None, root_index=0):
+        """Visit the subtree of a node, visiting all the children of a node
+        before going down into each of them.
+
+        ``end_visit`` receives the level of the children, the result of
+        the node's visit and the truthy visit results of the children."""
+        get_node = get_node or self.ids.__getitem__
+        cut = IdeaVisitor.CUT_VISIT
+        offsets = self.child_offsets
+        children = self.children
+        result = idea_visitor.visit_idea(get_node(root_index), 0, None)
+        if result is cut:
+            return None
+
+        def expand(index, level, prev_result):
+            child_results = []
+            to_expand = []
+            for position in xrange(offsets[index], offsets[index + 1]):
+                child = children[position]
+                node = get_node(child)
+                result = idea_visitor.visit_idea(node, level, prev_result)
+                if result is not cut:
+                    to_expand.append((child, result))
+                    if result:
+                        child_results.append((node, result))
+            # node index, level, result, child results, children to expand
+            return [index, level, prev_result, child_results, to_expand, 0]
+
+        stack = [expand(root_index, 1, result)]
+        while True:
+            frame = stack[-1]
+            index, level, prev_result, child_results, to_expand, position = frame
+            if position < len(to_expand):
+                frame[5] = position + 1
+                (child, result) = to_expand[position]
+                stack.append(expand(child, level + 1, result))
+                continue
+            stack.pop()
+            end_result = idea_visitor.end_visit(
+                get_node(index), level, prev_result, child_results)
+            if not stack:
+                return end_result
+
+
+class IdeaBatchLoader(object):
+    """Gives the :py:class:`Idea` of :py:class:`IdeaTree` nodes, fetching
+    consecutive nodes in batches. As nodes are numbered in depth-first
+    order, a depth-first visit makes one query per batch."""
+
+    def __init__(self, tree, db, batch_size=500, ideas=()):
+        self.tree = tree
+        self.db = db
+        self.batch_size = batch_size
+        self.ideas = {idea.id: idea for idea in ideas}
+
+    def __call__(self, index):
+        idea_id = self.tree.ids[index]
+        idea = self.ideas.get(idea_id, None)
+        if idea is None:
+            batch_ids = [
+                id for id in self.tree.ids[index:index + self.batch_size]
+                if id not in self.ideas]
+            for idea in self.db.query(Idea).filter(Idea.id.in_(batch_ids)):
+                self.ideas[idea.id] = idea
+            idea = self.ideas[idea_id]
+        return idea
+
+
 class WordCountVisitor(IdeaVisitor):
     """A Visitor that counts words related to an idea"""
 
@@ -107,23 +289,8 @@ class WordCountVisitor(IdeaVisitor):
         if idea.definition:
             self.counter.add_text(self.cleantext(idea.definition))
         if self.count_posts and level == 0:
-            from .generic import Content
-            query = idea.db.query(Content)
-            related = idea.get_related_posts_query(True)
-            query = query.join(related, Content.id == related.c.post_id
-                ).filter(Content.hidden == False,  # noqa: E712
-                         Content.tombstone_condition()).options(
-                    Content.subqueryload_options())
-            titles = set()
-            # TODO maparent: Group langstrings by language.
-            for content in query:
-                body = content.body.first_original().value
-                self.counter.add_text(self.cleantext(body), 0.5)
-                title = content.subject.first_original().value
-                title = self.cleantext(title)
-                if title not in titles:
-                    self.counter.add_text(title)
-                    titles.add(title)
+            from .keywords import PostTermFrequency
+            PostTermFrequency.add_related_terms(self.counter, idea)
 
     def best(self, num=8):
         return self.counter.best(num)
@@ -316,6 +483,24 @@ class Idea(HistoryMixin, DiscussionBoundBase):
     def get_ancestors_query_cls(
             cls, target_id=bindparam('root_id', type_=Integer),
             inclusive=True, tombstone_date=None):
+        if tombstone_date is not None:
+            # The closure only follows live links
+            return cls._get_ancestors_cte(target_id, inclusive, tombstone_date)
+        closure = IdeaClosure.__table__
+        if isinstance(target_id, list):
+            condition = closure.c.descendant_id.in_(target_id)
+        else:
+            condition = (closure.c.descendant_id == target_id)
+        if not inclusive:
+            condition = condition & (closure.c.depth > 0)
+        select_exp = select([closure.c.ancestor_id.label('id')]).where(
+            condition)
+        if isinstance(target_id, list):
+            select_exp = select_exp.distinct()
+        return select_exp.alias('ancestors')
+
+    @classmethod
+    def _get_ancestors_cte(cls, target_id, inclusive, tombstone_date):
         if isinstance(target_id, list):
             root_condition = IdeaLink.target_id.in_(target_id)
         else:
@@ -369,41 +554,25 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         from .announcement import IdeaAnnouncement
         if self.announcement:
             return self.announcement
-        aq = self.get_ancestors_query()
-        announcements = self.db.query(IdeaAnnouncement
-            ).filter(IdeaAnnouncement.idea_id.in_(aq),
+        # The announcement of the closest ancestor
+        return self.db.query(IdeaAnnouncement).join(
+            IdeaClosure,
+            IdeaClosure.ancestor_id == IdeaAnnouncement.idea_id
+            ).filter(IdeaClosure.descendant_id == self.id,
+                     IdeaClosure.depth > 0,
                      IdeaAnnouncement.should_propagate_down == True  # noqa: E712
-            ).all()
-        # assume order is preserved from aq...
-        if announcements:
-            return announcements[-1]
+            ).order_by(IdeaClosure.depth).first()
 
     @classmethod
     def get_descendants_query_cls(
             cls, root_idea_id=bindparam('root_idea_id', type_=Integer),
             inclusive=True):
-        link = select(
-            [IdeaLink.source_id, IdeaLink.target_id]
-            ).select_from(
-                IdeaLink
-            ).where(
-                (IdeaLink.tombstone_date == None) & (IdeaLink.source_id == root_idea_id)  # noqa: E711
-            ).cte(recursive=True)
-        source_alias = aliased(link)
-        targets_alias = aliased(IdeaLink)
-        parent_link = targets_alias.source_id == source_alias.c.target_id
-        children = select(
-            [targets_alias.source_id, targets_alias.target_id]
-            ).select_from(targets_alias).where(parent_link & (targets_alias.tombstone_date == None))  # noqa: E711
-        with_children = link.union(children)
-        select_exp = select([with_children.c.target_id.label('id')]
-            ).select_from(with_children)
-        if inclusive:
-            if isinstance(root_idea_id, int):
-                root_idea_id = literal_column(str(root_idea_id), Integer)
-            select_exp = select_exp.union(
-                select([root_idea_id.label('id')]))
-        return select_exp.alias('descendants')
+        closure = IdeaClosure.__table__
+        condition = (closure.c.ancestor_id == root_idea_id)
+        if not inclusive:
+            condition = condition & (closure.c.depth > 0)
+        return select([closure.c.descendant_id.label('id')]).where(
+            condition).alias('descendants')
 
     def get_descendants_query(
             self, inclusive=True, subquery=True):
@@ -510,36 +679,14 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         counters = self.prepare_counters(self.discussion_id)
         return counters.get_counts(self.id)
 
-    def prefetch_descendants(self):
-        # TODO maparent: descendants only. Let's just prefetch all ideas.
-        ideas = self.db.query(Idea).filter_by(
-            discussion_id=self.discussion_id, tombstone_date=None).all()
-        ideas_by_id = {idea.id: idea for idea in ideas}
-        children_id_dict = self.children_dict(self.discussion_id)
-        return {
-            id: [ideas_by_id[child_id] for child_id in child_ids]
-            for (id, child_ids) in children_id_dict.iteritems()
-        }
+    def get_tree(self):
+        "The :py:class:`IdeaTree` of this idea's descendants"
+        return IdeaTree(self.children_dict(self.discussion_id), self.id)
 
     def visit_ideas_depth_first(self, idea_visitor):
-        children_dict = self.prefetch_descendants()
-        return self._visit_ideas_depth_first(idea_visitor, set(), 0, None, children_dict)
-
-    def _visit_ideas_depth_first(
-            self, idea_visitor, visited, level, prev_result, children_dict):
-        if self in visited:
-            # not necessary in a tree, but let's start to think graph.
-            return False
-        result = idea_visitor.visit_idea(self, level, prev_result)
-        visited.add(self)
-        child_results = []
-        if result is not IdeaVisitor.CUT_VISIT:
-            for child in children_dict.get(self.id, ()):
-                r = child._visit_ideas_depth_first(
-                    idea_visitor, visited, level + 1, result, children_dict)
-                if r:
-                    child_results.append((child, r))
-        return idea_visitor.end_visit(self, level, result, child_results)
+        tree = self.get_tree()
+        return tree.visit_depth_first(
+            idea_visitor, IdeaBatchLoader(tree, self.db, ideas=(self,)))
 
     @classmethod
     def children_dict(cls, discussion_id):
@@ -577,63 +724,25 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         # Lightweight descent
         if children_dict is None:
             children_dict = cls.children_dict(discussion_id)
-        root_id = children_dict[None][0]
-        return cls._visit_idea_ids_depth_first(
-            root_id, idea_visitor, children_dict, set(), 0, None)
-
-    @classmethod
-    def _visit_idea_ids_depth_first(
-            cls, idea_id, idea_visitor, children_dict, visited,
-            level, prev_result):
-        if idea_id in visited:
-            # not necessary in a tree, but let's start to think graph.
-            return False
-        result = idea_visitor.visit_idea(idea_id, level, prev_result)
-        visited.add(idea_id)
-        child_results = []
-        if result is not IdeaVisitor.CUT_VISIT:
-            for child_id in children_dict[idea_id]:
-                r = cls._visit_idea_ids_depth_first(
-                    child_id, idea_visitor, children_dict, visited, level + 1, result)
-                if r:
-                    child_results.append((child_id, r))
-        return idea_visitor.end_visit(idea_id, level, result, child_results)
+        return IdeaTree(children_dict).visit_depth_first(idea_visitor)
 
     def visit_ideas_breadth_first(self, idea_visitor):
-        self.prefetch_descendants()
-        result = idea_visitor.visit_idea(self, 0, None)
-        visited = {self}
-        if result is not IdeaVisitor.CUT_VISIT:
-            return self._visit_ideas_breadth_first(
-                idea_visitor, visited, 1, result)
-
-    def _visit_ideas_breadth_first(
-            self, idea_visitor, visited, level, prev_result):
-        children = []
-        result = True
-        child_results = []
-        for child in self.get_children():
-            if child in visited:
-                continue
-            result = idea_visitor.visit_idea(child, level, prev_result)
-            visited.add(child)
-            if result != IdeaVisitor.CUT_VISIT:
-                children.append(child)
-                if result:
-                    child_results.append((child, result))
-        for child in children:
-            child._visit_ideas_breadth_first(
-                idea_visitor, visited, level + 1, result)
-        return idea_visitor.end_visit(self, level, prev_result, child_results)
+        tree = self.get_tree()
+        return tree.visit_breadth_first(
+            idea_visitor, IdeaBatchLoader(tree, self.db, ideas=(self,)))
 
     def most_common_words(self, lang=None, num=8):
         if lang:
             langs = (lang,)
         else:
             langs = self.discussion.discussion_locales
-        word_counter = WordCountVisitor(langs)
-        self.visit_ideas_depth_first(word_counter)
-        return word_counter.best(num)
+        keywords = self.get_discussion_data(self.discussion_id).keywords
+        key = (self.id, tuple(langs), num)
+        if key not in keywords:
+            word_counter = WordCountVisitor(langs)
+            self.visit_ideas_depth_first(word_counter)
+            keywords[key] = word_counter.best(num)
+        return list(keywords[key])
 
     @property
     def most_common_words_prop(self):
@@ -1284,6 +1393,128 @@ class IdeaLink(HistoryMixin, DiscussionBoundBase):
     )
 
 
+class IdeaClosure(Base):
+    """The transitive closure of live :py:class:`IdeaLink` s.
+
+    There is a row for each idea and each of its ancestors (or itself,
+    at depth 0), with the length of the shortest path between them.
+    It is maintained by flush listeners, so ancestors and descendants
+    are found without recursive queries; tombstoned links are ignored.
+    ``assembl-rebuild-idea-closure`` checks and rebuilds it."""
+    __tablename__ = 'idea_closure'
+    __table_args__ = (
+        Index('ix_idea_closure_descendant', 'descendant_id', 'depth'), )
+
+    ancestor_id = Column(Integer, ForeignKey(
+        'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    descendant_id = Column(Integer, ForeignKey(
+        'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    depth = Column(Integer, nullable=False)
+
+    # First key of the advisory locks of the closure, the second is the
+    # discussion id
+    lock_namespace = 7658
+
+    @classmethod
+    def lock(cls, connection, discussion_id):
+        """Serialize the changes to the closure of a discussion until the
+        end of the transaction, so each one sees the rows written by the
+        others (in read committed isolation.)"""
+        connection.execute(select([func.pg_advisory_xact_lock(
+            cls.lock_namespace, discussion_id)]))
+
+    @classmethod
+    def idea_added(cls, connection, idea_id):
+        table = cls.__table__
+        connection.execute(insert(table).values(
+            ancestor_id=idea_id, descendant_id=idea_id, depth=0
+            ).on_conflict_do_nothing())
+
+    @classmethod
+    def link_added(cls, connection, source_id, target_id):
+        """Connect the ancestors of the source to the descendants
+        of the target, keeping the shortest depth."""
+        table = cls.__table__
+        ancestors = table.alias('ancestors')
+        descendants = table.alias('descendants')
+        paths = select([
+            ancestors.c.ancestor_id, descendants.c.descendant_id,
+            (ancestors.c.depth + descendants.c.depth + 1)]
+            ).where((ancestors.c.descendant_id == source_id) &
+                    (descendants.c.ancestor_id == target_id))
+        statement = insert(table).from_select(
+            ['ancestor_id', 'descendant_id', 'depth'], paths)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.ancestor_id, table.c.descendant_id],
+            set_={'depth': func.least(table.c.depth,
+                                      statement.excluded.depth)})
+        connection.execute(statement)
+
+    @classmethod
+    def subtree_detached(cls, connection, target_id):
+        """A link to target was removed or changed: forget the ancestors
+        of its subtree, then reconnect it through the live links."""
+        table = cls.__table__
+        link = IdeaLink.__table__
+        subtree = select([table.c.descendant_id]).where(
+            table.c.ancestor_id == target_id)
+        connection.execute(table.delete().where(
+            table.c.descendant_id.in_(subtree) &
+            ~table.c.ancestor_id.in_(subtree)))
+        entering = connection.execute(
+            select([link.c.source_id, link.c.target_id]).where(
+                (link.c.tombstone_date == None) &  # noqa: E711
+                link.c.target_id.in_(subtree) &
+                ~link.c.source_id.in_(subtree))).fetchall()
+        for (source_id, link_target_id) in entering:
+            cls.link_added(connection, source_id, link_target_id)
+
+    @classmethod
+    def expected_rows(cls, connection):
+        """Compute the closure from the idea links, as a dictionary
+        of depths by (ancestor_id, descendant_id)"""
+        link = IdeaLink.__table__
+        children = defaultdictlist()
+        for (source_id, target_id) in connection.execute(
+                select([link.c.source_id, link.c.target_id]).where(
+                    link.c.tombstone_date == None)):  # noqa: E711
+            children[source_id].append(target_id)
+        rows = {}
+        for (idea_id,) in connection.execute(select([Idea.__table__.c.id])):
+            seen = {idea_id}
+            level = [idea_id]
+            depth = 0
+            while level:
+                for descendant_id in level:
+                    rows[(idea_id, descendant_id)] = depth
+                next_level = []
+                for descendant_id in level:
+                    for child_id in children.get(descendant_id, ()):
+                        if child_id not in seen:
+                            seen.add(child_id)
+                            next_level.append(child_id)
+                level = next_level
+                depth += 1
+        return rows
+
+    @classmethod
+    def rebuild(cls, connection, rows=None, chunk_size=5000):
+        "Replace the content of the closure table"
+        table = cls.__table__
+        if rows is None:
+            rows = cls.expected_rows(connection)
+        connection.execute(table.delete())
+        values = [
+            dict(ancestor_id=ancestor_id, descendant_id=descendant_id,
+                 depth=depth)
+            for ((ancestor_id, descendant_id), depth) in rows.iteritems()]
+        for start in range(0, len(values), chunk_size):
+            connection.execute(
+                table.insert(), values[start:start + chunk_size])
+
+
 _it = Idea.__table__
 _ilt = IdeaLink.__table__
 Idea.num_children = column_property(
@@ -1291,3 +1522,36 @@ Idea.num_children = column_property(
         (_ilt.c.source_id == _it.c.id) & (_ilt.c.tombstone_date == None) & (_it.c.tombstone_date == None)  # noqa: E711
         ).correlate_except(_ilt),
     deferred=True)
+
+
+@event.listens_for(Idea, 'after_insert', propagate=True)
+def idea_closure_idea_added(mapper, connection, target):
+    IdeaClosure.idea_added(connection, target.id)
+
+
+@event.listens_for(IdeaLink, 'after_insert', propagate=True)
+def idea_closure_link_added(mapper, connection, target):
+    if target.tombstone_date is None:
+        IdeaClosure.lock(connection, target.get_discussion_id())
+        IdeaClosure.link_added(connection, target.source_id, target.target_id)
+
+
+@event.listens_for(IdeaLink, 'after_update', propagate=True)
+def idea_closure_link_updated(mapper, connection, target):
+    attrs = inspect(target).attrs
+    if not any(attrs[name].history.has_changes() for name in (
+            'source_id', 'target_id', 'tombstone_date')):
+        return
+    IdeaClosure.lock(connection, target.get_discussion_id())
+    # Reconnecting the subtrees from the live links covers all cases
+    target_ids = set(attrs.target_id.history.deleted)
+    target_ids.add(target.target_id)
+    for target_id in target_ids:
+        IdeaClosure.subtree_detached(connection, target_id)
+
+
+@event.listens_for(IdeaLink, 'after_delete', propagate=True)
+def idea_closure_link_deleted(mapper, connection, target):
+    if target.tombstone_date is None:
+        IdeaClosure.lock(connection, target.get_discussion_id())
+        IdeaClosure.subtree_detached(connection, target.target_id)
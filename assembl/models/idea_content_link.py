@@ -25,6 +25,7 @@ from .discussion import Discussion
 from .idea import Idea
 from .generic import Content
 from .post import Post
+from .auth import track_participation
 from .vocabulary import AbstractEnumVocabulary
 from ..auth import (
     CrudPermissions, P_READ, P_EDIT_IDEA,
@@ -444,6 +445,9 @@ class Extract(IdeaContentPositiveLink):
         P_ADD_EXTRACT, P_READ, P_EDIT_EXTRACT, P_EDIT_EXTRACT, P_EDIT_MY_EXTRACT, P_EDIT_MY_EXTRACT)
 
 
+track_participation(Extract, 'creator_id', 'owner_id')
+
+
 class IdeaContentNegativeLink(IdeaContentLink):
     """
     A negative link between an idea and a Content.  Such links mean that
@@ -0,0 +1,117 @@
+"""Stemmed term frequencies of posts, to find the keywords of ideas.
+
+The term vector of each post is computed the first time it is needed,
+and stored for each set of languages (which give the stemmer and stop
+words) until the post is edited. The most common words of an idea sum
+the vectors of its related posts, and are cached with the discussion
+structure, see
+:py:meth:`assembl.models.path_utils.DiscussionGlobalData.keywords`."""
+from sqlalchemy import Column, Integer, String, ForeignKey, event, inspect
+from sqlalchemy.dialects.postgresql import insert
+
+from ..lib.clean_input import sanitize_text
+from ..lib.sqla import mark_changed
+from ..lib.sqla_types import JSONType
+from ..nlp.wordcounter import WordCounter
+from . import Base
+from .generic import Content
+from .post import Post
+
+
+def _original_text(langstring):
+    entry = langstring.first_original() if langstring else None
+    return sanitize_text(entry.value) if entry and entry.value else u''
+
+
+class PostTermFrequency(Base):
+    """The stemmed term vector of the original subject and body of a post.
+
+    Vectors are JSON dicts of stem -> [weight, shortest word], see
+    :py:meth:`assembl.nlp.wordcounter.WordCounter.as_vector`."""
+    __tablename__ = 'post_term_frequency'
+
+    post_id = Column(Integer, ForeignKey(
+        'content.id', ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    # The languages of the WordCounter, in order
+    langs = Column(String(100), primary_key=True)
+    # {"body": vector, "title": cleaned subject, "title_terms": vector}
+    terms = Column(JSONType, nullable=False)
+
+    body_weight = 0.5
+
+    @staticmethod
+    def langs_key(counter):
+        return ','.join(counter.langs)
+
+    @classmethod
+    def compute_terms(cls, content, langs):
+        body = WordCounter(langs)
+        body.add_text(_original_text(content.body), cls.body_weight)
+        title = _original_text(content.subject)
+        title_terms = WordCounter(langs)
+        title_terms.add_text(title)
+        return dict(body=body.as_vector(), title=title,
+                    title_terms=title_terms.as_vector())
+
+    @classmethod
+    def store_terms(cls, db, post_ids, langs, chunk_size=500):
+        """Compute and store the term vectors of posts.
+        Returns them by post id."""
+        table = cls.__table__
+        key = cls.langs_key(WordCounter(langs))
+        terms = {}
+        for start in range(0, len(post_ids), chunk_size):
+            values = []
+            for content in db.query(Content).filter(
+                    Content.id.in_(post_ids[start:start + chunk_size])
+                    ).options(*Content.subqueryload_options()):
+                terms[content.id] = cls.compute_terms(content, langs)
+                values.append(dict(post_id=content.id, langs=key,
+                                   terms=terms[content.id]))
+            if values:
+                statement = insert(table).values(values)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[table.c.post_id, table.c.langs],
+                    set_={'terms': statement.excluded.terms})
+                db.execute(statement)
+                mark_changed(db)
+        return terms
+
+    @classmethod
+    def add_related_terms(cls, counter, idea):
+        """Add the term vectors of the posts related to an idea to a
+        WordCounter. Identical subjects are only counted once."""
+        db = idea.db
+        related = idea.get_related_posts_query(True)
+        key = cls.langs_key(counter)
+        vectors = db.query(Content.id, cls.terms).join(
+            related, Content.id == related.c.post_id
+            ).outerjoin(cls, (cls.post_id == Content.id) & (cls.langs == key)
+            ).filter(Content.hidden == False,  # noqa: E712
+                     Content.tombstone_condition())
+        terms = {}
+        missing = []
+        for (post_id, post_terms) in vectors:
+            if post_terms is None:
+                missing.append(post_id)
+            else:
+                terms[post_id] = post_terms
+        if missing:
+            terms.update(cls.store_terms(db, missing, counter.langs))
+        titles = set()
+        for post_terms in terms.itervalues():
+            counter.add_vector(post_terms['body'])
+            if post_terms['title'] not in titles:
+                counter.add_vector(post_terms['title_terms'])
+                titles.add(post_terms['title'])
+
+
+@event.listens_for(Post, 'after_update', propagate=True)
+def post_terms_updated(mapper, connection, target):
+    # Edits set the modification date. The terms of new and edited posts
+    # are computed when the keywords of their ideas are, outside of the
+    # transaction which changes them.
+    if inspect(target).attrs.modification_date.history.has_changes():
+        table = PostTermFrequency.__table__
+        connection.execute(table.delete().where(table.c.post_id == target.id))
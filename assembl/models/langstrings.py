@@ -1,6 +1,7 @@
 """Classes for multilingual strings, using automatic or manual translation"""
 from collections import defaultdict
 from datetime import datetime
+from threading import Lock
 
 from sqlalchemy import (
     Column,
@@ -16,8 +17,10 @@ from sqlalchemy import (
     Sequence,
     literal)
 from sqlalchemy.sql.expression import case
-from sqlalchemy.orm import relationship, backref, subqueryload, joinedload, aliased
+from sqlalchemy.orm import (
+    relationship, backref, subqueryload, joinedload, aliased, object_session)
 from sqlalchemy.orm.query import Query
+from sqlalchemy.orm.session import Session
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from ..lib.sqla_types import CoerceUnicode
 import simplejson as json
@@ -36,10 +39,6 @@ class Locale(Base):
     id = Column(Integer, primary_key=True)
     code = Column(String(32), unique=True)
     rtl = Column(Boolean, server_default="0", doc="right-to-left")
-    _locale_collection = None
-    _locale_collection_byid = None
-    _locale_collection_subsets = None
-    _locale_uncommitted = []
     UNDEFINED = "und"
     NON_LINGUISTIC = "zxx"
     MULTILINGUAL = "mul"
@@ -113,6 +112,13 @@ class Locale(Base):
         """Are the two locales similar enough to be substituted
         one for the other. Mostly same language/script, disregard country.
         """
+        registry = _locale_registry
+        if registry is not None:
+            return registry.compatible(locname1, locname2)
+        return cls.compute_compatibility(locname1, locname2)
+
+    @staticmethod
+    def compute_compatibility(locname1, locname2):
         # Google special case... should be done upstream ideally.
         if locname1 == 'zh':
             locname1 = 'zh_Hans'
@@ -177,102 +183,74 @@ class Locale(Base):
 
     @classmethod
     def reset_cache(cls):
-        cls._locale_collection_byid = None
-        cls._locale_collection = None
-        cls._locale_collection_subsets = None
-
-    @classmethod
-    def get_locale_object_cache(cls):
-        """Maintain a per-thread cache of locale objects by name"""
-        from pyramid.threadlocal import get_current_request
-        req = get_current_request()
-        if not req:
-            return {}
-        if getattr(req, "locale_object_cache", None) is None:
-            req.locale_object_cache = {}
-        return req.locale_object_cache
+        reset_locale_registry()
 
     @classproperty
     def locale_collection_byid(cls):
         "A collection of all known locales, as a dictionary of id->strings"
-        if cls._locale_collection_byid is None:
-            cls._locale_collection_byid = dict(
-                cls.default_db.query(cls.id, cls.code))
-            # Add locales that were created, flushed but not yet committed,
-            # And will not show up in the query
-            uncommitted = [
-                l for l in cls._locale_uncommitted
-                if inspect(l).pending]
-            cls._locale_uncommitted = uncommitted
-            if uncommitted:
-                cls._locale_collection_byid.update(
-                    {l.id: l.code for l in uncommitted})
-        return cls._locale_collection_byid
+        return get_locale_registry().code_by_id
 
     @classmethod
     def code_for_id(cls, id):
-        if cls._locale_collection_byid is not None and id not in cls._locale_collection_byid:
+        code = get_locale_registry().code_by_id.get(id, None)
+        if code is None:
             # may have been created in another process
-            cls.reset_cache()
-        return cls.locale_collection_byid[id]
+            code = reload_locale_registry().code_by_id[id]
+        return code
+
+    @classmethod
+    def base_code_for_id(cls, id):
+        "The code of a locale, without machine translation information"
+        registry = get_locale_registry()
+        if id not in registry.code_by_id:
+            registry = reload_locale_registry()
+        return registry.base_code_by_id[id]
+
+    @classmethod
+    def id_is_machine_translated(cls, id):
+        registry = get_locale_registry()
+        if id not in registry.code_by_id:
+            registry = reload_locale_registry()
+        return id in registry.machine_translated_ids
 
     @classproperty
     def locale_collection(cls):
         "A collection of all known locales, as a dictionary of string->id"
-        if cls._locale_collection is None:
-            cls._locale_collection = {
-                name: id for (id, name)
-                in cls.locale_collection_byid.iteritems()}
-        return cls._locale_collection
+        return get_locale_registry().id_by_code
 
     @classmethod
     def get_id_of(cls, code, create=True):
-        if cls._locale_collection is not None and code not in cls._locale_collection:
+        locale_id = get_locale_registry().id_by_code.get(code, None)
+        if locale_id is None:
             # may have been created in another process
             if create:
                 return cls.get_or_create(code).id
-            else:
-                cls.reset_cache()
-        return cls.locale_collection.get(code, None)
+            locale_id = reload_locale_registry().id_by_code.get(code, None)
+        return locale_id
 
     @classproperty
     def locale_collection_subsets(cls):
         "A dictionary giving all the know locale variants for a base locale"
-        if cls._locale_collection_subsets is None:
-            # This is used often enough to be worth caching
-            collections = cls.locale_collection
-            collection_subsets = defaultdict(set)
-            for locale_code in collections.iterkeys():
-                collection_subsets[cls.extract_root_locale(locale_code)].add(locale_code)
-            cls._locale_collection_subsets = collection_subsets
-        return cls._locale_collection_subsets
+        return get_locale_registry().subsets
 
     @classmethod
     def get_or_create(cls, locale_code, db=None):
-        locale_object_cache = cls.get_locale_object_cache()
-        locale = locale_object_cache.get(locale_code, None)
-        if locale:
-            return locale
-        locale_id = cls.locale_collection.get(locale_code, None)
+        db = db or cls.default_db
+        locale_id = get_locale_registry().id_by_code.get(locale_code, None)
         if locale_id:
-            locale = Locale.get(locale_id)
+            # From the identity map if already loaded
+            locale = db.query(cls).get(locale_id)
             if locale:
-                locale_object_cache[locale_code] = locale
                 return locale
-        db = db or cls.default_db
-        # Maybe exists despite not in cache
+        # Maybe exists despite not in registry
         locale = db.query(cls).filter_by(code=locale_code).first()
         if locale:
-            cls.reset_cache()
-            locale_object_cache[locale_code] = locale
+            reload_locale_registry()
             return locale
-        # create it.
+        # create it; the registry is updated on insert.
         locale = Locale(code=locale_code)
         db.add(locale)
         db.flush()
-        cls._locale_uncommitted.append(locale)
-        cls.reset_cache()
-        locale_object_cache[locale_code] = locale
         return locale
 
     @classproperty
@@ -293,13 +271,120 @@ class Locale(Base):
             cls.get_or_create(loc_code, db=db)
 
 
+class LocaleRegistry(object):
+    """An immutable snapshot of the known locales, shared by the process.
+
+    Locale codes are decomposed once, when the registry is built, so
+    langstring resolution can work on locale ids without parsing codes.
+    Adding or removing locales builds a new registry with a higher
+    version, which replaces the current one atomically; readers keep
+    using a consistent snapshot. Compatibility scores of pairs of codes
+    are computed once and memoized."""
+
+    max_compatibility_entries = 10000
+
+    def __init__(self, code_by_id, version=0):
+        self.version = version
+        self.code_by_id = dict(code_by_id)
+        self.id_by_code = {
+            code: id for (id, code) in self.code_by_id.iteritems()}
+        self.base_code_by_id = {}
+        self.root_code_by_id = {}
+        machine_translated_ids = set()
+        subsets = defaultdict(set)
+        for (id, code) in self.code_by_id.iteritems():
+            base_code = Locale.extract_base_locale(code)
+            root_code = base_code.split('_')[0]
+            self.base_code_by_id[id] = base_code
+            self.root_code_by_id[id] = root_code
+            if base_code != code:
+                machine_translated_ids.add(id)
+            subsets[root_code].add(code)
+        self.machine_translated_ids = frozenset(machine_translated_ids)
+        self.subsets = {
+            root_code: frozenset(codes)
+            for (root_code, codes) in subsets.iteritems()}
+        self.compatibility = {}
+
+    def compatible(self, code1, code2):
+        key = (code1, code2)
+        score = self.compatibility.get(key, None)
+        if score is None:
+            if len(self.compatibility) > self.max_compatibility_entries:
+                self.compatibility = {}
+            score = Locale.compute_compatibility(code1, code2)
+            self.compatibility[key] = score
+        return score
+
+    def updated(self, added=None, removed_ids=()):
+        "A new registry, with some locales added or removed"
+        code_by_id = dict(self.code_by_id)
+        code_by_id.update(added or {})
+        for id in removed_ids:
+            code_by_id.pop(id, None)
+        return LocaleRegistry(code_by_id, self.version + 1)
+
+
+_locale_registry = None
+_locale_registry_lock = Lock()
+
+
+def get_locale_registry():
+    "The process-wide :py:class:`LocaleRegistry`"
+    registry = _locale_registry
+    if registry is None:
+        registry = reload_locale_registry()
+    return registry
+
+
+def reload_locale_registry():
+    """Rebuild the registry from the database, eg when a locale
+    was created by another process"""
+    global _locale_registry
+    with _locale_registry_lock:
+        version = _locale_registry.version if _locale_registry else 0
+        _locale_registry = LocaleRegistry(
+            Locale.default_db.query(Locale.id, Locale.code), version + 1)
+        return _locale_registry
+
+
+def reset_locale_registry():
+    global _locale_registry
+    with _locale_registry_lock:
+        _locale_registry = None
+
+
+def update_locale_registry(added=None, removed_ids=()):
+    global _locale_registry
+    with _locale_registry_lock:
+        if _locale_registry is not None:
+            _locale_registry = _locale_registry.updated(added, removed_ids)
+
+
 @event.listens_for(Locale, 'after_insert', propagate=True)
+def locale_created(mapper, connection, target):
+    update_locale_registry({target.id: target.code})
+    # Forget it if the transaction is rolled back
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('new_locale_ids', set()).add(target.id)
+
+
 @event.listens_for(Locale, 'after_delete', propagate=True)
-def locale_collection_changed(target, value, oldvalue):
-    # Reset the collections
-    Locale._locale_collection_subsets = None
-    Locale._locale_collection = None
-    Locale._locale_collection_byid = None
+def locale_deleted(mapper, connection, target):
+    update_locale_registry(removed_ids=(target.id,))
+
+
+@event.listens_for(Session, 'after_commit')
+def locales_committed(session):
+    session.info.pop('new_locale_ids', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def locales_rolled_back(session):
+    new_locale_ids = session.info.pop('new_locale_ids', None)
+    if new_locale_ids:
+        update_locale_registry(removed_ids=new_locale_ids)
 
 
 class LocaleLabel(Base):
@@ -506,8 +591,7 @@ class LangString(Base):
     @hybrid_method
     def non_mt_entries(self):
         return [e for e in self.entries
-                if not Locale.locale_is_machine_translated(
-                    Locale.code_for_id(e.locale_id))]
+                if not Locale.id_is_machine_translated(e.locale_id)]
 
     @non_mt_entries.expression
     def non_mt_entries(self):
@@ -621,7 +705,7 @@ class LangString(Base):
                     return available[locale_id]
             # is another variant there?
             mt_variants = list()
-            for sublocale in locale_collection_subsets[root_locale]:
+            for sublocale in locale_collection_subsets.get(root_locale, ()):
                 if sublocale in locale_codes:
                     continue
                 if sublocale == root_locale:
@@ -663,7 +747,7 @@ class LangString(Base):
             # is another variant there?
             mt_variants = list()
             found = False
-            for sublocale in locale_collection_subsets[root_locale]:
+            for sublocale in locale_collection_subsets.get(root_locale, ()):
                 if sublocale in locale_codes:
                     continue
                 if sublocale == root_locale:
@@ -715,8 +799,7 @@ class LangString(Base):
                 candidates = []
                 entriesByLocale = {}
                 for entry in entries:
-                    pref = user_prefs.find_locale(
-                        Locale.extract_base_locale(entry.locale_code))
+                    pref = user_prefs.find_locale(entry.base_locale)
                     if pref:
                         candidates.append(pref)
                         entriesByLocale[pref.locale_code] = entry
@@ -765,9 +848,7 @@ class LangString(Base):
 
     def closest_entry(self, target_locale, filter_errors=True):
         def common_len(e):
-            return Locale.compatible(
-                target_locale,
-                Locale.extract_base_locale(e.locale_code))
+            return Locale.compatible(target_locale, e.base_locale)
         if filter_errors:
             entries = [(common_len(e), e) for e in self.entries if not e.error_code]
         else:
@@ -944,6 +1025,8 @@ class LangStringEntry(TombstonableMixin, Base):
 
     @property
     def base_locale(self):
+        if self.locale_id:
+            return Locale.base_code_for_id(self.locale_id)
         return Locale.extract_base_locale(self.locale_code)
 
     @property
@@ -957,8 +1040,9 @@ class LangStringEntry(TombstonableMixin, Base):
 
     @hybrid_property
     def is_machine_translated(self):
-        return Locale.locale_is_machine_translated(
-            Locale.code_for_id(self.locale_id))
+        if self.locale_id:
+            return Locale.id_is_machine_translated(self.locale_id)
+        return Locale.locale_is_machine_translated(self.locale_code)
 
     @is_machine_translated.expression
     def is_machine_translated(cls):
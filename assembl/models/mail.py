@@ -1,6 +1,7 @@
 # coding=UTF-8
 """:py:class:`assembl.models.post.Post` that came as email, and utility code for handling email."""
 import email
+import logging
 import mailbox
 import re
 import smtplib
@@ -17,7 +18,9 @@ from pyramid.threadlocal import get_current_registry
 from datetime import datetime
 from imaplib2 import IMAP4_SSL, IMAP4
 import transaction
-from sqlalchemy.orm import joinedload_all, undefer
+from sqlalchemy.orm import (
+    backref, joinedload, joinedload_all, relationship, subqueryload,
+    undefer)
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy import (
     Column,
@@ -29,12 +32,15 @@ from sqlalchemy import (
 )
 from ..lib.sqla_types import (CoerceUnicode, EmailString)
 
+from . import Base
 from .langstrings import LangString
 from .generic import PostSource
 from .post import ImportedPost
 from .auth import EmailAccount
 from ..tasks.imap import import_mails
-from ..tasks.translate import translate_content
+from ..tasks.translate import translate_contents_task
+
+log = logging.getLogger('assembl')
 
 
 class AbstractMailbox(PostSource):
@@ -94,6 +100,21 @@ class AbstractMailbox(PostSource):
             return message_id[1:-1]
         return message_id
 
+    _message_id_re = re.compile(r'<([^>]+)>')
+
+    @classmethod
+    def parse_references(cls, references, in_reply_to=None):
+        """The message ids of the ancestors of an email, from its
+        References and In-Reply-To headers, without angle brackets.
+        The direct parent comes last, as in jwzthreading."""
+        ids = []
+        for message_id in cls._message_id_re.findall(references or ''):
+            if message_id not in ids:
+                ids.append(message_id)
+        if in_reply_to and in_reply_to not in ids:
+            ids.append(in_reply_to)
+        return ids
+
     @staticmethod
     def strip_full_message_quoting_plaintext(message_body):
         """Assumes any encoding conversions have already been done
@@ -380,6 +401,11 @@ class AbstractMailbox(PostSource):
         if new_in_reply_to:
             new_in_reply_to = self.clean_angle_brackets(
                 email_header_to_unicode(new_in_reply_to))
+        new_references = parsed_email.get('References', None)
+        if new_references:
+            new_references = email_header_to_unicode(new_references)
+        new_references = self.parse_references(
+            new_references, new_in_reply_to)
 
         sender = email_header_to_unicode(parsed_email.get('From'))
         sender_name, sender_email = parseaddr(sender)
@@ -405,6 +431,7 @@ class AbstractMailbox(PostSource):
             email_object.creation_date = creation_date
             email_object.source_post_id = new_message_id
             email_object.in_reply_to = new_in_reply_to
+            email_object.set_references(new_references)
             email_object.body_mime_type = mimeType
             email_object.imported_blob = message_string
             # TODO MAP: Make this nilpotent.
@@ -424,6 +451,7 @@ class AbstractMailbox(PostSource):
                 body_mime_type=mimeType,
                 imported_blob=message_string
             )
+            email_object.set_references(new_references)
         except MultipleResultsFound:
             """ TO find duplicates (this should no longer happen, but in case it ever does...
 
@@ -465,6 +493,11 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
     """
     @staticmethod
     def thread_mails(emails):
+        """Re-thread a complete set of emails with jwzthreading.
+
+        This re-parses every email, so it is only used for maintenance
+        (see ``assembl/scripts/rethread_mails.py``) and reprocessing;
+        imports use :py:meth:`thread_new_mails`."""
         # print('Threading...')
         emails_for_threading = []
         for mail in emails:
@@ -477,12 +510,6 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
 
         threaded_emails = jwzthreading.thread(emails_for_threading)
 
-        # Output
-        L = threaded_emails.items()
-        L.sort()
-        for subj, container in L:
-            jwzthreading.print_container(container, 0, True)
-
         def update_threading(threaded_emails, parent=None, debug=False):
             if debug:
                 print "\n\nEntering update_threading() for %s mails:" % len(threaded_emails)
@@ -539,6 +566,57 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
 
         update_threading(threaded_emails.values(), debug=False)
 
+    @staticmethod
+    def thread_new_mails(db, discussion_id, message_ids, chunk_size=500):
+        """Thread newly imported emails, given their message ids.
+
+        Each new email is attached to its closest ancestor present in the
+        discussion, found through the indexed message ids and references.
+        Existing emails which reference the new ones are threaded again,
+        as they may have been waiting for a missing ancestor.
+        This only touches emails related to the new ones, whatever the size
+        of the discussion."""
+        message_ids = list(set(message_ids))
+        email_ids = set()
+        for i in range(0, len(message_ids), chunk_size):
+            chunk = message_ids[i:i + chunk_size]
+            email_ids.update(id for (id,) in db.query(Email.id).filter(
+                Email.discussion_id == discussion_id,
+                Email.message_id.in_(chunk)))
+            email_ids.update(id for (id,) in db.query(
+                EmailReference.email_id).join(Email).filter(
+                Email.discussion_id == discussion_id,
+                EmailReference.message_id.in_(chunk)))
+        email_ids = sorted(email_ids)
+        for i in range(0, len(email_ids), chunk_size):
+            emails = db.query(Email).filter(
+                Email.id.in_(email_ids[i:i + chunk_size])).options(
+                joinedload(Email.parent),
+                subqueryload(Email.references)).order_by(Email.id).all()
+            references = list({ref.message_id for mail in emails
+                               for ref in mail.references})
+            candidates = {}
+            for j in range(0, len(references), chunk_size):
+                candidates.update((mail.message_id, mail) for mail in db.query(
+                    Email).filter(
+                    Email.discussion_id == discussion_id,
+                    Email.message_id.in_(references[j:j + chunk_size])))
+            for mail in emails:
+                current_parent = mail.parent
+                if not (current_parent is None or
+                        isinstance(current_parent, Email)):
+                    # the threading algorithm only considers mails
+                    continue
+                for ref in reversed(mail.references):
+                    parent = candidates.get(ref.message_id, None)
+                    if parent is not None and parent is not mail and \
+                            mail.id not in parent.ancestor_ids():
+                        break
+                else:
+                    continue
+                if parent is not current_parent:
+                    mail.set_parent(parent)
+
     def reprocess_content(self):
         """ Allows re-parsing all content as if it were imported for the first time
             but without re-hitting the source, or changing the object ids.
@@ -652,6 +730,57 @@ class IMAPMailbox(AbstractMailbox):
         'with_polymorphic': '*'
     }
 
+    # How many messages are fetched, and committed, at once
+    fetch_batch_size = 100
+
+    _fetch_uid_re = re.compile(r'\bUID (\d+)')
+
+    @classmethod
+    def fetch_messages(cls, mailbox, email_ids):
+        """Fetch messages by uid from an IMAP connection, in one round trip.
+
+        Returns (uid, message string) pairs, in the order of email_ids, and
+        the last uid up to which all messages were read, or None.
+        Messages deleted in the meantime are missing; a message which still
+        exists but could not be read stops the batch before it."""
+        status, message_data = mailbox.uid(
+            'fetch', ','.join(email_ids), "(UID RFC822)")
+        if status != 'OK':
+            raise IMAP4.error(message_data)
+        messages = {}
+        message_string = None
+        for response_part in message_data:
+            if isinstance(response_part, tuple):
+                (header, message_string) = response_part
+            elif message_string is not None:
+                # The UID may come after the message literal
+                header = response_part
+            else:
+                continue
+            match = cls._fetch_uid_re.search(header)
+            if match:
+                messages[match.group(1)] = message_string
+            if not isinstance(response_part, tuple):
+                message_string = None
+        missing = [email_id for email_id in email_ids
+                   if not messages.get(email_id, None)]
+        if missing:
+            # Make sure they were deleted
+            status, search_result = mailbox.uid(
+                'search', None, 'UID ' + ','.join(missing))
+            if status != 'OK':
+                raise IMAP4.error(search_result)
+            existing = set(search_result[0].split()).intersection(missing)
+            if existing:
+                first = min(email_ids.index(email_id)
+                            for email_id in existing)
+                log.warning("Could not read IMAP message with uid %s" % (
+                    email_ids[first],))
+                email_ids = email_ids[:first]
+        return ([(email_id, messages[email_id]) for email_id in email_ids
+                 if messages.get(email_id, None)],
+                email_ids[-1] if email_ids else None)
+
     @staticmethod
     def do_import_content(mbox, only_new=True):
         mbox = mbox.db.merge(mbox)
@@ -700,33 +829,40 @@ class IMAPMailbox(AbstractMailbox):
             assert search_status == 'OK'
             email_ids = search_result[0].split()
 
-        def import_email(mailbox_obj, email_id):
+        def import_batch(mailbox_obj, batch):
             session = mailbox_obj.db
-            # print "running fetch for message: "+email_id
-            status, message_data = mailbox.uid('fetch', email_id, "(RFC822)")
-            assert status == 'OK'
-
-            # print repr(message_data)
-            for response_part in message_data:
-                if isinstance(response_part, tuple):
-                    message_string = response_part[1]
-            assert message_string
-            if mailbox_obj.message_ok_to_import(message_string):
-                (email_object, dummy, error) = mailbox_obj.parse_email(message_string)
-                if error:
-                    raise Exception(error)
-                session.add(email_object)
-                translate_content(email_object)  # should delay
-            else:
-                print "Skipped message with imap id %s (bounce or vacation message)" % (email_id)
-            # print "Setting mailbox_obj.last_imported_email_uid to "+email_id
-            mailbox_obj.last_imported_email_uid = email_id
-
+            imported_emails = []
+            (messages, last_uid) = IMAPMailbox.fetch_messages(mailbox, batch)
+            for (email_id, message_string) in messages:
+                if mailbox_obj.message_ok_to_import(message_string):
+                    (email_object, dummy, error) = mailbox_obj.parse_email(message_string)
+                    if error:
+                        raise Exception(error)
+                    session.add(email_object)
+                    imported_emails.append(email_object)
+                else:
+                    print "Skipped message with imap id %s (bounce or vacation message)" % (email_id)
+            # print "Setting mailbox_obj.last_imported_email_uid to "+last_uid
+            if last_uid:
+                mailbox_obj.last_imported_email_uid = last_uid
+            session.flush()
+            imported_email_ids.extend(
+                email_object.id for email_object in imported_emails)
+            imported_message_ids.extend(
+                email_object.message_id for email_object in imported_emails)
+            return last_uid == batch[-1]
+
+        imported_email_ids = []
+        imported_message_ids = []
         if len(email_ids):
             print "Processing messages from IMAP: %d " % (len(email_ids))
-            for email_id in email_ids:
+            batch_size = mbox.fetch_batch_size
+            for i in range(0, len(email_ids), batch_size):
                 with transaction.manager:
-                    import_email(mbox, email_id)
+                    complete = import_batch(mbox, email_ids[i:i + batch_size])
+                if not complete:
+                    # Retry from the unread message next time
+                    break
         else:
             print "No IMAP messages to process"
 
@@ -734,14 +870,13 @@ class IMAPMailbox(AbstractMailbox):
         mailbox.close()
         mailbox.logout()
 
-        with transaction.manager:
-            if len(email_ids):
-                # We imported mails, we need to re-thread
-                emails = session.query(Email).filter(
-                    Email.discussion_id == discussion_id,
-                    ).options(joinedload_all(Email.parent))
-
-                AbstractMailbox.thread_mails(emails)
+        if imported_message_ids:
+            # We imported mails, we need to thread them
+            with transaction.manager:
+                AbstractMailbox.thread_new_mails(
+                    session, discussion_id, imported_message_ids)
+        if imported_email_ids:
+            translate_contents_task.delay(imported_email_ids)
 
     def make_reader(self):
         from assembl.tasks.imaplib2_source_reader import IMAPReader
@@ -853,20 +988,19 @@ class MaildirMailbox(AbstractFilesystemMailbox):
             (email_object, dummy, error) = abstract_mbox.parse_email(message_string)
             if error:
                 raise Exception(error)
+            imported_message_ids.append(email_object.message_id)
             with transaction.manager:
                 session.add(email_object)
             abstract_mbox = AbstractMailbox.get(abstract_mbox.id)
 
         if len(mails):
+            imported_message_ids = []
             [import_email(abstract_mbox, message_data) for message_data in mails]
 
-            # We imported mails, we need to re-thread
+            # We imported mails, we need to thread them
             with transaction.manager:
-                emails = session.query(Email).filter(
-                    Email.discussion_id == discussion_id,
-                    ).options(joinedload_all(Email.parent))
-
-                AbstractMailbox.thread_mails(emails)
+                AbstractMailbox.thread_new_mails(
+                    session, discussion_id, imported_message_ids)
 
 
 class Email(ImportedPost):
@@ -885,12 +1019,20 @@ class Email(ImportedPost):
     recipients = Column(UnicodeText, nullable=False)
     sender = Column(CoerceUnicode(), nullable=False)
 
-    in_reply_to = Column(CoerceUnicode())
+    in_reply_to = Column(CoerceUnicode(), index=True)
 
     __mapper_args__ = {
         'polymorphic_identity': 'email',
     }
 
+    def set_references(self, message_ids):
+        """Set the message ids of the ancestors of this email,
+        as given by :py:meth:`AbstractMailbox.parse_references`"""
+        if [ref.message_id for ref in self.references] != message_ids:
+            self.references = [
+                EmailReference(position=position, message_id=message_id)
+                for (position, message_id) in enumerate(message_ids)]
+
     def REWRITEMEreply(self, sender, response_body):
         """
         Send a response to this email.
@@ -978,3 +1120,18 @@ class Email(ImportedPost):
 
     def get_title(self):
         return self.source.mangle_mail_subject(self.subject)
+
+
+class EmailReference(Base):
+    """The message ids an email refers to, from its References and
+    In-Reply-To headers, indexed to thread new emails incrementally."""
+    __tablename__ = 'email_reference'
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, ForeignKey(
+        'email.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    # The direct parent has the last position
+    position = Column(Integer, nullable=False)
+    message_id = Column(CoerceUnicode, nullable=False, index=True)
+    email = relationship(Email, backref=backref(
+        'references', order_by=position, cascade="all, delete-orphan"))
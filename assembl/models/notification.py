@@ -3,6 +3,7 @@
 from datetime import datetime
 from collections import defaultdict
 from abc import abstractmethod
+from inspect import isabstract
 import transaction
 import os
 from os.path import join, dirname
@@ -10,6 +11,8 @@ import email
 from email import (charset as Charset)
 from email.mime.text import MIMEText
 from functools import partial
+from cgi import escape
+from time import time
 import threading
 
 from sqlalchemy import (
@@ -19,8 +22,12 @@ from sqlalchemy import (
     UnicodeText,
     DateTime,
     ForeignKey,
+    and_,
+    case,
     event,
-    inspect
+    exists,
+    inspect,
+    or_,
 )
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.orm.exc import DetachedInstanceError
@@ -34,10 +41,13 @@ from jinja2 import Environment, PackageLoader
 from . import Base, DiscussionBoundBase
 from ..lib.model_watcher import IModelEventWatcher
 from ..lib.decl_enums import DeclEnum
-from ..lib.sqla import get_session_maker
+from ..lib.sqla import get_session_maker, mark_changed
 from ..lib.utils import waiting_get
 from ..lib import config
-from .auth import User, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate
+from ..auth import R_PARTICIPANT
+from .auth import (
+    User, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate, LocalUserRole,
+    Role)
 from .discussion import Discussion
 from .generic import Content
 from .post import Post, SynthesisPost
@@ -235,33 +245,97 @@ class NotificationSubscription(DiscussionBoundBase):
     def wouldCreateNotification(self, discussion_id, verb, object):
         return discussion_id == object.get_discussion_id() and self.user.is_participant(discussion_id)
 
+    @classmethod
+    def applicable_condition(cls, discussion_id, verb, object):
+        """The SQL condition on subscriptions of this class that would fire
+        on the object and verb, or None if none can.
+        Must match :py:meth:`wouldCreateNotification`."""
+        if discussion_id != object.get_discussion_id():
+            return None
+        return exists().where(and_(
+            LocalUserRole.user_id == NotificationSubscription.user_id,
+            LocalUserRole.discussion_id == discussion_id,
+            LocalUserRole.requested == False,  # noqa: E712
+            LocalUserRole.role_id == Role.id,
+            Role.name == R_PARTICIPANT))
+
+    @classmethod
+    def applicable_query(cls, discussion_id, verb, object, user_id=None):
+        """Query of (user_id, id, type, priority) of the active subscriptions
+        of this class and its subclasses that would fire on the object
+        and verb, or None if none can."""
+        from ..lib.utils import get_concrete_subclasses_recursive
+        subscription_classes = get_concrete_subclasses_recursive(cls)
+        if not isabstract(cls):
+            subscription_classes.append(cls)
+        conditions = []
+        priorities = []
+        for subscription_class in subscription_classes:
+            condition = subscription_class.applicable_condition(
+                discussion_id, verb, object)
+            if condition is None:
+                continue
+            is_class = NotificationSubscription.type == \
+                subscription_class.__mapper__.polymorphic_identity
+            conditions.append(and_(is_class, condition))
+            priorities.append((is_class, subscription_class.priority))
+        if not conditions:
+            return None
+        query = cls.default_db.query(
+            NotificationSubscription.user_id,
+            NotificationSubscription.id,
+            NotificationSubscription.type,
+            case(priorities).label('priority')
+        ).filter(
+            NotificationSubscription.status == NotificationSubscriptionStatus.ACTIVE,
+            NotificationSubscription.discussion_id == discussion_id,
+            or_(*conditions))
+        if user_id is not None:
+            query = query.filter(NotificationSubscription.user_id == user_id)
+        return query
+
+    @classmethod
+    def first_applicable_query(cls, discussion_id, verb, object):
+        """Like :py:meth:`applicable_query`, but only the subscription
+        with the lowest priority of each user, which creates the notification"""
+        query = cls.applicable_query(discussion_id, verb, object)
+        if query is None:
+            return None
+        return query.distinct(NotificationSubscription.user_id).order_by(
+            NotificationSubscription.user_id, 'priority',
+            NotificationSubscription.id)
+
     @classmethod
     def findApplicableInstances(cls, discussion_id, verb, object, user=None):
         """
         Returns all subscriptions that would fire on the object, and verb given
-
-        This naive implementation instanciates every ACTIVE subscription for every user,
-        and calls "would fire" for each.  It is expected that most subclasses will
-        override this with a more optimal implementation
         """
-        applicable_subscriptions = []
-        subscriptionsQuery = cls.default_db.query(cls)
-        subscriptionsQuery = subscriptionsQuery.filter(cls.status == NotificationSubscriptionStatus.ACTIVE)
-        subscriptionsQuery = subscriptionsQuery.filter(cls.discussion_id == discussion_id)
-        if user:
-            subscriptionsQuery = subscriptionsQuery.filter(cls.user == user)
-        # print "findApplicableInstances(called) with discussion_id=%s, verb=%s, object=%s, user=%s"%(discussion_id, verb, object, user)
-        # print repr(subscriptionsQuery.all())
-        for subscription in subscriptionsQuery:
-            if(subscription.wouldCreateNotification(object.get_discussion_id(), verb, object)):
-                applicable_subscriptions.append(subscription)
-        return applicable_subscriptions
+        query = cls.applicable_query(
+            discussion_id, verb, object, user.id if user else None)
+        if query is None:
+            return []
+        ids = query.with_entities(NotificationSubscription.id).subquery()
+        return cls.default_db.query(NotificationSubscription).filter(
+            NotificationSubscription.id.in_(ids)).all()
 
     @abstractmethod
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         """Process a CRUD event on a model, creating :py:class:`Notification` as appropriate"""
         pass
 
+    @classmethod
+    def bulk_process(cls, subscription_ids, discussion_id, verb, objectInstance):
+        """Process a CRUD event for many subscriptions of this class.
+        Returns the ids of created notifications which still have to be sent;
+        by default, :py:meth:`process` is called on each subscription,
+        and sends its notification itself."""
+        for subscription in cls.default_db.query(cls).filter(
+                cls.id.in_(subscription_ids)):
+            # The other applicable subscriptions of the user are
+            # found again by Notification.get_applicable_subscriptions
+            subscription.process(discussion_id, verb, objectInstance, [])
+        return []
+
     def get_human_readable_description(self):
         """ A human readable description of this notification subscription
         Default implementation, expected to be overriden by child classes """
@@ -624,9 +698,15 @@ class NotificationSubscriptionFollowSyntheses(NotificationSubscriptionGlobal):
         parentWouldCreate = super(NotificationSubscriptionFollowSyntheses, self).wouldCreateNotification(discussion_id, verb, object)
         return parentWouldCreate and (verb == CrudVerbs.CREATE) and isinstance(object, SynthesisPost) and discussion_id == object.get_discussion_id()
 
+    @classmethod
+    def applicable_condition(cls, discussion_id, verb, object):
+        if verb != CrudVerbs.CREATE or not isinstance(object, SynthesisPost):
+            return None
+        return super(NotificationSubscriptionFollowSyntheses, cls).applicable_condition(
+            discussion_id, verb, object)
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         from ..tasks.notify import notify
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
         notification = NotificationOnPostCreated(
             post=objectInstance,
             first_matching_subscription=self,
@@ -637,6 +717,11 @@ class NotificationSubscriptionFollowSyntheses(NotificationSubscriptionGlobal):
         self.db.flush()
         notify.delay(notification.id)
 
+    @classmethod
+    def bulk_process(cls, subscription_ids, discussion_id, verb, objectInstance):
+        return NotificationOnPostCreated.bulk_create(
+            subscription_ids, objectInstance.id)
+
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_SYNTHESES
     }
@@ -653,8 +738,14 @@ class NotificationSubscriptionFollowAllMessages(NotificationSubscriptionGlobal):
         parentWouldCreate = super(NotificationSubscriptionFollowAllMessages, self).wouldCreateNotification(discussion_id, verb, object)
         return parentWouldCreate and (verb == CrudVerbs.CREATE) and isinstance(object, Post) and discussion_id == object.get_discussion_id()
 
+    @classmethod
+    def applicable_condition(cls, discussion_id, verb, object):
+        if verb != CrudVerbs.CREATE or not isinstance(object, Post):
+            return None
+        return super(NotificationSubscriptionFollowAllMessages, cls).applicable_condition(
+            discussion_id, verb, object)
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
         from ..tasks.notify import notify
         notification = NotificationOnPostCreated(
             post_id=objectInstance.id,
@@ -666,6 +757,11 @@ class NotificationSubscriptionFollowAllMessages(NotificationSubscriptionGlobal):
         self.db.flush()
         notify.delay(notification.id)
 
+    @classmethod
+    def bulk_process(cls, subscription_ids, discussion_id, verb, objectInstance):
+        return NotificationOnPostCreated.bulk_create(
+            subscription_ids, objectInstance.id)
+
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_ALL_MESSAGES
     }
@@ -689,8 +785,18 @@ class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscrip
             object.parent.creator == self.user
         )
 
+    @classmethod
+    def applicable_condition(cls, discussion_id, verb, object):
+        if (verb != CrudVerbs.CREATE or not isinstance(object, Post) or
+                object.parent_id is None):
+            return None
+        condition = super(NotificationSubscriptionFollowOwnMessageDirectReplies, cls).applicable_condition(
+            discussion_id, verb, object)
+        if condition is None:
+            return None
+        return and_(condition, NotificationSubscription.user_id == object.parent.creator_id)
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
         from ..tasks.notify import notify
         notification = NotificationOnPostCreated(
             post=objectInstance,
@@ -702,6 +808,11 @@ class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscrip
         self.db.flush()
         notify.delay(notification.id)
 
+    @classmethod
+    def bulk_process(cls, subscription_ids, discussion_id, verb, objectInstance):
+        return NotificationOnPostCreated.bulk_create(
+            subscription_ids, objectInstance.id)
+
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_OWN_MESSAGES_DIRECT_REPLIES
     }
@@ -714,28 +825,42 @@ class ModelEventWatcherNotificationSubscriptionDispatcher(object):
     protocol"""
     interface.implements(IModelEventWatcher)
 
+    chunk_size = 1000
+    notify_batch_size = 100
+
     def processEvent(self, verb, objectClass, objectId):
-        from ..lib.utils import get_concrete_subclasses_recursive
         assert objectId
         objectInstance = waiting_get(objectClass, objectId)
         assert objectInstance
         assert objectInstance.id
         # We need the discussion id
         assert isinstance(objectInstance, DiscussionBoundBase)
-        applicableInstancesByUser = defaultdict(list)
-        subscriptionClasses = get_concrete_subclasses_recursive(NotificationSubscription)
-        for subscriptionClass in subscriptionClasses:
-            applicableInstances = subscriptionClass.findApplicableInstances(objectInstance.get_discussion_id(), CrudVerbs.CREATE, objectInstance)
-            for subscription in applicableInstances:
-                applicableInstancesByUser[subscription.user_id].append(subscription)
-        num_instances = len([v for v in applicableInstancesByUser.itervalues() if v])
-        print "processEvent: %d notifications created for %s %s %d" % (
-            num_instances, verb, objectClass.__name__, objectId)
+        discussion_id = objectInstance.get_discussion_id()
+        # The first subscription of each user, in priority order
+        query = NotificationSubscription.first_applicable_query(
+            discussion_id, CrudVerbs.CREATE, objectInstance)
+        ids_by_class = defaultdict(list)
+        polymorphic_map = NotificationSubscription.__mapper__.polymorphic_map
+        for (user_id, id, type, priority) in ([] if query is None else query):
+            ids_by_class[polymorphic_map[type].class_].append(id)
+        notification_ids = []
         with transaction.manager:
-            for userId, applicableInstances in applicableInstancesByUser.iteritems():
-                if(len(applicableInstances) > 0):
-                    applicableInstances.sort(cmp=lambda x, y: cmp(x.priority, y.priority))
-                    applicableInstances[0].process(objectInstance.get_discussion_id(), verb, objectInstance, applicableInstances[1:])
+            for subscription_class, ids in ids_by_class.iteritems():
+                for start in range(0, len(ids), self.chunk_size):
+                    notification_ids.extend(subscription_class.bulk_process(
+                        ids[start:start + self.chunk_size],
+                        discussion_id, verb, objectInstance))
+        print "processEvent: %d notifications created for %s %s %d" % (
+            sum(len(ids) for ids in ids_by_class.itervalues()),
+            verb, objectClass.__name__, objectId)
+        self.send_notifications(notification_ids)
+
+    def send_notifications(self, notification_ids):
+        "Send committed notifications, in batches of tasks"
+        from ..tasks.notify import notify_batch
+        for start in range(0, len(notification_ids), self.notify_batch_size):
+            notify_batch.delay(
+                notification_ids[start:start + self.notify_batch_size])
 
     def processPostCreated(self, id):
         print "processPostCreated", id
@@ -891,8 +1016,19 @@ class Notification(Base):
     delivery_confirmation_date = Column(
         DateTime,
         nullable=True)
+    # When a notification delayed by rate limiting will be sent
+    scheduled_date = Column(
+        DateTime,
+        nullable=True)
 
-    threadlocals = threading.local()
+    # Caches of this process for email rendering, see render_to_email_html_part
+    _css_cache = {}
+    _localizers = {}
+    _jinja_envs = {}
+    _shared_renders = {}
+    _render_lock = threading.Lock()
+    shared_render_ttl = 600
+    max_shared_renders = 1000
 
     @abstractmethod
     def event_source_object(self):
@@ -942,32 +1078,41 @@ class Notification(Base):
 
     @classmethod
     def make_jinja_env(cls, user=None):
-        jinja_env = cls.make_unlocalized_jinja_env()
-        cls.setup_localizer(jinja_env, user)
+        return cls.jinja_env_for_locale(cls.get_locale(user))
+
+    @classmethod
+    def jinja_env_for_locale(cls, locale):
+        "A jinja environment with the translations of the locale, shared"
+        jinja_env = cls._jinja_envs.get(locale, None)
+        if jinja_env is None:
+            jinja_env = cls.make_unlocalized_jinja_env()
+            cls.setup_localizer(jinja_env, locale=locale)
+            cls._jinja_envs[locale] = jinja_env
         return jinja_env
 
     def get_jinja_env(self):
-        threadlocals = self.threadlocals
-        if getattr(threadlocals, 'jinja_env', None) is None:
-            threadlocals.jinja_env = self.make_unlocalized_jinja_env()
-        self.setup_localizer(
-            threadlocals.jinja_env, self.first_matching_subscription.user)
-        return threadlocals.jinja_env
+        return self.make_jinja_env(self.first_matching_subscription.user)
 
     @classmethod
-    def get_localizer(cls, user=None):
+    def get_locale(cls, user=None):
         if user:
-            locale = user.get_preferred_locale()
-        else:
-            locale = config.get(
-                'available_languages', 'fr_CA en_CA').split()[0]
-        # TODO: if locale has country code, make sure we fallback properly.
-        path = os.path.abspath(join(dirname(__file__), os.path.pardir, 'locale'))
-        return make_localizer(locale, [path])
+            return user.get_preferred_locale()
+        return config.get(
+            'available_languages', 'fr_CA en_CA').split()[0]
+
+    @classmethod
+    def get_localizer(cls, user=None, locale=None):
+        locale = locale or cls.get_locale(user)
+        localizer = cls._localizers.get(locale, None)
+        if localizer is None:
+            # TODO: if locale has country code, make sure we fallback properly.
+            path = os.path.abspath(join(dirname(__file__), os.path.pardir, 'locale'))
+            localizer = cls._localizers[locale] = make_localizer(locale, [path])
+        return localizer
 
     @classmethod
-    def setup_localizer(cls, jinja_env=None, user=None):
-        localizer = cls.get_localizer(user)
+    def setup_localizer(cls, jinja_env=None, user=None, locale=None):
+        localizer = cls.get_localizer(user, locale)
         jinja_env = jinja_env or cls.make_unlocalized_jinja_env()
         jinja_env.install_gettext_callables(
             partial(localizer.translate, domain='assembl'),
@@ -975,16 +1120,51 @@ class Notification(Base):
             newstyle=True)
 
     @classmethod
-    def get_css_paths(cls, discussion):
+    def get_css(cls, discussion):
+        """The notification stylesheet of the discussion's theme,
+        and the ink stylesheet, as text"""
         from ..views import get_theme_info, get_theme_base_path
         (theme_name, theme_relative_path) = get_theme_info(discussion)
         assembl_css_path = os.path.normpath(os.path.join(get_theme_base_path(), theme_relative_path, 'assembl_notifications.css'))
-        assembl_css = open(assembl_css_path)
-        assert assembl_css
         ink_css_path = os.path.normpath(os.path.join(os.path.abspath(__file__), '..', '..', 'static', 'js', 'bower', 'ink', 'css', 'ink.css'))
-        ink_css = open(ink_css_path)
-        assert ink_css
-        return (assembl_css, ink_css)
+        return (cls.read_css(assembl_css_path), cls.read_css(ink_css_path))
+
+    @classmethod
+    def read_css(cls, path):
+        "The contents of a stylesheet, read again only if the file changed"
+        mtime = os.path.getmtime(path)
+        entry = cls._css_cache.get(path, None)
+        if entry is None or entry[0] != mtime:
+            with open(path) as css:
+                entry = (mtime, css.read().decode('utf_8'))
+            cls._css_cache[path] = entry
+        return entry[1]
+
+    @classmethod
+    def get_shared_render(cls, key, render):
+        """The parts of an email shared by recipients, from the cache
+        or from the ``render()`` function"""
+        now = time()
+        entry = cls._shared_renders.get(key, None)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        parts = render()
+        with cls._render_lock:
+            if len(cls._shared_renders) >= cls.max_shared_renders:
+                for old_key, (expiry, old_parts) in cls._shared_renders.items():
+                    if expiry <= now:
+                        del cls._shared_renders[old_key]
+                if len(cls._shared_renders) >= cls.max_shared_renders:
+                    cls._shared_renders.clear()
+            cls._shared_renders[key] = (now + cls.shared_render_ttl, parts)
+        return parts
+
+    @classmethod
+    def clear_render_caches(cls):
+        cls._css_cache.clear()
+        cls._localizers.clear()
+        cls._jinja_envs.clear()
+        cls._shared_renders.clear()
 
     def get_from_email_address(self):
         from_email = self.first_matching_subscription.discussion.admin_source.admin_sender
@@ -1085,6 +1265,30 @@ class NotificationOnPostCreated(NotificationOnPost):
     def event_source_object(self):
         return NotificationOnPost.event_source_object(self)
 
+    @classmethod
+    def bulk_create(cls, subscription_ids, post_id,
+                    push_method=NotificationPushMethodType.EMAIL):
+        """Create the notifications of subscriptions on a new post,
+        with a multi-row insert per table. Returns their ids."""
+        if not subscription_ids:
+            return []
+        db = cls.default_db
+        now = datetime.utcnow()
+        result = db.execute(Notification.__table__.insert().values([{
+            'sqla_type': NotificationClasses.NOTIFICATION_ON_POST_CREATED,
+            'first_matching_subscription_id': subscription_id,
+            'creation_date': now,
+            'push_method': push_method,
+            'delivery_state': NotificationDeliveryStateType.QUEUED,
+            'delivery_confirmation': NotificationDeliveryConfirmationType.NONE,
+        } for subscription_id in subscription_ids]).returning(
+            Notification.__table__.c.id))
+        ids = [id for (id,) in result]
+        db.execute(NotificationOnPost.__table__.insert().values([
+            {'id': id, 'post_id': post_id} for id in ids]))
+        mark_changed(db)
+        return ids
+
     def get_notification_subject(self):
         loc = self.get_localizer()
         subject = "[" + self.first_matching_subscription.discussion.topic + "] "
@@ -1097,18 +1301,47 @@ class NotificationOnPostCreated(NotificationOnPost):
         return subject
 
     def render_to_email_html_part(self):
+        """Fill in the recipient's part of the email.
+
+        Rendering and inlining the CSS is done once for the post and locale,
+        with markers for the notification id and applicable subscriptions.
+        Syntheses depend on the user's language preferences,
+        and are rendered for each notification."""
+        locale = self.get_locale(self.first_matching_subscription.user)
+        if isinstance(self.post, SynthesisPost):
+            return self.render_html_template(self, locale)
+        post = self.post
+        key = (self.__class__, post.id, post.creation_date,
+               getattr(post, 'modification_date', None), locale)
+        (before, item, after) = self.get_shared_render(
+            key, lambda: split_subscriptions_item(self.render_html_template(
+                RecipientPlaceholders(self), locale)))
+        localizer = self.get_localizer(locale=locale)
+        items = []
+        for subscription in self.get_applicable_subscriptions():
+            description = localizer.translate(
+                subscription.get_human_readable_description(),
+                domain='assembl')
+            items.append(item.replace(
+                RecipientPlaceholders.subscription_description,
+                escape(description)).replace(
+                RecipientPlaceholders.subscription_id, str(subscription.id)))
+        return (before + ''.join(items) + after).replace(
+            RecipientPlaceholders.notification_id, str(self.id))
+
+    def render_html_template(self, notification, locale):
         from ..lib.frontend_urls import FrontendUrls, URL_DISCRIMINANTS, SOURCE_DISCRIMINANTS
         from premailer import Premailer
         discussion = self.first_matching_subscription.discussion
         langPrefs = self.first_matching_subscription.get_language_preferences()
-        (assembl_css, ink_css) = self.get_css_paths(discussion)
-        jinja_env = self.get_jinja_env()
+        (assembl_css, ink_css) = self.get_css(discussion)
+        jinja_env = self.jinja_env_for_locale(locale)
         template_data = {'subscription': self.first_matching_subscription,
                          'discussion': discussion,
-                         'notification': self,
+                         'notification': notification,
                          'frontendUrls': FrontendUrls(discussion),
-                         'ink_css': ink_css.read(),
-                         'assembl_notification_css': assembl_css.read().decode('utf_8'),
+                         'ink_css': ink_css,
+                         'assembl_notification_css': assembl_css,
                          'discriminants': {
                              'url': URL_DISCRIMINANTS,
                              'source': SOURCE_DISCRIMINANTS
@@ -1123,3 +1356,42 @@ class NotificationOnPostCreated(NotificationOnPost):
             template = jinja_env.get_template('notifications/html_mail_post.jinja2')
         html = template.render(**template_data)
         return Premailer(html, disable_leftover_css=True).transform()
+
+
+class RecipientPlaceholders(object):
+    """Stands for a notification in the part of an email shared by all
+    recipients: its id and applicable subscriptions are rendered as markers."""
+
+    notification_id = 'ASSEMBLNOTIFICATIONID'
+    subscription_id = 'ASSEMBLSUBSCRIPTIONID'
+    subscription_description = 'ASSEMBLSUBSCRIPTIONDESCRIPTION'
+
+    class SubscriptionPlaceholder(object):
+        def __init__(self, id, description):
+            self.id = id
+            self.description = description
+
+        def get_human_readable_description(self):
+            return self.description
+
+    def __init__(self, notification):
+        self.notification = notification
+        self.id = self.notification_id
+
+    def __getattr__(self, name):
+        return getattr(self.notification, name)
+
+    def get_applicable_subscriptions(self):
+        return [self.SubscriptionPlaceholder(
+            self.subscription_id, self.subscription_description)]
+
+
+def split_subscriptions_item(html):
+    """Split rendered html around the list item of the subscription marker,
+    which is repeated for each applicable subscription."""
+    marker = html.find(RecipientPlaceholders.subscription_description)
+    if marker < 0:
+        return (html, '', '')
+    start = html.rindex('<li', 0, marker)
+    end = html.index('</li>', marker) + len('</li>')
+    return (html[:start], html[start:end], html[end:])
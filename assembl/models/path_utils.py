@@ -2,12 +2,16 @@
 """Utilities for traversing the set of content related to an idea and vice-versa."""
 
 from functools import total_ordering
-from collections import defaultdict
+from collections import defaultdict, Counter
 from bisect import bisect_right
+from threading import Lock
+from time import time
+import logging
 
-from sqlalchemy import String
+from sqlalchemy import String, event, inspect
 from sqlalchemy.orm import (with_polymorphic, aliased)
-from sqlalchemy.sql.expression import or_, union, except_
+from sqlalchemy.orm.session import object_session, Session
+from sqlalchemy.sql.expression import or_, union, except_, select
 from sqlalchemy.sql.functions import count
 
 from .idea_content_link import (
@@ -17,14 +21,12 @@ from .post import (
     countable_publication_states, deleted_publication_states)
 from .annotation import Webpage
 from .idea import IdeaVisitor, Idea, IdeaLink, RootIdea
+from .langstrings import LangStringEntry
 from .discussion import Discussion
 from .action import ViewPost
+from ..lib import config
 
-# TODO: Write a discussion structure cache manager.
-# This will have caches of parent, children, counts, etc. at need
-# and understand the invalidation relationships
-# Tie it to request? use request.set_property?
-
+log = logging.getLogger('assembl')
 
 # Cas à surveiller:
 # I1 > I2 + P1 > P2
@@ -362,6 +364,7 @@ class PostPathGlobalCollection(object):
 
     def __init__(self, discussion=None):
         self.paths = defaultdict(PostPathLocalCollection)
+        self.discussion = discussion
         if discussion is not None:
             self.load_discussion(discussion)
 
@@ -406,46 +409,53 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
         super(PostPathCombiner, self).__init__(discussion)
         self.postponed_paths = []
 
-    def init_from(self, post_path_global_collection):
+    def init_from(self, post_path_global_collection, discussion=None):
         for id, paths in post_path_global_collection.paths.iteritems():
             self.paths[id] = paths.clone()
-        self.discussion = post_path_global_collection.discussion
+        self.discussion = discussion or post_path_global_collection.discussion
+        root_idea_id = getattr(post_path_global_collection, 'root_idea_id', None)
+        if root_idea_id is not None:
+            self.root_idea_id = root_idea_id
 
-    def visit_idea(self, idea, level, prev_result):
+    @staticmethod
+    def get_idea_id(idea):
         if isinstance(idea, Idea):
-            idea_id = idea.id
-        elif isinstance(idea, int):
-            idea_id = idea
-            idea = Idea.get(idea_id)
-        else:
-            assert False, "idea param should be an Idea object or its idea"
-        return self.paths[idea_id]
+            return idea.id
+        assert isinstance(idea, (int, long)), \
+            "idea param should be an Idea object or its id"
+        return idea
+
+    @staticmethod
+    def propagates(idea):
+        # Visits by id do not load ideas; they all propagate for now,
+        # see Idea.propagate_message_count
+        return idea.propagate_message_count() if isinstance(
+            idea, Idea) else True
+
+    def visit_idea(self, idea, level, prev_result):
+        return self.paths[self.get_idea_id(idea)]
 
     def copy_result(self, idea_id, parent_result, child_result):
         # When the parent has no information, and can get it from a single child
         parent_result.paths = child_result.paths[:]
 
     def end_visit(self, idea, level, result, child_results):
-        if isinstance(idea, Idea):
-            idea_id = idea.id
-        elif isinstance(idea, int):
-            idea_id = idea
-            idea = Idea.get(idea_id)
-        else:
-            assert False, "idea param should be an Idea object or its idea"
+        idea_id = self.get_idea_id(idea)
         child_results = [
             (child, res) for (child, res) in child_results if bool(res)]
         if (len(child_results) == 1 and not result and
-                child_results[0][0].propagate_message_count()):
+                self.propagates(child_results[0][0])):
             # optimisation
             self.copy_result(idea_id, result, child_results[0][1])
         else:
             for (child, res) in child_results:
-                if child.propagate_message_count():
+                if self.propagates(child):
                     result.combine(res)
                 else:
                     self.postponed_paths.append(res)
-        if isinstance(idea, RootIdea):
+        # Visits by id start from the root idea
+        if isinstance(idea, RootIdea) or (
+                level == 0 and not isinstance(idea, Idea)):
             self.root_idea_id = idea_id
             for path in self.postponed_paths:
                 result.combine(path)
@@ -489,7 +499,8 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
 class PostPathCounter(PostPathCombiner):
     "Adds the ability to do post counts to PostPathCombiner."
 
-    def __init__(self, discussion, user_id=None, calc_subset=None):
+    def __init__(self, discussion, user_id=None, calc_subset=None,
+                 post_counts_loader=None):
         super(PostPathCounter, self).__init__(discussion)
         self.counts = {}
         self.viewed_counts = {}
@@ -497,6 +508,30 @@ class PostPathCounter(PostPathCombiner):
         self.contributor_counts = {}
         self.user_id = user_id
         self.calc_subset = calc_subset
+        self.counted_all = False
+        # Loads the shared DiscussionPostCounts, if any
+        self.post_counts_loader = post_counts_loader
+        self._post_counts = None
+        self._viewed_counts_by_idea = None
+
+    @property
+    def post_counts(self):
+        if self._post_counts is None and self.post_counts_loader:
+            self._post_counts = self.post_counts_loader()
+        return self._post_counts
+
+    def get_shared_counts(self, idea_id):
+        "Counts from the shared DiscussionPostCounts, plus the user's views"
+        post_counts = self.post_counts
+        (post_count, contributor_count) = post_counts.get_counts(idea_id)
+        if not self.user_id:
+            return (post_count, contributor_count, 0)
+        if self._viewed_counts_by_idea is None:
+            self._viewed_counts_by_idea = post_counts.get_viewed_counts(
+                get_view_counts(
+                    self.discussion.db, self.discussion.id, self.user_id))
+        return (post_count, contributor_count,
+                self._viewed_counts_by_idea.get(idea_id, 0))
 
     def copy_result(self, idea_id, parent_result, child_result):
         # When the parent has no information, and can get it from a single child
@@ -543,21 +578,17 @@ class PostPathCounter(PostPathCombiner):
                 self.viewed_counts[idea_id])
         path_collection = self.paths[idea_id]
         if not path_collection:
-            (
-                path_collection.count,
-                path_collection.contributor_count,
-                path_collection.viewed_count
-            ) = (0, 0, 0)
-            self.counts[idea_id] = 0
-            self.contributor_counts[idea_id] = 0
-            self.viewed_counts[idea_id] = 0
-            return (0, 0, 0)
+            return self.set_counts(idea_id, (0, 0, 0))
+        if self.post_counts is not None:
+            return self.set_counts(idea_id, self.get_shared_counts(idea_id))
         q = path_collection.as_clause(
             self.discussion.db, self.discussion.id, user_id=self.user_id,
             include_deleted=None)
-        (
-            post_count, contributor_count, viewed_count
-        ) = self.get_counts_for_query(q)
+        return self.set_counts(idea_id, self.get_counts_for_query(q))
+
+    def set_counts(self, idea_id, counts):
+        path_collection = self.paths[idea_id]
+        (post_count, contributor_count, viewed_count) = counts
         (
             path_collection.count,
             path_collection.contributor_count,
@@ -570,37 +601,310 @@ class PostPathCounter(PostPathCombiner):
         self.contributor_counts[idea_id] = contributor_count
         return (post_count, contributor_count, viewed_count)
 
+    def calc_all_counts(self):
+        """Compute the counts of all ideas not counted yet,
+        in a single pass over the discussion's posts.
+        Call after the visit, when all path collections are complete."""
+        if self.post_counts is not None:
+            for idea_id in self.paths.keys():
+                self.get_counts(idea_id)
+        else:
+            tree_counter = PostTreeCounter(
+                self.discussion.db, self.discussion.id, self.user_id)
+            for idea_id, path_collection in self.paths.items():
+                if self.counts.get(idea_id, None) is None:
+                    self.set_counts(
+                        idea_id, tree_counter.get_counts(path_collection))
+        self.counted_all = True
+
     def get_orphan_counts(self, include_deleted=False):
         return self.get_counts_for_query(
             self.orphan_clause(self.user_id, include_deleted=include_deleted))
 
     def end_visit(self, idea, level, result, child_results):
-        if isinstance(idea, Idea):
-            idea_id = idea.id
-        elif isinstance(idea, int):
-            idea_id = idea
-            idea = Idea.get(idea_id)
-        else:
-            assert False, "idea param should be an Idea object or its idea"
+        idea_id = self.get_idea_id(idea)
         result = super(PostPathCounter, self).end_visit(
             idea, level, result, child_results)
-        if self.calc_subset is None or (idea_id in self.calc_subset):
+        # counting all ideas is done in bulk by calc_all_counts
+        if self.calc_subset is not None and (idea_id in self.calc_subset):
             self.get_counts(idea_id)
         return result
 
 
+def get_view_counts(db, discussion_id, user_id):
+    "Number of live views of each post of the discussion by the user"
+    return dict(db.query(
+        ViewPost.post_id, count(ViewPost.id)
+        ).join(Post, Post.id == ViewPost.post_id
+        ).filter(
+            Post.discussion_id == discussion_id,
+            ViewPost.actor_id == user_id,
+            ViewPost.tombstone_date == None  # noqa: E711
+        ).group_by(ViewPost.post_id))
+
+
+class PostTreeCounter(object):
+    """Counts posts, contributors and views for many ideas in one pass.
+
+    The posts of the discussion are loaded once, and indexed as a prefix
+    trie of their ancestry (children by parent post.) The posts included
+    in a reduced :py:class:`PostPathLocalCollection` are then the subtrees
+    of its positive paths, down to the nested paths of that collection.
+    This gives the same counts as the :py:meth:`PostPathLocalCollection.as_clause`
+    queries of :py:meth:`PostPathCounter.get_counts`, without a query per idea."""
+
+    def __init__(self, db, discussion_id, user_id=None):
+        self.children = defaultdict(list)
+        # creator of each post that should be counted
+        self.creators = {}
+        self.view_counts = {}
+        q = db.query(
+            Post.id, Post.ancestry, Post.creator_id,
+            Post.publication_state, Post.hidden
+            ).filter(Post.discussion_id == discussion_id)
+        for (post_id, ancestry, creator_id, state, hidden) in q:
+            ancestry = ancestry.rstrip(',')
+            parent_id = int(ancestry.rsplit(',', 1)[-1]) if ancestry else None
+            self.children[parent_id].append(post_id)
+            if not hidden and state in countable_publication_states:
+                self.creators[post_id] = creator_id
+        if user_id:
+            self.view_counts = get_view_counts(db, discussion_id, user_id)
+
+    def get_post_ids(self, path_collection):
+        "Generator of the ids of the posts included in the collection"
+        polarity = {path.last_id: path.positive
+                    for path in path_collection.paths}
+        for start_id, positive in polarity.iteritems():
+            if not positive:
+                continue
+            stack = [start_id]
+            while stack:
+                post_id = stack.pop()
+                yield post_id
+                stack.extend(
+                    child_id for child_id in self.children.get(post_id, ())
+                    if child_id not in polarity)
+
+    def get_counts(self, path_collection):
+        "Return (post_count, contributor_count, viewed_count)"
+        post_count = viewed_count = 0
+        contributors = set()
+        creators = self.creators
+        view_counts = self.view_counts
+        for post_id in self.get_post_ids(path_collection):
+            if post_id in creators:
+                post_count += 1
+                contributors.add(creators[post_id])
+                viewed_count += view_counts.get(post_id, 0)
+        return (post_count, len(contributors), viewed_count)
+
+
+class DiscussionPostCounts(object):
+    """Post and contributor counts of all ideas of a discussion.
+
+    These do not depend on the user. They are computed in one pass by a
+    :py:class:`PostTreeCounter`, then maintained incrementally as posts
+    are created, using :py:meth:`Idea.get_idea_ids_showing_post`."""
+
+    def __init__(self):
+        self.created = time()
+        # ids of the ideas showing each countable post
+        self.ideas_of_post = {}
+        self.post_counts = defaultdict(int)
+        # number of posts of each contributor, by idea
+        self.contributors = defaultdict(Counter)
+        self.lock = Lock()
+
+    @classmethod
+    def from_paths(cls, tree_counter, post_path_collection):
+        ideas_of_post = defaultdict(list)
+        creators = tree_counter.creators
+        for idea_id, path_collection in \
+                post_path_collection.paths.iteritems():
+            for post_id in tree_counter.get_post_ids(path_collection):
+                if post_id in creators:
+                    ideas_of_post[post_id].append(idea_id)
+        counts = cls()
+        for post_id, idea_ids in ideas_of_post.iteritems():
+            counts._add_post(post_id, creators[post_id], idea_ids)
+        return counts
+
+    def _add_post(self, post_id, creator_id, idea_ids):
+        self.ideas_of_post[post_id] = tuple(idea_ids)
+        for idea_id in idea_ids:
+            self.post_counts[idea_id] += 1
+            self.contributors[idea_id][creator_id] += 1
+
+    def add_post(self, post_id, creator_id, idea_ids):
+        """Count a new post in the given ideas.
+        Returns False if the post was already counted."""
+        with self.lock:
+            if post_id in self.ideas_of_post:
+                return False
+            self._add_post(post_id, creator_id, idea_ids)
+            return True
+
+    def get_counts(self, idea_id):
+        "Return (post_count, contributor_count)"
+        return (self.post_counts.get(idea_id, 0),
+                len(self.contributors.get(idea_id, ())))
+
+    def get_viewed_counts(self, view_counts):
+        "Given view counts by post, return view counts by idea"
+        viewed_counts = defaultdict(int)
+        for post_id, num_views in view_counts.iteritems():
+            for idea_id in self.ideas_of_post.get(post_id, ()):
+                viewed_counts[idea_id] += num_views
+        return viewed_counts
+
+    def drift(self, other):
+        "Ideas whose counts differ: idea_id -> (own counts, other counts)"
+        idea_ids = set(self.post_counts.keys()) | set(other.post_counts.keys())
+        drift = {}
+        for idea_id in idea_ids:
+            counts = self.get_counts(idea_id)
+            other_counts = other.get_counts(idea_id)
+            if counts != other_counts:
+                drift[idea_id] = (counts, other_counts)
+        return drift
+
+
+# Aspects of the discussion structure, which are invalidated separately.
+HIERARCHY = "hierarchy"
+CONTENT_LINKS = "content_links"
+# Changes to existing posts which affect counts
+POSTS = "posts"
+POST_COUNT_ASPECTS = (HIERARCHY, CONTENT_LINKS, POSTS)
+# New and edited posts, which change the keywords of ideas
+TEXTS = "texts"
+KEYWORD_ASPECTS = (HIERARCHY, CONTENT_LINKS, POSTS, TEXTS)
+
+
+class DiscussionStructureCache(object):
+    """Process-wide cache of discussion structure data.
+
+    Entries are keyed by discussion and versioned by change counters,
+    one per aspect of the structure, which are bumped by ORM listeners.
+    The counters are also kept in redis, so changes made by other
+    processes invalidate local entries. Without redis (or if it cannot
+    be reached), entries are only kept ``ttl`` seconds."""
+
+    def __init__(self, redis_url=None, ttl=10):
+        self.local_versions = defaultdict(int)
+        self.entries = {}
+        self.lock = Lock()
+        self.ttl = ttl
+        self.redis = None
+        if redis_url:
+            from redis import StrictRedis
+            self.redis = StrictRedis.from_url(redis_url)
+
+    @staticmethod
+    def redis_key(discussion_id, aspect):
+        return "assembl:structure:%d:%s" % (discussion_id, aspect)
+
+    def version(self, discussion_id, aspect):
+        local_version = self.local_versions[(discussion_id, aspect)]
+        if self.redis is None:
+            return local_version
+        try:
+            shared_version = self.redis.get(
+                self.redis_key(discussion_id, aspect))
+        except Exception:
+            log.exception("Could not read the structure version")
+            return local_version
+        return (local_version, int(shared_version or 0))
+
+    def bump(self, discussion_id, aspect):
+        "Bump the version of an aspect, and return the new version."
+        with self.lock:
+            self.local_versions[(discussion_id, aspect)] += 1
+            local_version = self.local_versions[(discussion_id, aspect)]
+        if self.redis is None:
+            return local_version
+        try:
+            shared_version = self.redis.incr(
+                self.redis_key(discussion_id, aspect))
+        except Exception:
+            log.exception("Could not bump the structure version")
+            return local_version
+        return (local_version, shared_version)
+
+    @staticmethod
+    def is_next_version(version, new_version):
+        "Whether new_version is the result of a single bump of version"
+        if isinstance(version, tuple):
+            return isinstance(new_version, tuple) and all(
+                new == old + 1 for (old, new) in zip(version, new_version))
+        return new_version == version + 1
+
+    def get(self, discussion_id, name, version):
+        entry = self.entries.get((discussion_id, name), None)
+        if entry is None or entry[0] != version:
+            return None
+        # Versions which are not shared may miss changes made elsewhere
+        if (time() - entry[2] > self.ttl and not all(
+                isinstance(aspect_version, tuple)
+                for aspect_version in version)):
+            return None
+        return entry[1]
+
+    def set(self, discussion_id, name, version, data):
+        with self.lock:
+            self.entries[(discussion_id, name)] = (version, data, time())
+
+    def rekey(self, discussion_id, name, version, new_version):
+        """Keep an entry at a new version, if it is still at version"""
+        with self.lock:
+            entry = self.entries.get((discussion_id, name), None)
+            if entry is not None and entry[0] == version:
+                self.entries[(discussion_id, name)] = (
+                    new_version, entry[1], entry[2])
+
+    def clear(self, discussion_id=None):
+        with self.lock:
+            if discussion_id is None:
+                self.entries.clear()
+            else:
+                for key in self.entries.keys():
+                    if key[0] == discussion_id:
+                        del self.entries[key]
+
+
+_structure_cache = None
+
+
+def get_structure_cache():
+    global _structure_cache
+    if _structure_cache is None:
+        broker = config.get('celery_tasks.broker', None) or ''
+        _structure_cache = DiscussionStructureCache(
+            config.get('structure_cache.redis_url', None) or (
+                broker if broker.startswith('redis:') else None),
+            float(config.get('structure_cache.local_ttl', 10)))
+    return _structure_cache
+
+
 class DiscussionGlobalData(object):
-    "Cache for global discussion data, lasts as long as the pyramid request object."
+    """Global discussion data, lasts as long as the pyramid request object.
+
+    The structure data that does not depend on the user is shared
+    between requests through the :py:class:`DiscussionStructureCache`."""
 
     def __init__(self, db, discussion_id, user_id=None, discussion=None):
         self.discussion_id = discussion_id
         self.db = db
         self.user_id = user_id
         self._discussion = discussion
+        self._versions = {}
         self._parent_dict = None
         self._children_dict = None
         self._post_path_collection_raw = None
+        self._post_path_combined = None
+        self._post_counts = None
         self._post_path_counter = None
+        self._keywords = None
 
     @property
     def discussion(self):
@@ -608,26 +912,54 @@ class DiscussionGlobalData(object):
             self._discussion = Discussion.get(self.discussion_id)
         return self._discussion
 
+    def structure_version(self, aspects):
+        """The version of some aspects of the discussion structure,
+        as seen by this request."""
+        for aspect in aspects:
+            if aspect not in self._versions:
+                self._versions[aspect] = get_structure_cache().version(
+                    self.discussion_id, aspect)
+        return tuple(self._versions[aspect] for aspect in aspects)
+
+    def cached_structure(self, name, aspects, builder):
+        if self.db.autoflush and (
+                self.db.new or self.db.dirty or self.db.deleted):
+            # Like a query would, so listeners see pending changes
+            self.db.flush()
+        cache = get_structure_cache()
+        version = self.structure_version(aspects)
+        data = cache.get(self.discussion_id, name, version)
+        if data is None:
+            data = builder()
+            # Do not share data built from uncommitted changes
+            if not self.db.info.get('structure_changes', None):
+                cache.set(self.discussion_id, name, version, data)
+        return data
+
     @property
     def parent_dict(self):
         """dictionary child_idea.id -> parent_idea.id.
 
         TODO: Make it dict(id->id[]) for multiparenting"""
         if self._parent_dict is None:
-            source = aliased(Idea, name="source")
-            target = aliased(Idea, name="target")
-            self._parent_dict = dict(self.db.query(
-                IdeaLink.target_id, IdeaLink.source_id
-                ).join(source, source.id == IdeaLink.source_id
-                ).join(target, target.id == IdeaLink.target_id
-                ).filter(
-                source.discussion_id == self.discussion_id,
-                IdeaLink.tombstone_date == None,  # noqa: E711
-                source.tombstone_date == None,
-                target.tombstone_date == None,
-                target.discussion_id == self.discussion_id))
+            self._parent_dict = self.cached_structure(
+                "parent_dict", (HIERARCHY,), self._load_parent_dict)
         return self._parent_dict
 
+    def _load_parent_dict(self):
+        source = aliased(Idea, name="source")
+        target = aliased(Idea, name="target")
+        return dict(self.db.query(
+            IdeaLink.target_id, IdeaLink.source_id
+            ).join(source, source.id == IdeaLink.source_id
+            ).join(target, target.id == IdeaLink.target_id
+            ).filter(
+            source.discussion_id == self.discussion_id,
+            IdeaLink.tombstone_date == None,  # noqa: E711
+            source.tombstone_date == None,
+            target.tombstone_date == None,
+            target.discussion_id == self.discussion_id))
+
     def idea_ancestry(self, idea_id):
         """generator of ids of ancestor ideas"""
         while idea_id:
@@ -637,41 +969,324 @@ class DiscussionGlobalData(object):
     @property
     def children_dict(self):
         if self._children_dict is None:
-            if not self.parent_dict:
-                (root_id,) = self.db.query(
-                    RootIdea.id).filter_by(
-                    discussion_id=self.discussion_id).first()
-                self._children_dict = {None: (root_id,), root_id: ()}
-                return self._children_dict
-            children = defaultdict(list)
-            for child, parent in self.parent_dict.iteritems():
-                children[parent].append(child)
-            root = set(children.keys()) - set(self.parent_dict.keys())
-            assert len(root) == 1
-            children[None] = [root.pop()]
-            self._children_dict = children
+            self._children_dict = self.cached_structure(
+                "children_dict", (HIERARCHY,), self._build_children_dict)
         return self._children_dict
 
+    def _build_children_dict(self):
+        if not self.parent_dict:
+            (root_id,) = self.db.query(
+                RootIdea.id).filter_by(
+                discussion_id=self.discussion_id).first()
+            return {None: (root_id,), root_id: ()}
+        children = defaultdict(list)
+        for child, parent in self.parent_dict.iteritems():
+            children[parent].append(child)
+        root = set(children.keys()) - set(self.parent_dict.keys())
+        assert len(root) == 1
+        children[None] = [root.pop()]
+        return children
+
     @property
     def post_path_collection_raw(self):
         if self._post_path_collection_raw is None:
-            self._post_path_collection_raw = PostPathGlobalCollection(self.discussion)
+            self._post_path_collection_raw = self.cached_structure(
+                "post_path_collection_raw", (CONTENT_LINKS,),
+                self._load_post_path_collection)
         return self._post_path_collection_raw
 
+    def _load_post_path_collection(self):
+        collection = PostPathGlobalCollection(self.discussion)
+        # Do not keep the session-bound discussion in the shared cache
+        collection.discussion = None
+        return collection
+
+    @property
+    def post_path_combined(self):
+        """The post paths of each idea, combined with those of its
+        descendants. Shared between requests; do not modify."""
+        if self._post_path_combined is None:
+            self._post_path_combined = self.cached_structure(
+                "post_path_combined", (HIERARCHY, CONTENT_LINKS),
+                self._combine_post_paths)
+        return self._post_path_combined
+
+    def _combine_post_paths(self):
+        combiner = PostPathCombiner(None)
+        combiner.init_from(self.post_path_collection_raw, self.discussion)
+        Idea.visit_idea_ids_depth_first(
+            combiner, self.discussion_id, self.children_dict)
+        combiner.discussion = None
+        return combiner
+
+    @property
+    def post_counts(self):
+        """The post counts of all ideas, shared between requests.
+        They are reconciled with a full recount periodically."""
+        if self._post_counts is None:
+            post_counts = self.cached_structure(
+                "post_counts", POST_COUNT_ASPECTS, self._build_post_counts)
+            interval = float(config.get(
+                'structure_cache.reconcile_interval', 3600))
+            if time() - post_counts.created > interval:
+                post_counts = self.reconcile_post_counts(post_counts)
+            self._post_counts = post_counts
+        return self._post_counts
+
+    def _build_post_counts(self):
+        tree_counter = PostTreeCounter(self.db, self.discussion_id)
+        return DiscussionPostCounts.from_paths(
+            tree_counter, self.post_path_combined)
+
+    def reconcile_post_counts(self, post_counts=None):
+        """Recount all posts, and replace the shared post counts.
+        Drift from the incrementally maintained counts is logged."""
+        cache = get_structure_cache()
+        version = self.structure_version(POST_COUNT_ASPECTS)
+        if post_counts is None:
+            post_counts = cache.get(
+                self.discussion_id, "post_counts", version)
+        new_counts = self._build_post_counts()
+        if post_counts is not None:
+            drift = post_counts.drift(new_counts)
+            if drift:
+                log.warning(
+                    "Post counts of discussion %d drifted for ideas: %s" % (
+                        self.discussion_id, drift))
+        if not self.db.info.get('structure_changes', None):
+            cache.set(self.discussion_id, "post_counts", version, new_counts)
+        self._post_counts = new_counts
+        return new_counts
+
     def post_path_counter(self, user_id, calc_all):
         if (self._post_path_counter is None or not isinstance(self._post_path_counter, PostPathCounter)):
             counter = PostPathCounter(
-                self.discussion, user_id, None if calc_all else ())
-            counter.init_from(self.post_path_collection_raw)
-            self.discussion.root_idea.visit_ideas_depth_first(counter)
+                None, user_id, None if calc_all else (),
+                lambda: self.post_counts)
+            counter.init_from(self.post_path_combined, self.discussion)
             self._post_path_counter = counter
+        if calc_all and not self._post_path_counter.counted_all:
+            self._post_path_counter.calc_all_counts()
         return self._post_path_counter
 
+    @property
+    def keywords(self):
+        """Most common words of ideas, by (idea_id, langs, num).
+        Shared between requests, and filled as they are computed."""
+        if self._keywords is None:
+            self._keywords = self.cached_structure(
+                "keywords", KEYWORD_ASPECTS, dict)
+        return self._keywords
+
     def reset_hierarchy(self):
+        self._versions.pop(HIERARCHY, None)
         self._parent_dict = None
         self._children_dict = None
+        self._post_path_combined = None
+        self._post_counts = None
         self._post_path_counter = None
+        self._keywords = None
 
     def reset_content_links(self):
+        self._versions.pop(CONTENT_LINKS, None)
         self._post_path_collection_raw = None
+        self._post_path_combined = None
+        self._post_counts = None
         self._post_path_counter = None
+        self._keywords = None
+
+    def reset_counts(self):
+        self._versions.pop(POSTS, None)
+        self._post_counts = None
+        self._post_path_counter = None
+        self._keywords = None
+
+    def reset_texts(self):
+        self._versions.pop(TEXTS, None)
+        self._keywords = None
+
+    def reset(self, aspect=None):
+        if aspect == HIERARCHY:
+            self.reset_hierarchy()
+        elif aspect == CONTENT_LINKS:
+            self.reset_content_links()
+        elif aspect == TEXTS:
+            self.reset_texts()
+        else:
+            self.reset_counts()
+
+
+def structure_changed(target, discussion_id, aspect=None):
+    """Invalidate an aspect of a discussion's structure.
+
+    The change counter is bumped right away for this process, and again
+    when the transaction ends, so data built from uncommitted changes
+    is not reused. Without an aspect, only the counts of the current
+    request are invalidated."""
+    if aspect is not None:
+        get_structure_cache().bump(discussion_id, aspect)
+    session = object_session(target)
+    if session is not None:
+        # Also marks the session as having uncommitted changes
+        session.info.setdefault('structure_changes', set()).add(
+            (discussion_id, aspect))
+    from pyramid.threadlocal import get_current_request
+    req = get_current_request()
+    discussion_data = getattr(req, "discussion_data", None)
+    if discussion_data is not None and \
+            discussion_data.discussion_id == discussion_id:
+        discussion_data.reset(aspect)
+
+
+def _attributes_changed(target, *names):
+    attrs = inspect(target).attrs
+    return any(attrs[name].history.has_changes() for name in names)
+
+
+@event.listens_for(IdeaLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaLink, 'after_update', propagate=True)
+@event.listens_for(IdeaLink, 'after_delete', propagate=True)
+def idea_link_changed(mapper, connection, target):
+    structure_changed(target, target.get_discussion_id(), HIERARCHY)
+
+
+@event.listens_for(Idea, 'after_insert', propagate=True)
+@event.listens_for(Idea, 'after_delete', propagate=True)
+def idea_changed(mapper, connection, target):
+    structure_changed(target, target.get_discussion_id(), HIERARCHY)
+
+
+@event.listens_for(Idea, 'after_update', propagate=True)
+def idea_updated(mapper, connection, target):
+    # Only tombstoning changes the hierarchy
+    if _attributes_changed(target, 'tombstone_date'):
+        structure_changed(target, target.get_discussion_id(), HIERARCHY)
+    if _attributes_changed(
+            target, 'title_id', 'description_id', 'synthesis_title_id'):
+        structure_changed(target, target.get_discussion_id(), TEXTS)
+
+
+@event.listens_for(LangStringEntry, 'after_insert', propagate=True)
+@event.listens_for(LangStringEntry, 'after_update', propagate=True)
+@event.listens_for(LangStringEntry, 'after_delete', propagate=True)
+def langstring_entry_changed(mapper, connection, target):
+    # The titles and definitions of ideas are counted in their keywords
+    owner = getattr(target.langstring, 'owner_object', None)
+    if isinstance(owner, Idea):
+        discussion_id = owner.discussion_id
+    elif owner is None:
+        idea = Idea.__table__
+        discussion_id = connection.execute(select(
+            [idea.c.discussion_id]).where(
+            (idea.c.title_id == target.langstring_id) |
+            (idea.c.description_id == target.langstring_id) |
+            (idea.c.synthesis_title_id == target.langstring_id)
+            ).limit(1)).scalar()
+    else:
+        return
+    if discussion_id:
+        structure_changed(target, discussion_id, TEXTS)
+
+
+@event.listens_for(IdeaContentLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaContentLink, 'after_update', propagate=True)
+@event.listens_for(IdeaContentLink, 'after_delete', propagate=True)
+def idea_content_link_changed(mapper, connection, target):
+    structure_changed(target, target.get_discussion_id(), CONTENT_LINKS)
+
+
+@event.listens_for(Post, 'after_insert', propagate=True)
+def post_created(mapper, connection, target):
+    # A new post does not change paths, only counts, which are updated
+    # incrementally at commit; other processes recount them.
+    discussion_id = target.get_discussion_id()
+    structure_changed(target, discussion_id)
+    structure_changed(target, discussion_id, TEXTS)
+    object_session(target).info.setdefault('new_posts', {})[target.id] = \
+        discussion_id
+
+
+@event.listens_for(Post, 'after_update', propagate=True)
+def post_updated(mapper, connection, target):
+    discussion_id = target.get_discussion_id()
+    if target.id in object_session(target).info.get('new_posts', ()):
+        # Setting the parent of a new post does not change paths
+        structure_changed(target, discussion_id)
+    elif _attributes_changed(target, 'ancestry', 'hidden'):
+        structure_changed(target, discussion_id, CONTENT_LINKS)
+    elif _attributes_changed(target, 'publication_state', 'creator_id'):
+        structure_changed(target, discussion_id, POSTS)
+    else:
+        structure_changed(target, discussion_id)
+    if _attributes_changed(target, 'modification_date'):
+        structure_changed(target, discussion_id, TEXTS)
+
+
+@event.listens_for(Post, 'after_delete', propagate=True)
+def post_deleted(mapper, connection, target):
+    structure_changed(target, target.get_discussion_id(), CONTENT_LINKS)
+
+
+@event.listens_for(Session, 'before_commit')
+def structure_before_commit(session):
+    """Find the ideas showing new posts, while we can still query.
+    Only needed if the discussion's post counts are already cached."""
+    if not session.info.get('new_posts', None):
+        return
+    session.flush()
+    cache = get_structure_cache()
+    increments = session.info.setdefault('post_count_increments', [])
+    changes = session.info.setdefault('structure_changes', set())
+    for post_id, discussion_id in session.info.pop('new_posts').iteritems():
+        # Bumped at the end of the transaction, for all processes
+        changes.add((discussion_id, POSTS))
+        version = tuple(cache.version(discussion_id, aspect)
+                        for aspect in POST_COUNT_ASPECTS)
+        post_counts = cache.get(discussion_id, "post_counts", version)
+        if post_counts is None:
+            continue
+        post = session.query(Post).get(post_id)
+        if post is None or post.hidden or (
+                post.publication_state not in countable_publication_states):
+            continue
+        increments.append((discussion_id, version, post_counts, post_id,
+                           post.creator_id,
+                           Idea.get_idea_ids_showing_post(post_id)))
+
+
+def _end_of_transaction(session, committed):
+    session.info.pop('new_posts', None)
+    increments = session.info.pop('post_count_increments', None)
+    changes = session.info.pop('structure_changes', None)
+    cache = get_structure_cache()
+    new_versions = {}
+    if changes:
+        for (discussion_id, aspect) in changes:
+            if aspect is not None:
+                new_versions[(discussion_id, aspect)] = cache.bump(
+                    discussion_id, aspect)
+    if committed and increments:
+        for (discussion_id, version, post_counts, post_id, creator_id,
+                idea_ids) in increments:
+            post_counts.add_post(post_id, creator_id, idea_ids)
+        # Keep the incremented counts in this process, unless posts
+        # were added by another process meanwhile.
+        for (discussion_id, version) in set(
+                (increment[0], increment[1]) for increment in increments):
+            posts_version = version[POST_COUNT_ASPECTS.index(POSTS)]
+            new_posts_version = new_versions.get((discussion_id, POSTS))
+            if cache.is_next_version(posts_version, new_posts_version):
+                cache.rekey(discussion_id, "post_counts", version, tuple(
+                    new_posts_version if aspect == POSTS else aspect_version
+                    for (aspect, aspect_version)
+                    in zip(POST_COUNT_ASPECTS, version)))
+
+
+@event.listens_for(Session, 'after_commit')
+def structure_after_commit(session):
+    _end_of_transaction(session, True)
+
+
+@event.listens_for(Session, 'after_rollback')
+def structure_after_rollback(session):
+    _end_of_transaction(session, False)
@@ -28,7 +28,7 @@ from ..lib.sqla import CrudOperation
 from ..lib.decl_enums import DeclEnum
 from ..lib.sqla_types import CoerceUnicode
 from .generic import Content, ContentSource
-from .auth import AgentProfile
+from .auth import AgentProfile, participant_added, track_participation
 from ..lib import config
 from .langstrings import LangString, LangStringEntry
 from assembl.views.traversal import AbstractCollectionDefinition
@@ -566,12 +566,11 @@ def orm_insert_listener(mapper, connection, target):
     isn't otherwise linked to the table of idea """
     if target.discussion.root_idea:
         target.discussion.root_idea.send_to_changes(connection)
-    # Check if this is the first post by this user in the discussion.
-    # In which case, tell the discussion about this new participant,
-    # which was not in Discussion.get_participants_query originally.
-    if target.db.query(Post).filter_by(
-            creator_id=target.creator_id,
-            discussion_id=target.discussion_id).count() <= 1:
+    # Record the creator as a participant. If this is their first
+    # contribution to the discussion, tell the discussion about this
+    # new participant, which was not in Discussion.get_participants_query.
+    if participant_added(
+            connection, target.discussion_id, target.creator_id):
         creator = target.creator or AgentProfile.get(target.creator_id)
         creator.send_to_changes(connection, CrudOperation.UPDATE, target.discussion_id)
     # Eagerly translate the post
@@ -582,6 +581,7 @@ def orm_insert_listener(mapper, connection, target):
 
 
 event.listen(Post, 'after_insert', orm_insert_listener, propagate=True)
+track_participation(Post, 'creator_id', on_insert=False)
 
 
 class AssemblPost(Post):
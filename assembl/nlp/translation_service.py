@@ -3,8 +3,10 @@ from abc import abstractmethod
 import urllib2
 from traceback import print_exc
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from hashlib import sha1
 from math import log
+from threading import Lock
 
 import simplejson as json
 from langdetect.detector_factory import init_factory
@@ -19,6 +21,7 @@ from assembl.lib.clean_input import unescape
 from assembl.models.langstrings import (
     Locale, LangString, LangStringEntry, LocaleLabel)
 from assembl.lib.locale import strip_country
+from assembl.lib.utils import full_class_name
 
 
 _ = TranslationStringFactory('assembl')
@@ -41,6 +44,80 @@ class LangStringStatus(OrderedEnum):
     TOO_MANY_TRANSIENTS = 15
 
 
+class TranslationCache(object):
+    """Cache of machine translations, shared by all discussions.
+
+    Translations are keyed by a hash of the text and of the translation
+    parameters, so a given text is only sent once to a translation service.
+    If a redis url is given, the cache is shared by all processes."""
+
+    def __init__(self, redis_url=None, max_entries=10000, ttl=30 * 86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = Lock()
+        # key -> (translation, source locale), least recently used first
+        self.entries = OrderedDict()
+        self.redis = None
+        if redis_url:
+            from redis import StrictRedis
+            self.redis = StrictRedis.from_url(redis_url)
+
+    @staticmethod
+    def key(service_name, text, target, is_html=False, source=None):
+        data = u"\x00".join((
+            service_name, source or u'', target,
+            u'html' if is_html else u'text', text))
+        return "assembl:translation:" + sha1(data.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        "The cached translations of those keys, as a dict"
+        if self.redis is not None:
+            values = self.redis.mget(keys) if keys else ()
+            return {key: tuple(json.loads(value))
+                    for (key, value) in zip(keys, values)
+                    if value is not None}
+        result = {}
+        with self.lock:
+            for key in keys:
+                value = self.entries.pop(key, None)
+                if value is not None:
+                    self.entries[key] = value
+                    result[key] = value
+        return result
+
+    def set_many(self, translations):
+        if not translations:
+            return
+        if self.redis is not None:
+            pipeline = self.redis.pipeline(transaction=False)
+            for (key, value) in translations.iteritems():
+                pipeline.setex(key, self.ttl, json.dumps(value))
+            pipeline.execute()
+            return
+        with self.lock:
+            for (key, value) in translations.iteritems():
+                self.entries.pop(key, None)
+                self.entries[key] = tuple(value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_translation_cache = None
+
+
+def get_translation_cache():
+    global _translation_cache
+    if _translation_cache is None:
+        _translation_cache = TranslationCache(
+            config.get('translation_cache.redis_url', None),
+            int(config.get('translation_cache.max_entries', None) or 10000))
+    return _translation_cache
+
+
 class LanguageIdentificationService(object):
     canTranslate = None
 
@@ -206,6 +283,40 @@ class AbstractTranslationService(LanguageIdentificationService):
             source = Locale.get_or_create(source, db)
         return text, lang
 
+    # Maximum number of texts given at once to translate_many
+    max_batch_size = 100
+
+    def translate_many(
+            self, texts, target, is_html=False, source=None, db=None):
+        """Translate texts which have the same source and target locales.
+        Returns a list of (translation, source locale) pairs, as translate.
+        Services which can translate many texts in one call override this."""
+        return [self.translate(text, target, is_html, source=source, db=db)
+                for text in texts]
+
+    def cached_translate_many(
+            self, texts, target, is_html=False, source=None, db=None):
+        """translate_many, through the translation cache.
+        Texts which are not cached are translated in batches."""
+        cache = get_translation_cache()
+        service_name = full_class_name(self)
+        keys = [cache.key(service_name, text, target, is_html, source)
+                if text else None for text in texts]
+        results = cache.get_many([key for key in keys if key])
+        missing = OrderedDict(
+            (key, text) for (key, text) in zip(keys, texts)
+            if key and key not in results)
+        missing_keys = missing.keys()
+        for i in range(0, len(missing_keys), self.max_batch_size):
+            batch = missing_keys[i:i + self.max_batch_size]
+            translations = dict(zip(batch, self.translate_many(
+                [missing[key] for key in batch], target, is_html,
+                source=source, db=db)))
+            cache.set_many(translations)
+            results.update(translations)
+        return [results[key] if key else (text, Locale.NON_LINGUISTIC)
+                for (key, text) in zip(keys, texts)]
+
     def get_mt_name(self, source_name, target_name):
         return Locale.create_mt_code(source_name, target_name)
 
@@ -255,8 +366,8 @@ class AbstractTranslationService(LanguageIdentificationService):
             is_new_lse = True
         if self.canTranslate(source_locale, target.code):
             try:
-                trans, lang = self.translate(
-                    source_lse.value,
+                [(trans, lang)] = self.cached_translate_many(
+                    [source_lse.value],
                     target.code,
                     is_html,
                     source=source_locale if source_locale != Locale.UNDEFINED
@@ -549,6 +660,24 @@ class GoogleTranslationService(DummyGoogleTranslationService):
         translated = self.unescape_string(translated, is_html)
         return translated, source
 
+    def translate_many(
+            self, texts, target, is_html=False, source=None, db=None):
+        if not self.client:
+            return super(GoogleTranslationService, self).translate_many(
+                texts, target, is_html, source=source, db=db)
+        r = self.client.translations().list(
+            q=list(texts),
+            format="html" if is_html else "text",
+            target=self.asKnownLocale(target),
+            source=self.asKnownLocale(source) if source else None).execute()
+        results = []
+        for translation in r[u"translations"]:
+            results.append((
+                self.unescape_string(translation[u'translatedText'], is_html),
+                source or self.asPosixLocale(
+                    translation[u'detectedSourceLanguage'])))
+        return results
+
     def decode_exception(self, exception, identify_phase=False):
         from googleapiclient.http import HttpError
         import socket
@@ -56,6 +56,17 @@ class WordCounter(defaultdict):
         stemmed = self.stemmer.stemWord(word.lower())
         self[stemmed].add(word, weight)
 
+    def as_vector(self):
+        """The sparse term vector of the counted words, as a
+        JSON-friendly dict: stem -> [weight, shortest word]"""
+        return {stem: [words.counter, words.shortest()]
+                for (stem, words) in self.iteritems()}
+
+    def add_vector(self, vector):
+        "Add a term vector given by :py:meth:`as_vector`"
+        for stem, (weight, word) in vector.iteritems():
+            self[stem].add(word, weight)
+
     def best(self, num=10):
         all_words = self.values()
         all_words.sort(key=lambda x: x.counter, reverse=True)
@@ -0,0 +1,84 @@
+"""Benchmark the fan-out of changes to many browser connections.
+
+Simulates connections to a single discussion, and compares filtering
+private entries for each connection (as each connection used to have its
+own subscription) to the shared :py:class:`ChangesFanout`."""
+import argparse
+from time import time
+
+import simplejson as json
+
+from assembl.lib.changes_fanout import ChangesFanout
+
+
+class FakeConnection(object):
+    def __init__(self, discussion, user_id):
+        self.discussion = discussion
+        self.userId = user_id
+
+
+def make_message(num_entries, private_users):
+    entries = [{"@id": "local:Post/%d" % i, "@type": "Post",
+                "body": "x" * 200} for i in range(num_entries)]
+    for n, user_id in enumerate(private_users):
+        entries.append({"@id": "local:AgentProfile/%d" % n,
+                        "@private": user_id, "@type": "User"})
+    return json.dumps(entries)
+
+
+def per_connection(connections, data):
+    sent = 0
+    for connection in connections:
+        message = data
+        if '@private' in data:
+            entries = [x for x in json.loads(data)
+                       if x.get('@private', connection.userId) ==
+                       connection.userId]
+            if not entries:
+                continue
+            message = json.dumps(entries)
+        sent += len(message)
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sessions", type=int, default=5000,
+                        help="number of simulated sessions")
+    parser.add_argument("-m", "--messages", type=int, default=100,
+                        help="number of messages")
+    parser.add_argument("-e", "--entries", type=int, default=5,
+                        help="number of entries per message")
+    args = parser.parse_args()
+    connections = [FakeConnection("1", "local:AgentProfile/%d" % n)
+                   for n in range(args.sessions)]
+    public_message = make_message(args.entries, [])
+    private_message = make_message(args.entries, [connections[0].userId])
+    sent = [0]
+
+    def broadcast(targets, message):
+        # sockjs encodes the message once, then writes it to each session
+        for target in targets:
+            sent[0] += len(message)
+
+    fanout = ChangesFanout(lambda d: None, lambda d: None, broadcast)
+    for connection in connections:
+        fanout.add(connection)
+    for name, message in (("public", public_message),
+                          ("private", private_message)):
+        start = time()
+        for i in range(args.messages):
+            per_connection(connections, message)
+        before = time() - start
+        start = time()
+        for i in range(args.messages):
+            fanout.on_recv(["1", str(i), message])
+        after = time() - start
+        print "%s: %d messages to %d sessions, per connection %.3fs, "\
+            "fan-out %.3fs (x%.1f)" % (
+                name, args.messages, args.sessions, before, after,
+                before / max(after, 1e-6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Benchmark generic_json serialization of posts.
+
+Compares serialization with a freshly compiled plan for every object
+(the cost of introspecting the mapper on each call, as before plans
+were cached) to serialization with the cached plans."""
+import argparse
+from itertools import cycle, islice
+from time import time
+
+from sqlalchemy.orm import joinedload
+
+from assembl.lib import sqla
+from assembl.scripts import boostrap_configuration
+
+
+def serialize(posts, view_def, cached):
+    start = time()
+    for post in posts:
+        if not cached:
+            sqla._json_plans.clear()
+        post.generic_json(view_def)
+    return time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("-d", "--discussion", default=None,
+                        help="slug of discussion to take posts from")
+    parser.add_argument("-n", "--num-posts", type=int, default=10000,
+                        help="number of posts to serialize")
+    parser.add_argument("-v", "--view-def", action="append",
+                        help="view_defs to benchmark (default and changes)")
+    args = parser.parse_args()
+    session = boostrap_configuration(args.configuration)
+    from assembl.models import Post, Discussion
+    posts = session.query(Post).options(
+        joinedload(Post.creator), joinedload(Post.body),
+        joinedload(Post.subject))
+    if args.discussion:
+        (discussion_id,) = session.query(Discussion.id).filter_by(
+            slug=args.discussion).first()
+        posts = posts.filter_by(discussion_id=discussion_id)
+    posts = posts.limit(args.num_posts).all()
+    assert posts, "No posts to serialize"
+    # reuse posts if there are fewer than requested
+    posts = list(islice(cycle(posts), args.num_posts))
+    for view_def in args.view_def or ('default', 'changes'):
+        # warm up the session and view_def caches
+        serialize(posts[:10], view_def, True)
+        uncached = serialize(posts, view_def, False)
+        cached = serialize(posts, view_def, True)
+        print "%s: %d posts, uncompiled %.3fs, compiled %.3fs (x%.1f)" % (
+            view_def, len(posts), uncached, cached, uncached / cached)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Benchmark visits of the idea tree.
+
+Compares the former recursive depth-first visit, which prefetched every
+idea of the discussion, with the iterative visits of IdeaTree, over ids
+and over ideas fetched in batches. A synthetic tree of ideas is added
+under the root idea of a discussion, and rolled back at the end."""
+import argparse
+import random
+import sys
+from time import time
+
+import transaction
+
+from assembl.scripts import boostrap_configuration
+
+
+def add_ideas(db, discussion, num_ideas, max_children, chunk_size=1000):
+    """Add a random tree of ideas under the root idea"""
+    from assembl.models import Idea, IdeaLink, LangString
+    start = time()
+    root_id = discussion.root_idea.id
+    discussion_id = discussion.id
+    parent_ids = [root_id]
+    ideas = []
+    for i in range(num_ideas):
+        parent_id = random.choice(parent_ids[-max_children:])
+        idea = Idea(discussion_id=discussion_id,
+                    title=LangString.create(u"Idea %d" % i, 'en'))
+        db.add(idea)
+        ideas.append((idea, parent_id))
+        if len(ideas) == chunk_size or i == num_ideas - 1:
+            db.flush()
+            for (order, (idea, parent_id)) in enumerate(ideas):
+                db.add(IdeaLink(source_id=parent_id, target_id=idea.id,
+                                order=float(order)))
+                parent_ids.append(idea.id)
+            db.flush()
+            ideas = []
+    db.expunge_all()
+    print "added %d ideas in %.1fs" % (num_ideas, time() - start)
+
+
+def recursive_visit(idea, idea_visitor, children_dict, level=0, prev_result=None):
+    "The former recursive visit, for reference"
+    from assembl.models.idea import IdeaVisitor
+    result = idea_visitor.visit_idea(idea, level, prev_result)
+    child_results = []
+    if result is not IdeaVisitor.CUT_VISIT:
+        for child in children_dict.get(idea.id, ()):
+            r = recursive_visit(
+                child, idea_visitor, children_dict, level + 1, result)
+            if r:
+                child_results.append((child, r))
+    return idea_visitor.end_visit(idea, level, result, child_results)
+
+
+def prefetched_recursive_visit(db, discussion_id, root_id, idea_visitor):
+    from assembl.models import Idea
+    ideas = db.query(Idea).filter_by(
+        discussion_id=discussion_id, tombstone_date=None).all()
+    ideas_by_id = {idea.id: idea for idea in ideas}
+    children_dict = {
+        id: [ideas_by_id[child_id] for child_id in child_ids]
+        for (id, child_ids) in Idea.children_dict(discussion_id).iteritems()}
+    return recursive_visit(ideas_by_id[root_id], idea_visitor, children_dict)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("discussion", help="slug of the discussion")
+    parser.add_argument("-n", "--num-ideas", type=int, default=20000,
+                        help="number of ideas to add")
+    parser.add_argument("-c", "--max-children", type=int, default=10,
+                        help="ideas are added under one of the last "
+                        "N ideas; lower values give deeper trees")
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    from assembl.models import Discussion, Idea
+    from assembl.models.idea import AppendingVisitor, IdeaTree
+    # The recursive visit needs a frame per level
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 4 * args.num_ideas))
+    transaction.begin()
+    try:
+        discussion = db.query(Discussion).filter_by(slug=args.discussion).one()
+        discussion_id = discussion.id
+        add_ideas(db, discussion, args.num_ideas, args.max_children)
+        children_dict = Idea.children_dict(discussion_id)
+        root_id = children_dict[None][0]
+        start = time()
+        tree = IdeaTree(children_dict)
+        print "tree of %d ideas, depth %d, built in %.3fs" % (
+            len(tree), max(tree.levels), time() - start)
+        results = {}
+        for name, visit in (
+                ("recursive, prefetched ideas",
+                 lambda: prefetched_recursive_visit(
+                     db, discussion_id, root_id, AppendingVisitor())),
+                ("iterative, ideas in batches",
+                 lambda: Idea.get(root_id).visit_ideas_depth_first(
+                     AppendingVisitor())),
+                ("iterative, ids",
+                 lambda: Idea.visit_idea_ids_depth_first(
+                     AppendingVisitor(), discussion_id, children_dict))):
+            db.expunge_all()
+            start = time()
+            visited = visit()
+            print "%s: visited %d ideas in %.3fs" % (
+                name, len(visited), time() - start)
+            results[name] = [getattr(idea, 'id', idea) for idea in visited]
+        assert len(set(map(tuple, results.values()))) == 1, \
+            "visits do not give the same order"
+    finally:
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Benchmark matching of notification subscriptions on post creation.
+
+Adds temporary participants following all messages of a discussion, then
+compares matching subscriptions in python (instanciating every active
+subscription and checking it, as before matching was done in SQL) to the
+set-based SQL query. Everything is rolled back at the end."""
+import argparse
+from collections import defaultdict
+from time import time
+
+import transaction
+
+from assembl.scripts import boostrap_configuration
+
+
+def python_matching(db, discussion_id, post):
+    from assembl.lib.utils import get_concrete_subclasses_recursive
+    from assembl.models import NotificationSubscription
+    from assembl.models.notification import (
+        CrudVerbs, NotificationSubscriptionStatus)
+    by_user = defaultdict(list)
+    for cls in get_concrete_subclasses_recursive(NotificationSubscription):
+        for subscription in db.query(cls).filter(
+                cls.status == NotificationSubscriptionStatus.ACTIVE,
+                cls.discussion_id == discussion_id):
+            if subscription.wouldCreateNotification(
+                    discussion_id, CrudVerbs.CREATE, post):
+                by_user[subscription.user_id].append(subscription)
+    return {user_id: min(subscriptions, key=lambda s: s.priority).id
+            for (user_id, subscriptions) in by_user.iteritems()}
+
+
+def sql_matching(db, discussion_id, post):
+    from assembl.models import NotificationSubscription
+    from assembl.models.notification import CrudVerbs
+    query = NotificationSubscription.first_applicable_query(
+        discussion_id, CrudVerbs.CREATE, post)
+    return {user_id: id for (user_id, id, type, priority) in query}
+
+
+def add_subscribers(db, discussion, num_subscribers, chunk_size=1000):
+    from assembl.auth import R_PARTICIPANT
+    from assembl.models import (
+        User, LocalUserRole, Role, NotificationCreationOrigin,
+        NotificationSubscriptionFollowAllMessages)
+    role = db.query(Role).filter_by(name=R_PARTICIPANT).one()
+    start = time()
+    for i in range(num_subscribers):
+        user = User(name=u"Benchmark subscriber %d" % i)
+        db.add(user)
+        db.add(LocalUserRole(user=user, role=role, discussion=discussion))
+        db.add(NotificationSubscriptionFollowAllMessages(
+            discussion=discussion, user=user,
+            creation_origin=NotificationCreationOrigin.USER_REQUESTED))
+        if i % chunk_size == chunk_size - 1:
+            db.flush()
+            db.expunge_all()
+            discussion = db.merge(discussion, load=False)
+            role = db.merge(role, load=False)
+    db.flush()
+    db.expunge_all()
+    print "added %d subscribers in %.1fs" % (num_subscribers, time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("discussion", help="slug of the discussion")
+    parser.add_argument("-n", "--num-subscribers", type=int, default=50000,
+                        help="number of subscribers to add")
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    from assembl.models import Discussion, Post
+    transaction.begin()
+    try:
+        discussion = db.query(Discussion).filter_by(slug=args.discussion).one()
+        discussion_id = discussion.id
+        add_subscribers(db, discussion, args.num_subscribers)
+        post_id = db.query(Post.id).filter_by(
+            discussion_id=discussion_id).order_by(Post.id.desc()).first()[0]
+        results = {}
+        for name, matching in (
+                ("python", python_matching), ("sql", sql_matching)):
+            db.expunge_all()
+            post = db.query(Post).get(post_id)
+            start = time()
+            results[name] = matching(db, discussion_id, post)
+            print "%s: %d subscriptions matched in %.3fs" % (
+                name, len(results[name]), time() - start)
+        assert set(results["python"]) == set(results["sql"]), \
+            "python and sql matching notify different users"
+    finally:
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
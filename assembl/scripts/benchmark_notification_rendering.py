@@ -0,0 +1,58 @@
+"""Benchmark rendering of post notification emails.
+
+Compares rendering with empty caches for every notification (reading
+stylesheets, building localizers and inlining CSS each time, as before
+rendering was cached) to rendering with the caches of the process."""
+import argparse
+from itertools import cycle, islice
+from time import time
+
+from assembl.scripts import boostrap_configuration
+
+
+def render(notifications, cached):
+    from assembl.models import Notification
+    Notification.clear_render_caches()
+    start = time()
+    for notification in notifications:
+        if not cached:
+            Notification.clear_render_caches()
+        notification.render_to_email_html_part()
+    return time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("-d", "--discussion", default=None,
+                        help="slug of discussion to take notifications from")
+    parser.add_argument("-n", "--num-notifications", type=int, default=1000,
+                        help="number of notifications to render")
+    args = parser.parse_args()
+    session = boostrap_configuration(args.configuration)
+    from assembl.models import (
+        Discussion, NotificationOnPostCreated, NotificationSubscription)
+    notifications = session.query(NotificationOnPostCreated)
+    if args.discussion:
+        (discussion_id,) = session.query(Discussion.id).filter_by(
+            slug=args.discussion).first()
+        notifications = notifications.join(
+            NotificationOnPostCreated.first_matching_subscription).filter(
+            NotificationSubscription.discussion_id == discussion_id)
+    notifications = notifications.order_by(
+        NotificationOnPostCreated.id.desc()).limit(
+        args.num_notifications).all()
+    assert notifications, "No notifications to render"
+    # reuse notifications if there are fewer than requested
+    notifications = list(
+        islice(cycle(notifications), args.num_notifications))
+    # warm up the session
+    render(notifications[:10], True)
+    uncached = render(notifications, False)
+    cached = render(notifications, True)
+    print "%d notifications, uncached %.3fs, cached %.3fs (x%.1f)" % (
+        len(notifications), uncached, cached, uncached / cached)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 import argparse
 
 import transaction
-from sqlalchemy.orm import undefer
 
 from assembl.lib.sqla import mark_changed
 from assembl.lib.antivirus import get_antivirus
@@ -33,12 +32,14 @@ def main():
                 File.av_checked: AntiVirusStatus.unchecked.name})
             mark_changed(session)
     with transaction.manager:
-        file_ids = files.with_entities(File.id).all()
-    for file_id in file_ids:
+        file_identities = [identity for (identity,) in files.filter(
+            File.av_checked == AntiVirusStatus.unchecked.name,
+            File.file_identity != None  # noqa: E711
+            ).with_entities(File.file_identity).distinct()]
+    # Files with the same content are checked once
+    for file_identity in file_identities:
         with transaction.manager:
-            file_obj = session.query(File).options(undefer(File.data)).get(file_id)
-            file_obj.ensure_virus_checked(antivirus)
-
+            File.virus_check_identity(session, file_identity, antivirus)
 
 if __name__ == '__main__':
     main()
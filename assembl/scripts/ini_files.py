@@ -36,21 +36,24 @@ RANDOM_FILE = 'random.ini'
 DEFAULTS = {
     # Define either the first or all others.
     'celery_tasks.broker': '',
+    'celery_tasks.antivirus.broker': '',
     'celery_tasks.imap.broker': '',
     'celery_tasks.notification_dispatch.broker': '',
     'celery_tasks.notify.broker': '',
     'celery_tasks.translate.broker': '',
     # num_workers: These are production values
+    'celery_tasks.antivirus.num_workers': '2',
     'celery_tasks.imap.num_workers': '1',
     'celery_tasks.notification_dispatch.num_workers': '1',
     'celery_tasks.notify.num_workers': '2',
     'celery_tasks.translate.num_workers': '2',
     # Sensible defaults
+    'autostart_celery_antivirus': 'true',
     'autostart_celery_imap': 'false',
     'autostart_celery_notification_dispatch': 'true',
     'autostart_celery_notify': 'true',
     'autostart_celery_notify_beat': 'true',
-    'autostart_celery_translate': 'false',
+    'autostart_celery_translate': 'true',
     'autostart_source_reader': 'true',
     'autostart_changes_router': 'true',
     'autostart_pserve': 'false',
@@ -107,6 +110,8 @@ def generate_ini_files(config, config_fname):
         edgesense_code_dir = ''
     default_celery_broker = config.get(
         SECTION, 'celery_tasks.broker')
+    antivirus_celery_broker = config.get(
+        SECTION, 'celery_tasks.antivirus.broker') or default_celery_broker
     imap_celery_broker = config.get(
         SECTION, 'celery_tasks.imap.broker') or default_celery_broker
     notif_dispatch_celery_broker = config.get(
@@ -116,7 +121,7 @@ def generate_ini_files(config, config_fname):
         SECTION, 'celery_tasks.notify.broker') or default_celery_broker
     translate_celery_broker = config.get(
         SECTION, 'celery_tasks.translate.broker') or default_celery_broker
-    assert all((imap_celery_broker, notif_dispatch_celery_broker,
+    assert all((antivirus_celery_broker, imap_celery_broker, notif_dispatch_celery_broker,
                 notify_celery_broker, translate_celery_broker)
                ), "Define the celery broker"
     secure = config.getboolean(SECTION, 'require_secure_connection')
@@ -136,10 +141,13 @@ def generate_ini_files(config, config_fname):
     webpack_host = config.get(SECTION, 'webpack_host', public_hostname)
     webpack_url = "http://%s:%d" % (webpack_host, webpack_port)
     vars = {
+        'ANTIVIRUS_CELERY_BROKER': antivirus_celery_broker,
         'IMAP_CELERY_BROKER': imap_celery_broker,
         'NOTIF_DISPATCH_CELERY_BROKER': notif_dispatch_celery_broker,
         'NOTIFY_CELERY_BROKER': notify_celery_broker,
         'TRANSLATE_CELERY_BROKER': translate_celery_broker,
+        'ANTIVIRUS_CELERY_NUM_WORKERS': config.get(
+            SECTION, 'celery_tasks.antivirus.num_workers'),
         'IMAP_CELERY_NUM_WORKERS': config.get(
             SECTION, 'celery_tasks.imap.num_workers'),
         'NOTIF_DISPATCH_CELERY_NUM_WORKERS': config.get(
@@ -165,6 +173,7 @@ def generate_ini_files(config, config_fname):
         'ASSEMBL_URL': url,
     }
     for var in (
+            'autostart_celery_antivirus',
             'autostart_celery_imap',
             'autostart_celery_notification_dispatch',
             'autostart_celery_notify',
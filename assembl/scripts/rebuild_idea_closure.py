@@ -0,0 +1,52 @@
+"""Check the idea closure table against the idea links, and rebuild it.
+
+The closure is maintained by flush listeners; bulk updates of idea links
+bypass them. Without options, report the differences; with --rebuild,
+replace the table content."""
+import argparse
+
+import transaction
+
+from assembl.scripts import boostrap_configuration
+
+
+def compare_closure(connection):
+    """Return the missing, extra and wrong-depth rows of the closure"""
+    from assembl.models import IdeaClosure
+    table = IdeaClosure.__table__
+    expected = IdeaClosure.expected_rows(connection)
+    actual = {(ancestor_id, descendant_id): depth
+              for (ancestor_id, descendant_id, depth) in connection.execute(
+                  table.select())}
+    missing = set(expected) - set(actual)
+    extra = set(actual) - set(expected)
+    wrong_depth = {key for key in set(expected) & set(actual)
+                   if expected[key] != actual[key]}
+    return expected, missing, extra, wrong_depth
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild the closure if it differs")
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    from assembl.models import IdeaClosure
+    from assembl.lib.sqla import mark_changed
+    with transaction.manager:
+        connection = db.connection()
+        if args.rebuild:
+            # Idea links must not change while the closure is rebuilt
+            connection.execute("LOCK TABLE idea_link IN SHARE MODE")
+        expected, missing, extra, wrong_depth = compare_closure(connection)
+        print "%d missing, %d extra, %d wrong depth rows" % (
+            len(missing), len(extra), len(wrong_depth))
+        if args.rebuild and (missing or extra or wrong_depth):
+            IdeaClosure.rebuild(connection, expected)
+            mark_changed(db)
+            print "rebuilt %d rows" % (len(expected),)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""Recompute the participants of discussions from their contributions.
+
+Participants are maintained by ORM listeners; use this to backfill them,
+or to resync after changes made outside of the ORM."""
+from __future__ import print_function
+import argparse
+
+import transaction
+
+from assembl.scripts import boostrap_configuration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("-d", "--discussion", action="append",
+                        help="slug of a discussion to rebuild (default all)")
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    from assembl.models import Discussion
+    query = db.query(Discussion)
+    if args.discussion:
+        query = query.filter(Discussion.slug.in_(args.discussion))
+    for discussion_id, slug in query.with_entities(
+            Discussion.id, Discussion.slug).all():
+        with transaction.manager:
+            discussion = Discussion.get(discussion_id)
+            count = discussion.rebuild_participants()
+        print("%s: %d participants" % (slug, count))
+
+
+if __name__ == '__main__':
+    main()
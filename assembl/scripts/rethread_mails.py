@@ -0,0 +1,44 @@
+"""Thread all the emails of discussions again.
+
+Imports only thread the emails they bring in. Use this to repair threads,
+or after changing the threading rules."""
+import argparse
+
+import transaction
+
+from assembl.scripts import boostrap_configuration
+
+
+def rethread_mails(db, discussion_id):
+    from sqlalchemy.orm import joinedload, undefer
+    from assembl.models import AbstractMailbox, Email
+    emails = db.query(Email).filter(
+        Email.discussion_id == discussion_id).options(
+        joinedload(Email.parent), undefer(Email.imported_blob)).all()
+    if emails:
+        AbstractMailbox.thread_mails(emails)
+    return len(emails)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("-d", "--discussion", action="append",
+                        help="slug of a discussion to rethread (default: all)")
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    from assembl.models import Discussion
+    with transaction.manager:
+        discussions = db.query(Discussion.id, Discussion.slug)
+        if args.discussion:
+            discussions = discussions.filter(
+                Discussion.slug.in_(args.discussion))
+        discussions = discussions.all()
+    for (discussion_id, slug) in discussions:
+        with transaction.manager:
+            num_emails = rethread_mails(db, discussion_id)
+        print "%s: rethreaded %d emails" % (slug, num_emails)
+
+
+if __name__ == '__main__':
+    main()
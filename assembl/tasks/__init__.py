@@ -52,12 +52,15 @@ def configure(registry, task_name):
     config_celery_app(translation_celery_app, settings)
     from .imap import imap_celery_app
     config_celery_app(imap_celery_app, settings)
+    from .antivirus import antivirus_celery_app
+    config_celery_app(antivirus_celery_app, settings)
 
 
 _celery_queues = None
 _celery_routes = None
 
 ASSEMBL_CELERY_APPS = {
+    'antivirus': 'antivirus_celery_app',
     'imap': 'imap_celery_app',
     'notification_dispatch': 'notif_dispatch_celery_app',
     'notify': 'notify_celery_app',
@@ -151,6 +154,7 @@ def includeme(config):
     _settings = config.registry.settings
     config.include('.threaded_model_watcher')
     configure(config.registry, 'assembl')
+    config.include('.antivirus')
     config.include('.imap')
     config.include('.notification_dispatch')
     config.include('.notify')
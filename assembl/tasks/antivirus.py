@@ -0,0 +1,72 @@
+"""A celery process that checks uploaded files for viruses.
+
+Files are queued when they are uploaded, see
+:py:func:`assembl.models.attachment.files_before_commit`, and requests
+read their status, queueing pending files again at most every
+``RESCAN_INTERVAL`` seconds. Files with the same content (``file_identity``)
+are checked once: the status is shared by all of them."""
+from threading import Lock
+from time import time
+
+import transaction
+
+from . import config_celery_app, CeleryWithConfig
+from ..lib.antivirus import get_antivirus
+from ..lib.raven_client import capture_exception
+
+# broker specified
+antivirus_celery_app = CeleryWithConfig('celery_tasks.antivirus')
+
+# Files requested while still pending are queued again at most that often
+RESCAN_INTERVAL = 60
+# Shared by processes if set (the broker if it is redis)
+_rescan_redis = None
+# file_identity -> time queued, if not shared
+_recent_scans = {}
+_recent_scans_lock = Lock()
+
+
+@antivirus_celery_app.task(ignore_result=True)
+def scan_files(file_identities):
+    """Check the files with those identities, one identity at a time."""
+    from ..models import File
+    db = File.default_db
+    antivirus = get_antivirus()
+    for file_identity in set(file_identities):
+        try:
+            with transaction.manager:
+                File.virus_check_identity(db, file_identity, antivirus)
+        except Exception:
+            capture_exception()
+
+
+def request_scan(file_identity):
+    """Queue a check of the files with that identity, unless one was
+    queued less than RESCAN_INTERVAL seconds ago. Returns whether queued."""
+    if _rescan_redis is not None:
+        if not _rescan_redis.set('assembl:antivirus:rescan:' + file_identity,
+                                 1, nx=True, ex=RESCAN_INTERVAL):
+            return False
+    else:
+        now = time()
+        with _recent_scans_lock:
+            if _recent_scans.get(file_identity, 0) > now - RESCAN_INTERVAL:
+                return False
+            _recent_scans[file_identity] = now
+            if len(_recent_scans) > 10000:
+                for key, queued in _recent_scans.items():
+                    if queued <= now - RESCAN_INTERVAL:
+                        del _recent_scans[key]
+    scan_files.delay([file_identity])
+    return True
+
+
+def includeme(config):
+    global _rescan_redis
+    settings = config.registry.settings
+    config_celery_app(antivirus_celery_app, settings)
+    broker = settings.get('celery_tasks.antivirus.broker', None) or \
+        settings.get('celery_tasks.broker', None) or ''
+    if broker.startswith('redis:'):
+        from redis import StrictRedis
+        _rescan_redis = StrictRedis.from_url(broker)
@@ -10,16 +10,16 @@ import ConfigParser
 import traceback
 from time import sleep
 
-import simplejson as json
 import zmq
 from zmq.eventloop import ioloop
 from zmq.eventloop import zmqstream
-import requests
-from tornado import web
+from tornado import web, gen
 from sockjs.tornado import SockJSRouter, SockJSConnection
 from tornado.httpserver import HTTPServer
 
 from assembl.lib.zmqlib import INTERNAL_SOCKET
+from assembl.lib.changes_fanout import ChangesFanout
+from assembl.lib.changes_permissions import ReadPermissionChecker
 from assembl.lib.raven_client import setup_raven, capture_exception
 from assembl.lib.web_token import decode_token, TokenInvalid
 
@@ -32,7 +32,10 @@ if len(sys.argv) != 2:
 
 SECTION = 'app:assembl'
 
-settings = ConfigParser.ConfigParser({'changes.prefix': ''})
+settings = ConfigParser.ConfigParser({
+    'changes.prefix': '',
+    'changes.permission_cache_ttl': '60',
+    'changes.permission_max_concurrent': '10'})
 settings.read(sys.argv[-1])
 CHANGES_SOCKET = settings.get(SECTION, 'changes.socket')
 CHANGES_PREFIX = settings.get(SECTION, 'changes.prefix')
@@ -47,6 +50,9 @@ if REQUIRES_SECURE and SERVER_PORT == 80:
     # old misconfiguration
     SERVER_PORT = 443
 SERVER_URL = "%s://%s:%d" % (SERVER_PROTOCOL, SERVER_HOST, SERVER_PORT)
+PERMISSION_CACHE_TTL = settings.getint(SECTION, 'changes.permission_cache_ttl')
+PERMISSION_MAX_CONCURRENT = settings.getint(
+    SECTION, 'changes.permission_max_concurrent')
 setup_raven(settings)
 
 context = zmq.Context.instance()
@@ -65,46 +71,38 @@ td.setsockopt_in(zmq.IDENTITY, 'XSUB')
 td.setsockopt_out(zmq.IDENTITY, 'XPUB')
 td.start()
 
+permission_checker = ReadPermissionChecker(
+    SERVER_URL, PERMISSION_CACHE_TTL, PERMISSION_MAX_CONCURRENT)
+
 
 class ZMQRouter(SockJSConnection):
 
     token = None
     discussion = None
     userId = None
+    subscribed = False
+    checking = False
 
     def on_open(self, request):
         self.valid = True
         self.closing = False
 
-    def on_recv(self, data):
-        try:
-            data = data[-1]
-            if '@private' in data:
-                jsondata = json.loads(data)
-                jsondata = [x for x in jsondata
-                            if x.get('@private', self.userId) == self.userId]
-                if not jsondata:
-                    return
-                data = json.dumps(jsondata)
-            self.send(data)
-        except Exception:
-            capture_exception()
-            self.do_close()
-
     def do_close(self):
         self.closing = True
         self.close()
-        self.socket = None
-        if getattr(self, "loop", None):
-            self.loop.stop_on_recv()
-            self.loop.close()
-            self.loop = None
+        if self.subscribed:
+            self.subscribed = False
+            fanout.remove(self)
 
+    @gen.coroutine
     def on_message(self, msg):
         try:
-            if getattr(self, 'socket', None):
-                print "closing old socket"
-                self.loop.add_callback(self.do_close)
+            if self.subscribed:
+                print "closing old subscription"
+                io_loop.add_callback(self.do_close)
+                return
+            if self.checking:
+                # The discussion and token being checked must not change
                 return
             if msg.startswith('discussion:') and self.valid:
                 self.discussion = msg.split(':', 1)[1]
@@ -118,19 +116,21 @@ class ZMQRouter(SockJSConnection):
                     pass
             if self.token and self.discussion:
                 # Check if token authorizes discussion
-                r = requests.get(
-                    '%s/api/v1/discussion/%s/permissions/read/u/%s' %
-                    (SERVER_URL, self.discussion,
-                        self.token['userId']))
-                print r.text
-                if r.text != 'true':
+                discussion = self.discussion
+                user_id = self.token['userId']
+                self.checking = True
+                try:
+                    can_read = yield permission_checker.can_read(
+                        discussion, user_id)
+                finally:
+                    self.checking = False
+                if not can_read or self.closing:
+                    return
+                if (self.discussion != discussion or
+                        self.token['userId'] != user_id):
                     return
-                self.socket = context.socket(zmq.SUB)
-                self.socket.connect(INTERNAL_SOCKET)
-                self.socket.setsockopt(zmq.SUBSCRIBE, '*')
-                self.socket.setsockopt(zmq.SUBSCRIBE, str(self.discussion))
-                self.loop = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
-                self.loop.on_recv(self.on_recv)
+                fanout.add(self)
+                self.subscribed = True
                 print "connected"
                 self.send('[{"@type":"Connection"}]')
         except Exception:
@@ -161,10 +161,45 @@ def log_queue():
 
 log_queue()
 
+
+def log_permission_stats():
+    permission_checker.expire()
+    print "permission checks:", permission_checker.stats()
+
+
+def setup_fanout():
+    """A single subscription per discussion, shared by its connections."""
+    socket = context.socket(zmq.SUB)
+    socket.connect(INTERNAL_SOCKET)
+    socket.setsockopt(zmq.SUBSCRIBE, '*')
+    stream = zmqstream.ZMQStream(socket, io_loop=io_loop)
+
+    def subscribe(discussion):
+        socket.setsockopt(zmq.SUBSCRIBE, discussion)
+
+    def unsubscribe(discussion):
+        socket.setsockopt(zmq.UNSUBSCRIBE, discussion)
+
+    def broadcast(connections, message):
+        sockjs_router.broadcast(connections, message)
+
+    fanout = ChangesFanout(subscribe, unsubscribe, broadcast)
+
+    def on_recv(frames):
+        try:
+            fanout.on_recv(frames)
+        except Exception:
+            capture_exception()
+
+    stream.on_recv(on_recv)
+    return fanout
+
 sockjs_router = SockJSRouter(
     ZMQRouter, prefix=CHANGES_PREFIX, io_loop=io_loop,
     user_settings={"websocket_allow_origin": SERVER_URL})
 routes = sockjs_router.urls
+fanout = setup_fanout()
+ioloop.PeriodicCallback(log_permission_stats, 60000, io_loop=io_loop).start()
 web_app = web.Application(routes, debug=False)
 
 
@@ -31,7 +31,7 @@ class EmailCreatorAtDiscussionCreation(object):
         profile = discussion.creator
         assert profile
         jinja_env = Notification.make_jinja_env()
-        (assembl_css, ink_css) = Notification.get_css_paths(discussion)
+        (assembl_css, ink_css) = Notification.get_css(discussion)
         request = get_current_request()
         confirm_url = request.route_url(
             'contextual_welcome',
@@ -40,8 +40,8 @@ class EmailCreatorAtDiscussionCreation(object):
         template_data = {
             'discussion': discussion,
             'frontendUrls': FrontendUrls(discussion),
-            'ink_css': ink_css.read(),
-            'assembl_notification_css': assembl_css.read().decode('utf_8'),
+            'ink_css': ink_css,
+            'assembl_notification_css': assembl_css,
             'jinja_env': jinja_env,
             'connection_url': confirm_url,
             'documentation_url': config.get('documentation_url'),
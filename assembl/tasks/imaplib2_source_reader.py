@@ -94,33 +94,27 @@ class IMAPReader(SourceReader):
         except IMAP4.error as e:
             raise ClientError(e)
 
-    def import_email(self, email_id):
+    def import_emails(self, email_ids):
         mailbox = self.mailbox
-        # print "running fetch for message: "+email_id
         try:
-            status, message_data = mailbox.uid('fetch', email_id, "(RFC822)")
-            if not is_ok((status,)):
-                raise ClientError(message_data)
-
-            # print repr(message_data)
-            for response_part in message_data:
-                if isinstance(response_part, tuple):
-                    message_string = response_part[1]
-            if not message_string:
-                raise ClientError()
+            (messages, last_uid) = self.source.fetch_messages(
+                mailbox, email_ids)
             try:
-                if self.source.message_ok_to_import(message_string):
-                    (email_object, dummy, error) = self.source.parse_email(message_string)
-                    if error:
-                        raise ReaderError(error)
-                    self.source.db.add(email_object)
-                else:
-                    print "Skipped message with imap id %s (bounce or vacation message)" % (email_id)
-                # print "Setting self.source.last_imported_email_uid to "+email_id
-                self.source.last_imported_email_uid = email_id
+                for (email_id, message_string) in messages:
+                    if self.source.message_ok_to_import(message_string):
+                        (email_object, dummy, error) = self.source.parse_email(message_string)
+                        if error:
+                            raise ReaderError(error)
+                        self.source.db.add(email_object)
+                    else:
+                        print "Skipped message with imap id %s (bounce or vacation message)" % (email_id)
+                # print "Setting self.source.last_imported_email_uid to "+last_uid
+                if last_uid:
+                    self.source.last_imported_email_uid = last_uid
                 self.source.db.commit()
             finally:
                 self.source = ContentSource.get(self.source.id)
+            return last_uid == email_ids[-1]
         except IMAP4.abort as e:
             raise IrrecoverableError(e)
         except IMAP4.error as e:
@@ -170,9 +164,10 @@ class IMAPReader(SourceReader):
 
             if len(email_ids):
                 print "Processing messages from IMAP: %d "% (len(email_ids))
-                for email_id in email_ids:
-                    self.import_email(email_id)
-                    if self.status != ReaderStatus.READING:
+                batch_size = self.source.fetch_batch_size
+                for i in range(0, len(email_ids), batch_size):
+                    complete = self.import_emails(email_ids[i:i + batch_size])
+                    if not complete or self.status != ReaderStatus.READING:
                         break
             else:
                 print "No IMAP messages to process"
@@ -1,6 +1,5 @@
 """Celery task for sending :py:class:`assembl.models.notification.Notification` to users."""
 import sys
-from time import sleep
 from datetime import datetime, timedelta
 from traceback import print_exc
 
@@ -9,6 +8,7 @@ from pyramid_mailer import mailer_factory_from_settings
 from pyramid_mailer.message import Message
 
 from ..lib.raven_client import capture_exception
+from ..lib.rate_limit import TokenBuckets
 from . import (config_celery_app, CeleryWithConfig)
 from ..lib.logging import getLogger
 
@@ -30,8 +30,14 @@ CELERYBEAT_SCHEDULE = {
 
 class NotifyCeleryApp(CeleryWithConfig):
     def on_configure_with_settings(self, settings):
-        global notify_process_mailer
+        global notify_process_mailer, rate_limit_redis_url, SMTP_BURST
         notify_process_mailer = mailer_factory_from_settings(settings)
+        broker = settings.get('celery_tasks.notify.broker', None) or \
+            settings.get('celery_tasks.broker', None) or ''
+        rate_limit_redis_url = settings.get(
+            SETTINGS_RATE_LIMIT_REDIS_URL, None) or (
+            broker if broker.startswith('redis:') else None)
+        SMTP_BURST = int(settings.get(SETTINGS_SMTP_BURST, None) or 1)
         # setup SETTINGS_SMTP_DELAY
         for name, val in settings.iteritems():
             if name.startswith(SETTINGS_SMTP_DELAY):
@@ -50,50 +56,135 @@ notify_celery_app._preconf = {
 }
 
 
-# When was a mail last sent by notifications to a given domain?
-# Propagates to superdomains.
-DOMAIN_LAST_SENT = {}
-
 # Minimum delay between emails sent to a domain.
-# For this to work, you need to have a SINGLE celery process for notification.
+# Domains are rate limited with token buckets, shared between notify
+# processes through redis, so several workers can run in parallel.
 SMTP_DOMAIN_DELAYS = {
     '': timedelta(0)
 }
 
+# How many emails can be sent to a domain at once, before delays apply.
+SMTP_BURST = 1
+
 # INI file values with this prefix will be used to populate SMTP_DOMAIN_DELAYS.
 # Anything after the last dot is a domain name (including empty).
 # Use seconds (float) as values.
 SETTINGS_SMTP_DELAY = "celery_tasks.notify.smtp_delay."
+SETTINGS_SMTP_BURST = "celery_tasks.notify.smtp_burst"
 
+# Redis keeping the token buckets (by default, the broker if it is redis)
+SETTINGS_RATE_LIMIT_REDIS_URL = "celery_tasks.notify.rate_limit_redis_url"
+# Longer delays are waited in steps, as the redis broker redelivers tasks
+# which are not acknowledged within its visibility timeout (1h)
+MAX_COUNTDOWN = 3000
+# Delayed notifications are retried by process_pending_notifications
+# only if they are still unsent that long after their scheduled date
+SCHEDULED_GRACE = timedelta(minutes=30)
+rate_limit_redis_url = None
+_domain_buckets = None
 
-def email_was_sent(email):
-    domain = email.split("@")[-1].lower().split('.')
-    now = datetime.utcnow()
-    for i in range(len(domain) + 1):
-        dom = '.'.join(domain[i:])
-        DOMAIN_LAST_SENT[dom] = now
+
+def get_domain_buckets():
+    global _domain_buckets
+    if _domain_buckets is None:
+        _domain_buckets = TokenBuckets(
+            rate_limit_redis_url, 'assembl:notify:domain:')
+    return _domain_buckets
 
 
-def wait_if_necessary(email):
+def domain_delay_rule(email):
+    """The most specific domain of the email with a delay rule,
+    and its delay. Subdomains share the bucket of the rule."""
     domain = email.split("@")[-1].lower().split('.')
-    # Look for most specific delay rule
     for i in range(len(domain) + 1):
         dom = '.'.join(domain[i:])
         if dom in SMTP_DOMAIN_DELAYS:
-            delay = SMTP_DOMAIN_DELAYS[dom]
-            break
-    else:
-        return
-    # Not looking at superdomains. make delays as generic as needed
-    last_sent = DOMAIN_LAST_SENT.get(dom, None)
-    if last_sent is None:
-        return
-    elapsed = datetime.utcnow() - last_sent
-    if elapsed < delay:
-        sleep((delay - elapsed).total_seconds())
+            return dom, SMTP_DOMAIN_DELAYS[dom]
+    return None, None
+
+
+def reserve_sending(email):
+    """Reserve a turn to send an email to its domain.
+    Returns the delay in seconds after which it may be sent."""
+    dom, delay = domain_delay_rule(email)
+    if not delay:
+        return 0
+    return get_domain_buckets().reserve(
+        dom, delay.total_seconds(), SMTP_BURST)
+
+
+class SMTPBatch(object):
+    """Sends the emails of a batch of notifications through a single
+    connection to the SMTP server, opened when first needed.
+    Can be used in place of a mailer's ``send_immediately``."""
+
+    def __init__(self, mailer):
+        self.mailer = mailer
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
+    def connect(self, smtp_mailer):
+        # Same handshake as repoze.sendmail's SMTPMailer.send
+        connection = smtp_mailer.smtp_factory()
+        code, response = connection.ehlo()
+        if code < 200 or code >= 300:
+            code, response = connection.helo()
+            if code < 200 or code >= 300:
+                raise RuntimeError(
+                    'Error sending HELO to the SMTP server '
+                    '(code=%s, response=%s)' % (code, response))
+        have_tls = connection.has_extn('starttls')
+        if not have_tls and smtp_mailer.force_tls:
+            raise RuntimeError('TLS is not available but TLS is required')
+        if have_tls and not smtp_mailer.no_tls:
+            connection.starttls()
+            connection.ehlo()
+        if connection.does_esmtp:
+            if smtp_mailer.username is not None and \
+                    smtp_mailer.password is not None:
+                connection.login(smtp_mailer.username, smtp_mailer.password)
+        elif smtp_mailer.username:
+            raise RuntimeError(
+                'Mailhost does not support ESMTP but a username '
+                'is configured')
+        return connection
 
-def process_notification(notification):
+    def send_immediately(self, message, fail_silently=False):
+        from repoze.sendmail.encoding import encode_message
+        from repoze.sendmail.mailer import SMTPMailer
+        smtp_mailer = getattr(self.mailer, 'smtp_mailer', None)
+        if not isinstance(smtp_mailer, SMTPMailer):
+            # e.g. the DummyMailer of tests
+            return self.mailer.send_immediately(message, fail_silently)
+        if self.connection is None:
+            self.connection = self.connect(smtp_mailer)
+        message.sender = message.sender or self.mailer.default_sender
+        try:
+            self.connection.sendmail(
+                message.sender, message.send_to,
+                encode_message(message.to_message()))
+        except Exception:
+            # the next message will use a new connection
+            self.close()
+            raise
+
+    def close(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            try:
+                connection.quit()
+            except Exception:
+                connection.close()
+
+
+def process_notification(notification, mailer=None, reserved=False):
+    """Send a notification, or schedule it for later if its domain
+    is rate limited. ``reserved`` notifications already waited their turn."""
     from ..models.notification import (
         NotificationDeliveryStateType, UnverifiedEmailException,
         MissingEmailException)
@@ -112,15 +203,31 @@ def process_notification(notification):
                 notification.id, notification.delivery_state))
         return
     try:
-        email = notification.render_to_message()
-        # sys.stderr.write(email_str)
         recipient = notification.get_to_email_address()
-        wait_if_necessary(recipient)
-        notify_process_mailer.send_immediately(email, fail_silently=False)
+        if reserved and notification.scheduled_date:
+            delay = (notification.scheduled_date -
+                     datetime.utcnow()).total_seconds()
+            if delay > 0:
+                schedule_notification(notification, delay)
+                return
+        elif not reserved:
+            delay = reserve_sending(recipient)
+            if delay > 0:
+                # Not our turn yet: send later, without blocking the worker
+                notification.scheduled_date = datetime.utcnow() + timedelta(
+                    seconds=delay)
+                schedule_notification(notification, delay)
+                sys.stderr.write(
+                    "process_notification delayed %d by %.1fs" % (
+                        notification.id, delay))
+                return
+        notification.scheduled_date = None
+        email = notification.render_to_message()
+        (mailer or notify_process_mailer).send_immediately(
+            email, fail_silently=False)
 
         notification.delivery_state = \
             NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
-        email_was_sent(recipient)
     except UnverifiedEmailException as e:
         capture_exception()
         getLogger().exception("Not sending to unverified email")
@@ -165,8 +272,13 @@ def process_notification(notification):
         % (notification.id, notification.delivery_state))
 
 
+def schedule_notification(notification, delay):
+    notify.apply_async(
+        (notification.id, True), countdown=min(delay, MAX_COUNTDOWN))
+
+
 @notify_celery_app.task()
-def notify(id):
+def notify(id, reserved=False):
     """ Can be triggered by
     http://localhost:6543/data/Discussion/6/all_users/2/notifications/12/process_now """
     from ..models.notification import Notification, waiting_get
@@ -174,7 +286,20 @@ def notify(id):
     with transaction.manager:
         notification = waiting_get(Notification, id)
         assert notification
-        process_notification(notification)
+        process_notification(notification, reserved=reserved)
+
+
+@notify_celery_app.task()
+def notify_batch(ids):
+    """Send the notifications of an event, reusing one SMTP connection"""
+    from ..models.notification import Notification, waiting_get
+    sys.stderr.write("notify_batch called with %d notifications" % len(ids))
+    with SMTPBatch(notify_process_mailer) as mailer:
+        for id in ids:
+            with transaction.manager:
+                notification = waiting_get(Notification, id)
+                assert notification
+                process_notification(notification, mailer)
 
 
 @notify_celery_app.task()
@@ -185,13 +310,18 @@ def process_pending_notifications():
     sys.stderr.write("process_pending_notifications called")
     retryable_notifications = Notification.default_db.query(Notification.id).filter(
         Notification.delivery_state.in_(
-        NotificationDeliveryStateType.getRetryableDeliveryStates()))
-    for (notification_id,) in retryable_notifications:
-        try:
-            with transaction.manager:
-                process_notification(Notification.get(notification_id))
-        except:
-            capture_exception()
+        NotificationDeliveryStateType.getRetryableDeliveryStates()),
+        # Delayed notifications have their own task, unless it was lost
+        (Notification.scheduled_date == None) |  # noqa: E711
+        (Notification.scheduled_date < datetime.utcnow() - SCHEDULED_GRACE))
+    with SMTPBatch(notify_process_mailer) as mailer:
+        for (notification_id,) in retryable_notifications.all():
+            try:
+                with transaction.manager:
+                    process_notification(
+                        Notification.get(notification_id), mailer)
+            except:
+                capture_exception()
 
 
 def includeme(config):
@@ -4,8 +4,8 @@ and reads at reasonable intervals. It can also handle sources that can push chan
 import sys
 import signal
 from random import uniform
-from time import sleep
-from threading import Thread, Event, currentThread
+from time import sleep, time
+from threading import Thread, Event, Lock, currentThread
 from traceback import print_stack
 from datetime import datetime, timedelta
 from abc import ABCMeta, abstractmethod
@@ -22,7 +22,7 @@ from sqlalchemy.exc import TimeoutError
 
 from assembl.tasks import configure
 from assembl.lib.raven_client import capture_exception
-from assembl.lib.config import set_config
+from assembl.lib.config import set_config, get_config
 from assembl.lib.enum import OrderedEnum
 from assembl.lib.sqla import configure_engine
 
@@ -485,6 +485,25 @@ def wake(source_id, reimport=False, force_restart=False, **kwargs):
         producer.publish(kwargs, serializer="json", routing_key=ROUTING_KEY)
 
 
+# When each source was last woken by read requests, in this process
+_last_wakes = {}
+_last_wakes_lock = Lock()
+
+
+def should_wake(source_id, min_interval=None):
+    """Debounce source wakes coming from read requests: returns True
+    at most once per source every ``sources.min_wake_interval`` seconds."""
+    if min_interval is None:
+        min_interval = float(get_config().get(
+            'sources.min_wake_interval', 60))
+    now = time()
+    with _last_wakes_lock:
+        if now - _last_wakes.get(source_id, 0) < min_interval:
+            return False
+        _last_wakes[source_id] = now
+    return True
+
+
 def external_shutdown():
     global _producer_connection
     from kombu.common import maybe_declare
@@ -1,7 +1,14 @@
-"""A celery process that translate messages as soon as they are created. Causes deadlocks, not used"""
+"""A celery process that translates messages.
+
+Requests do not translate contents themselves: they queue the contents
+which miss translations with :py:func:`translate_later`, and translations
+reach clients through the changes socket. Translating messages as soon as
+they are created caused deadlocks, and is not done."""
 from collections import defaultdict
 from abc import abstractmethod
 
+import transaction
+
 from . import config_celery_app, CeleryWithConfig
 from ..lib.utils import waiting_get
 from ..lib.raven_client import capture_exception
@@ -145,6 +152,145 @@ def translate_content(
     return changed
 
 
+def missing_translations(content, translation_table, service):
+    """The translations missing from a content, as
+    (original entry, target locale code, is_html) triples.
+    Entries in an undefined locale which have to be identified
+    before being translated have a None target."""
+    from ..models import Locale
+    for prop in ("body", "subject"):
+        ls = getattr(content, prop)
+        if not ls:
+            continue
+        is_html = (prop == "body" and
+                   content.get_body_mime_type() == 'text/html')
+        entries = {service.asKnownLocale(
+                    Locale.extract_base_locale(entry.locale_code)): entry
+                   for entry in ls.entries}
+        entries.pop(None, None)
+        for original in ls.non_mt_entries():
+            if not original.value:
+                continue
+            if (original.locale_code == Locale.UNDEFINED and
+                    service.distinct_identify_step):
+                if not original.error_code:
+                    yield (original, None, is_html)
+                continue
+            source_loc = (service.asKnownLocale(original.locale_code) or
+                          original.locale_code) or 'und'
+            for dest in translation_table.languages_for(
+                    source_loc, content.db):
+                if Locale.compatible(dest, source_loc):
+                    continue
+                entry = entries.get(dest, None)
+                if entry is None or (
+                        entry.error_code and
+                        not service.has_fatal_error(entry)):
+                    yield (original, dest, is_html)
+
+
+def prefetch_translations(contents, translation_table, service):
+    """Translate the texts missing from contents in batches, one per
+    source and target locale, so translate_content finds them in the
+    translation cache instead of calling the service for each text."""
+    from ..models import Locale
+    batches = defaultdict(list)
+    for content in contents:
+        for (original, dest, is_html) in missing_translations(
+                content, translation_table, service):
+            if dest is None:
+                continue
+            source = original.locale_code
+            if not service.canTranslate(source, dest):
+                continue
+            if source == Locale.UNDEFINED:
+                source = None
+            batches[(source, dest, is_html)].append(original.value)
+    for ((source, dest, is_html), texts) in batches.iteritems():
+        try:
+            service.cached_translate_many(
+                texts, dest, is_html, source=source)
+        except:
+            # translate_content will try again, and record errors
+            capture_exception()
+
+
+def translate_contents(
+        contents, pref_collection=None, service=None,
+        constrain_to_discussion_languages=True,
+        send_to_changes=False):
+    """Translate contents to the discussion languages, or to the languages
+    of pref_collection, with batched calls to the translation service."""
+    by_discussion = defaultdict(list)
+    for content in contents:
+        by_discussion[content.discussion_id].append(content)
+    changed = False
+    for discussion_contents in by_discussion.itervalues():
+        discussion = discussion_contents[0].discussion
+        discussion_service = service or discussion.translation_service()
+        if discussion_service.canTranslate is None:
+            continue
+        if pref_collection is None:
+            translation_table = DiscussionPreloadTranslationTable(
+                discussion_service, discussion)
+        else:
+            translation_table = PrefCollectionTranslationTable(
+                discussion_service, pref_collection)
+        prefetch_translations(
+            discussion_contents, translation_table, discussion_service)
+        for content in discussion_contents:
+            changed |= bool(translate_content(
+                content, translation_table, discussion_service,
+                constrain_to_discussion_languages, send_to_changes))
+    return changed
+
+
+def translate_later(request, content_ids, locale=None):
+    """Queue the translation of contents to the languages of the user of
+    the request, or to locale. Tasks are sent once the request is over,
+    one per request and set of languages."""
+    from pyramid.security import Everyone
+    user_id = request.authenticated_userid
+    if user_id == Everyone:
+        user_id = None
+    key = (user_id, locale or (None if user_id else request.locale_name))
+    queued = getattr(request, 'translations_to_queue', None)
+    if queued is None:
+        queued = request.translations_to_queue = defaultdict(set)
+        request.add_finished_callback(queue_translations)
+    queued[key].update(content_ids)
+
+
+def queue_translations(request):
+    for ((user_id, locale), content_ids) in \
+            request.translations_to_queue.iteritems():
+        translate_contents_task.delay(sorted(content_ids), user_id, locale)
+
+
+@translation_celery_app.task(ignore_result=True)
+def translate_contents_task(content_ids, user_id=None, locale=None):
+    from ..models import Content
+    from ..models.auth import (
+        UserLanguagePreferenceCollection,
+        LanguagePreferenceCollectionWithDefault)
+    with transaction.manager:
+        pref_collection = None
+        if user_id:
+            try:
+                pref_collection = UserLanguagePreferenceCollection(user_id)
+            except Exception:
+                capture_exception()
+                from ..lib import config
+                locale = locale or config.get('pyramid.default_locale_name')
+        if pref_collection is None and locale:
+            pref_collection = LanguagePreferenceCollectionWithDefault(locale)
+        contents = Content.default_db.query(Content).filter(
+            Content.id.in_(content_ids)).options(
+            *Content.subqueryload_options()).all()
+        translate_contents(
+            contents, pref_collection, send_to_changes=True)
+
+
 @translation_celery_app.task(ignore_result=True)
 def translate_content_task(content_id):
     from ..models import Content
@@ -166,10 +312,14 @@ def translate_discussion(
         translation_table = DiscussionPreloadTranslationTable(
             service, discussion)
     changed = False
-    for post in discussion.posts:
-        changed |= translate_content(
-            post, translation_table, service,
-            constrain_to_discussion_languages, send_to_changes)
+    posts = discussion.posts
+    for i in range(0, len(posts), service.max_batch_size):
+        batch = posts[i:i + service.max_batch_size]
+        prefetch_translations(batch, translation_table, service)
+        for post in batch:
+            changed |= bool(translate_content(
+                post, translation_table, service,
+                constrain_to_discussion_languages, send_to_changes))
     return changed
 
 
@@ -0,0 +1,47 @@
+import simplejson as json
+
+from assembl.lib.changes_fanout import ChangesFanout, split_private
+
+
+class FakeConnection(object):
+    def __init__(self, discussion, user_id):
+        self.discussion = discussion
+        self.userId = user_id
+
+
+def test_split_private():
+    data = json.dumps([
+        {"@id": "a"},
+        {"@id": "b", "@private": "u1"},
+        {"@id": "c"}])
+    public, private = split_private(data)
+    assert json.loads(public) == [{"@id": "a"}, {"@id": "c"}]
+    assert private.keys() == ["u1"]
+    assert [x["@id"] for x in json.loads(private["u1"])] == ["a", "b", "c"]
+
+
+def test_fanout_subscriptions_and_dispatch():
+    subscriptions = set()
+    sent = []
+    fanout = ChangesFanout(
+        subscriptions.add, subscriptions.discard,
+        lambda connections, message: sent.append(
+            (frozenset(c.userId for c in connections), message)))
+    c1 = FakeConnection(1, "u1")
+    c2 = FakeConnection(1, "u2")
+    c3 = FakeConnection(12, "u3")
+    for c in (c1, c2, c3):
+        fanout.add(c)
+    assert subscriptions == {"1", "12"}
+    fanout.on_recv(["1", "0", json.dumps([
+        {"@id": "a"}, {"@id": "b", "@private": "u1"}])])
+    assert len(sent) == 2
+    by_users = dict(sent)
+    assert len(json.loads(by_users[frozenset(["u1"])])) == 2
+    assert len(json.loads(by_users[frozenset(["u2"])])) == 1
+    del sent[:]
+    fanout.on_recv(["*", "1", json.dumps([{"@id": "c"}])])
+    assert {frozenset(users) for (users, m) in sent} == {
+        frozenset(["u1", "u2"]), frozenset(["u3"])}
+    fanout.remove(c3)
+    assert subscriptions == {"1"}
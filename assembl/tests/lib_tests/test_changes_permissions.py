@@ -0,0 +1,67 @@
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from assembl.lib.changes_permissions import ReadPermissionChecker
+
+
+class FakeResponse(object):
+    def __init__(self, code, body):
+        self.code = code
+        self.body = body
+
+
+class FakeHTTPClient(object):
+    def __init__(self):
+        self.requests = []
+        self.futures = []
+
+    def fetch(self, url, raise_error=True):
+        self.requests.append(url)
+        future = Future()
+        self.futures.append(future)
+        return future
+
+    def respond(self, code=200, body='true'):
+        for future in self.futures:
+            future.set_result(FakeResponse(code, body))
+        self.futures = []
+
+
+def test_permission_checks_are_cached_and_shared():
+    client = FakeHTTPClient()
+    checker = ReadPermissionChecker(
+        'http://localhost', ttl=60, http_client=client)
+
+    @gen.coroutine
+    def check():
+        first = checker.can_read(1, 'u1')
+        second = checker.can_read(1, 'u1')
+        yield gen.moment
+        assert len(client.requests) == 1
+        client.respond()
+        results = yield [first, second]
+        third = yield checker.can_read(1, 'u1')
+        raise gen.Return(results + [third])
+
+    assert IOLoop.current().run_sync(check) == [True, True, True]
+    assert len(client.requests) == 1
+    assert checker.stats()["checks"] == 1
+    assert checker.stats()["hits"] == 1
+
+
+def test_permission_errors_are_not_cached():
+    client = FakeHTTPClient()
+    checker = ReadPermissionChecker(
+        'http://localhost', ttl=60, http_client=client)
+
+    @gen.coroutine
+    def check():
+        result = checker.can_read(1, 'u1')
+        yield gen.moment
+        client.respond(500, '')
+        result = yield result
+        raise gen.Return(result)
+
+    assert IOLoop.current().run_sync(check) is False
+    assert checker.cache == {}
@@ -0,0 +1,101 @@
+import os
+from time import sleep
+
+import simplejson as json
+
+from assembl.indexing.queue import IndexingQueue
+
+
+class FakeSerializer(object):
+    def dumps(self, data):
+        return data if isinstance(data, basestring) else json.dumps(data)
+
+
+class FakeTransport(object):
+    serializer = FakeSerializer()
+
+
+class FakeElasticsearch(object):
+    transport = FakeTransport()
+
+    def __init__(self, failures=0, rejected=()):
+        self.failures = failures
+        # ids of documents rejected once, as when elasticsearch is overloaded
+        self.rejected = set(rejected)
+        self.requests = []
+
+    def bulk(self, body, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("elasticsearch is down")
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.requests.append(lines)
+        items = []
+        for (op_type, meta) in operations(lines):
+            result = dict(meta, status=200)
+            if meta['_id'] in self.rejected:
+                self.rejected.remove(meta['_id'])
+                result.update(
+                    status=429, error="es_rejected_execution_exception")
+            items.append({op_type: result})
+        return {'errors': any(
+            item.values()[0]['status'] != 200 for item in items),
+            'items': items}
+
+
+def operations(lines):
+    return [line.items()[0] for line in lines
+            if len(line) == 1 and line.keys()[0] in ('index', 'delete')]
+
+
+def action(uid, op_type='index'):
+    action = {'_op_type': op_type, '_index': 'assembl',
+              '_type': 'post', '_id': uid}
+    if op_type == 'index':
+        action['_source'] = {'id': uid}
+    return action
+
+
+def wait_until_sent(queue, timeout=5):
+    for i in range(int(timeout / 0.01)):
+        if not queue.stats()["pending"]:
+            break
+        sleep(0.01)
+    queue.stop()
+
+
+def test_indexing_queue_merges_and_retries(tmpdir):
+    client = FakeElasticsearch(failures=1, rejected=['post:2'])
+    queue = IndexingQueue(str(tmpdir), client=client)
+    queue.max_backoff = 0
+    queue.put([action('post:1'), action('post:2')])
+    queue.put([action('post:1', 'delete')])
+    assert len(open(queue.journal_path).readlines()) == 3
+    queue.start()
+    wait_until_sent(queue)
+    # once unreachable, then post:2 rejected once
+    assert queue.retries == 2
+    assert queue.stats()["pending"] == 0
+    assert queue.stats()["failed"] == 0
+    (request, retried) = client.requests
+    # post:1 is only deleted, after post:2 is indexed
+    assert [(op_type, meta['_id']) for (op_type, meta) in operations(request)
+            ] == [('index', 'post:2'), ('delete', 'post:1')]
+    assert [(op_type, meta['_id']) for (op_type, meta) in operations(retried)
+            ] == [('index', 'post:2')]
+    # Sent segments are deleted
+    assert [path.basename for path in tmpdir.listdir()] == [
+        os.path.basename(queue.journal_path)]
+    assert open(queue.journal_path).read() == ''
+
+
+def test_indexing_queue_recovers_journals(tmpdir):
+    journal = tmpdir.join('indexing-1.journal')
+    journal.write(json.dumps(action('post:3')) + '\n')
+    client = FakeElasticsearch()
+    queue = IndexingQueue(str(tmpdir), client=client)
+    assert not journal.check()
+    assert queue.stats()["pending"] == 1
+    queue.start()
+    wait_until_sent(queue)
+    assert queue.stats()["sent"] == 1
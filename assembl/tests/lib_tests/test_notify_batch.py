@@ -0,0 +1,51 @@
+from pyramid_mailer.mailer import Mailer
+from pyramid_mailer.message import Message
+
+from assembl.tasks.notify import SMTPBatch
+
+
+class FakeSMTP(object):
+    connections = []
+
+    def __init__(self, hostname, port, timeout=None):
+        self.sent = []
+        self.closed = False
+        self.does_esmtp = True
+        self.connections.append(self)
+
+    def set_debuglevel(self, level):
+        pass
+
+    def ehlo(self):
+        return (250, 'ok')
+
+    def has_extn(self, name):
+        return False
+
+    def sendmail(self, sender, recipients, message):
+        if 'refused@example.com' in recipients:
+            raise RuntimeError("refused")
+        self.sent.extend(recipients)
+
+    def quit(self):
+        self.closed = True
+
+
+def test_smtp_batch_reuses_connection():
+    FakeSMTP.connections = []
+    mailer = Mailer(default_sender='assembl@example.com')
+    mailer.smtp_mailer.smtp = FakeSMTP
+
+    def message(recipient):
+        return Message(subject="test", recipients=[recipient], body="test")
+    with SMTPBatch(mailer) as batch:
+        batch.send_immediately(message('a@example.com'))
+        batch.send_immediately(message('b@example.com'))
+        try:
+            batch.send_immediately(message('refused@example.com'))
+        except RuntimeError:
+            pass
+        batch.send_immediately(message('c@example.com'))
+    assert [c.sent for c in FakeSMTP.connections] == [
+        ['a@example.com', 'b@example.com'], ['c@example.com']]
+    assert all(c.closed for c in FakeSMTP.connections)
@@ -0,0 +1,93 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from time import sleep
+from urlparse import urlparse, parse_qs
+
+import pytest
+import simplejson as json
+
+from assembl.lib import piwik
+from assembl.lib.piwik import (
+    AnalyticsCache, cached_piwik_call, piwik_Actions_get)
+
+
+class StubPiwikHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        self.server.calls.append(params)
+        sleep(self.server.delay)
+        if self.server.fail:
+            self.send_response(500)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({
+            "nb_pageviews": len(self.server.calls),
+            "nb_uniq_pageviews": 1}))
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="function")
+def piwik_server(request, monkeypatch):
+    server = HTTPServer(('127.0.0.1', 0), StubPiwikHandler)
+    server.calls = []
+    server.delay = 0
+    server.fail = False
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setattr(piwik, '_analytics_cache', AnalyticsCache(ttl=60))
+
+    def fin():
+        server.shutdown()
+        server.server_close()
+    request.addfinalizer(fin)
+    server.url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    return server
+
+
+def test_piwik_cache_hits_and_errors(piwik_server):
+    def call(date):
+        return cached_piwik_call(
+            piwik_Actions_get, piwik_server.url, 'token', 1, 'range', date)
+    ongoing = '2017-01-01,2999-01-01'
+    assert call(ongoing)["nb_pageviews"] == 1
+    assert call(ongoing)["nb_pageviews"] == 1
+    assert len(piwik_server.calls) == 1
+    # another range is another report
+    assert call('2017-01-01,2017-02-01')["nb_pageviews"] == 2
+    cache = piwik._analytics_cache
+    assert cache.entries[
+        (piwik_server.url, 1, 'range', '2017-01-01,2017-02-01',
+         'piwik_Actions_get')][0] is None
+    assert cache.entries[
+        (piwik_server.url, 1, 'range', ongoing, 'piwik_Actions_get')][0]
+    # errors are not cached
+    piwik_server.fail = True
+    with pytest.raises(Exception):
+        call('2017-03-01,2017-04-01')
+    piwik_server.fail = False
+    assert call('2017-03-01,2017-04-01')["nb_pageviews"] == 4
+    assert len(piwik_server.calls) == 4
+
+
+def test_piwik_cache_coalesces_calls(piwik_server):
+    piwik_server.delay = 0.2
+    results = []
+
+    def call():
+        results.append(cached_piwik_call(
+            piwik_Actions_get, piwik_server.url, 'token', 1, 'range',
+            '2017-01-01,2999-01-01'))
+    threads = [Thread(target=call) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(piwik_server.calls) == 1
+    assert len(results) == 5
+    assert all(r["nb_pageviews"] == 1 for r in results)
@@ -0,0 +1,43 @@
+from datetime import timedelta
+
+from assembl.lib.rate_limit import TokenBuckets
+
+
+def test_token_bucket_reservations():
+    buckets = TokenBuckets()
+    # one email per second, up to 3 at once
+    delays = [buckets.reserve('example.com', 1, 3, now=100)
+              for i in range(5)]
+    assert delays == [0, 0, 0, 1, 2]
+    # other keys have their own bucket
+    assert buckets.reserve('example.org', 1, 3, now=100) == 0
+    # tokens come back with time
+    assert buckets.reserve('example.com', 1, 3, now=110) == 0
+    assert buckets.reserve('example.com', 0, 1, now=110) == 0
+
+
+def test_notify_domain_rules(monkeypatch):
+    from assembl.tasks import notify
+    monkeypatch.setattr(notify, 'SMTP_DOMAIN_DELAYS', {
+        '': timedelta(0), 'example.com': timedelta(seconds=2)})
+    monkeypatch.setattr(notify, '_domain_buckets', TokenBuckets())
+    assert notify.domain_delay_rule('a@mail.example.com') == (
+        'example.com', timedelta(seconds=2))
+    assert notify.reserve_sending('a@example.org') == 0
+    assert notify.reserve_sending('a@example.com') == 0
+    # subdomains share the bucket of the rule
+    assert 1.9 < notify.reserve_sending('b@mail.example.com') <= 2
+
+
+def test_long_delays_are_waited_in_steps(monkeypatch):
+    from assembl.tasks import notify
+    scheduled = []
+    monkeypatch.setattr(
+        notify.notify, 'apply_async',
+        lambda args, countdown: scheduled.append((args, countdown)))
+
+    class Notification(object):
+        id = 3
+    notify.schedule_notification(Notification, 7200)
+    notify.schedule_notification(Notification, 5)
+    assert scheduled == [((3, True), notify.MAX_COUNTDOWN), ((3, True), 5)]
@@ -0,0 +1,55 @@
+from assembl.nlp import translation_service
+from assembl.nlp.translation_service import (
+    AbstractTranslationService, TranslationCache)
+
+
+class FakeDiscussion(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeTranslationService(AbstractTranslationService):
+    def __init__(self, discussion):
+        super(FakeTranslationService, self).__init__(discussion)
+        self.calls = []
+
+    def canTranslate(self, source, target):
+        return True
+
+    def translate_many(
+            self, texts, target, is_html=False, source=None, db=None):
+        self.calls.append((source, target, is_html, list(texts)))
+        return [(u"%s:%s" % (target, text), source) for text in texts]
+
+
+def test_translations_are_batched_and_cached(monkeypatch):
+    monkeypatch.setattr(
+        translation_service, '_translation_cache', TranslationCache())
+    service = FakeTranslationService(FakeDiscussion(1))
+    service.max_batch_size = 2
+    results = service.cached_translate_many(
+        [u"a", u"b", u"", u"c", u"a"], "fr", source="en")
+    assert results == [
+        (u"fr:a", "en"), (u"fr:b", "en"), (u"", "zxx"), (u"fr:c", "en"),
+        (u"fr:a", "en")]
+    assert service.calls == [
+        ("en", "fr", False, [u"a", u"b"]), ("en", "fr", False, [u"c"])]
+    # the cache is shared with other discussions
+    other_service = FakeTranslationService(FakeDiscussion(2))
+    assert other_service.cached_translate_many(
+        [u"a", u"d"], "fr", source="en") == [
+        (u"fr:a", "en"), (u"fr:d", "en")]
+    assert other_service.calls == [("en", "fr", False, [u"d"])]
+    # but translations depend on the format
+    other_service.cached_translate_many(
+        [u"a"], "fr", is_html=True, source="en")
+    assert other_service.calls[-1] == ("en", "fr", True, [u"a"])
+
+
+def test_translation_cache_keeps_recent_entries():
+    cache = TranslationCache(max_entries=2)
+    cache.set_many({'a': (u"A", "en"), 'b': (u"B", "en")})
+    assert cache.get_many(['a']) == {'a': (u"A", "en")}
+    cache.set_many({'c': (u"C", "en")})
+    assert cache.get_many(['a', 'b', 'c']) == {
+        'a': (u"A", "en"), 'c': (u"C", "en")}
@@ -0,0 +1,15 @@
+from assembl.nlp.wordcounter import WordCounter
+
+
+def test_word_counter_vectors():
+    texts = [u"Growing economies grow", u"The economy is growing"]
+    direct = WordCounter(['en'])
+    summed = WordCounter(['en'])
+    for text in texts:
+        direct.add_text(text)
+        counter = WordCounter(['en'])
+        counter.add_text(text)
+        summed.add_vector(counter.as_vector())
+    assert {stem: words.counter for (stem, words) in direct.iteritems()} == \
+        {stem: words.counter for (stem, words) in summed.iteritems()}
+    assert set(direct.best(2)) == set(summed.best(2)) == {u"grow", u"economy"}
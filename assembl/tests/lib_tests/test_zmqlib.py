@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+from assembl.lib.zmqlib import ChangesPublisher
+
+
+def test_coalesce_changes_last_write_wins():
+    pending = OrderedDict()
+    ChangesPublisher.coalesce(pending, "1", [
+        {"@id": "local:Post/1", "v": 1},
+        {"@id": "local:Post/2", "v": 1}])
+    ChangesPublisher.coalesce(pending, "2", [
+        {"@id": "local:Post/3", "v": 1}])
+    ChangesPublisher.coalesce(pending, "1", [
+        {"@id": "local:Post/1", "v": 2}])
+    assert pending.keys() == ["1", "2"]
+    assert pending["1"].values() == [
+        {"@id": "local:Post/2", "v": 1},
+        {"@id": "local:Post/1", "v": 2}]
+    assert pending["2"].values() == [{"@id": "local:Post/3", "v": 1}]
+
+
+def test_coalesce_keeps_views_and_recipients():
+    pending = OrderedDict()
+    ChangesPublisher.coalesce(pending, "1", [
+        {"@id": "local:Post/1", "v": 1},
+        {"@id": "local:Post/1", "v": 1, "private": True},
+        {"@id": "local:Post/1", "@private": "local:AgentProfile/1"},
+        {"@id": "local:Post/1", "@private": "local:AgentProfile/2"}], [
+        ("local:Post/1", "changes"), ("local:Post/1", "private"),
+        ("local:Post/1", "changes"), ("local:Post/1", "changes")])
+    assert len(pending["1"]) == 4
+    ChangesPublisher.coalesce(pending, "1", [
+        {"@id": "local:Post/1", "v": 2, "private": True}], [
+        ("local:Post/1", "private")])
+    assert pending["1"].values() == [
+        {"@id": "local:Post/1", "v": 1},
+        {"@id": "local:Post/1", "@private": "local:AgentProfile/1"},
+        {"@id": "local:Post/1", "@private": "local:AgentProfile/2"},
+        {"@id": "local:Post/1", "v": 2, "private": True}]
+
+
+def test_publisher_stats():
+    publisher = ChangesPublisher()
+    publisher.messages = 10
+    publisher.bytes = 1000
+    stats = publisher.stats()
+    assert stats["messages"] == 10
+    assert stats["bytes"] == 1000
+    assert stats["messages_per_second"] > 0
+    stats = publisher.stats()
+    assert stats["messages_per_second"] == 0
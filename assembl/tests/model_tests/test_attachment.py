@@ -0,0 +1,62 @@
+import os
+
+from assembl.lib.antivirus import AntiVirus
+
+
+class CountingAntiVirus(AntiVirus):
+    def __init__(self, safe=True):
+        self.safe = safe
+        self.paths = []
+
+    def check(self, path):
+        self.paths.append(path)
+        return self.safe
+
+
+def test_virus_check_by_identity(discussion, test_session):
+    from assembl.models import File
+    from assembl.models.attachment import AntiVirusStatus
+    data = os.urandom(256)
+    files = []
+    for title in ('first.png', 'copy.png'):
+        f = File(discussion=discussion, mime_type='image/png', title=title)
+        f.add_raw_data(data)
+        test_session.add(f)
+        files.append(f)
+    test_session.flush()
+    identity = files[0].file_identity
+    try:
+        assert files[1].file_identity == identity
+        assert File.known_virus_status(test_session, identity) is None
+        antivirus = CountingAntiVirus(False)
+        status = File.virus_check_identity(test_session, identity, antivirus)
+        assert status == AntiVirusStatus.failed.name
+        # Identical contents are checked once
+        assert len(antivirus.paths) == 1
+        for f in files:
+            test_session.refresh(f)
+            assert f.infected
+            assert not f.virus_check_pending
+        # Later copies get the known status without a new check
+        assert File.known_virus_status(
+            test_session, identity) == AntiVirusStatus.failed.name
+        assert File.virus_check_identity(
+            test_session, identity, antivirus) == AntiVirusStatus.failed.name
+        assert len(antivirus.paths) == 1
+    finally:
+        files[0].delete_file(False)
+        for f in files:
+            test_session.delete(f)
+        test_session.flush()
+
+
+def test_pending_files_are_queued_once(monkeypatch):
+    from assembl.tasks import antivirus
+    queued = []
+    monkeypatch.setattr(antivirus, '_rescan_redis', None)
+    monkeypatch.setattr(antivirus, '_recent_scans', {})
+    monkeypatch.setattr(antivirus.scan_files, 'delay', queued.append)
+    assert antivirus.request_scan('abc')
+    assert not antivirus.request_scan('abc')
+    assert antivirus.request_scan('def')
+    assert queued == [['abc'], ['def']]
@@ -69,3 +69,31 @@ def test_restricted_discussion_expiry_override(
     admin_user.last_assembl_login = long_ago
     admin_social_account.last_checked = now
     assert not admin_user.login_expired(closed_discussion)
+
+
+def test_permission_cache_invalidation(
+        test_session, test_webrequest, discussion, participant2_user):
+    from assembl.auth import R_ADMINISTRATOR, P_ADMIN_DISC
+    from assembl.auth.permission_cache import get_permission_cache
+    from assembl.auth.util import get_permissions, user_has_permission
+    from assembl.models.auth import Role, LocalUserRole
+    test_session.commit()
+    cache = get_permission_cache()
+    stats = cache.stats()
+    permissions = get_permissions(participant2_user.id, discussion.id)
+    assert P_ADMIN_DISC not in permissions
+    # Second call comes from the request memo
+    assert get_permissions(participant2_user.id, discussion.id) == permissions
+    assert cache.stats()["request_hits"] == stats["request_hits"] + 1
+    # Adding a role invalidates the cache
+    role = LocalUserRole(
+        user=participant2_user, discussion=discussion,
+        role=Role.get_role(R_ADMINISTRATOR, test_session))
+    test_session.add(role)
+    test_session.flush()
+    assert user_has_permission(
+        discussion.id, participant2_user.id, P_ADMIN_DISC)
+    test_session.delete(role)
+    test_session.flush()
+    assert not user_has_permission(
+        discussion.id, participant2_user.id, P_ADMIN_DISC)
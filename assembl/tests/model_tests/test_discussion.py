@@ -144,3 +144,20 @@ def test_adding_a_discussion_automatically_adds_participant_user_template_for_no
     participant_role = test_session.query(Role).filter_by(name=R_PARTICIPANT).one()
     user_templates_for_role_participant = test_session.query(UserTemplate).filter_by(discussion=discussion, for_role=participant_role).all()
     assert len(user_templates_for_role_participant) > 0
+
+
+def test_participants_are_maintained(
+        test_session, discussion, root_post_1, post_viewed2,
+        participant1_user, participant2_user):
+    def participant_ids(include_readers):
+        return {id for (id,) in discussion.get_participants_query(
+            True, include_readers)}
+    contributors = participant_ids(False)
+    readers = participant_ids(True)
+    assert participant1_user.id in contributors
+    assert participant2_user.id not in contributors
+    assert participant2_user.id in readers
+    # Rebuilding from contributions gives the same participants
+    discussion.rebuild_participants()
+    assert participant_ids(False) == contributors
+    assert participant_ids(True) == readers
@@ -31,3 +31,79 @@ def test_idea_copy_and_commit(subidea_1_1, test_session):
         test_session.delete(entry)
     test_session.delete(boba_fett)
     test_session.commit()
+
+
+def test_idea_closure_follows_links(
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_2, test_session):
+    from assembl.models import IdeaClosure
+
+    def ancestors(idea):
+        return set(idea.get_all_ancestors(id_only=True))
+
+    def check_closure():
+        connection = test_session.connection()
+        expected = IdeaClosure.expected_rows(connection)
+        actual = {(a, d): depth for (a, d, depth) in connection.execute(
+            IdeaClosure.__table__.select())}
+        assert actual == expected
+
+    check_closure()
+    assert set(subidea_1.get_all_descendants(id_only=True)) == {
+        subidea_1.id, subidea_1_1.id, subidea_1_1_1.id, subidea_1_2.id}
+    assert subidea_1.id in ancestors(subidea_1_1_1)
+    # move subidea_1_1 under subidea_1_2
+    link = subidea_1_1.source_links[0]
+    link.source = subidea_1_2
+    test_session.flush()
+    check_closure()
+    assert subidea_1_2.id in ancestors(subidea_1_1_1)
+    # detach subidea_1_1_1
+    link_1_1_1 = subidea_1_1_1.source_links[0]
+    link_1_1_1.is_tombstone = True
+    test_session.flush()
+    check_closure()
+    assert ancestors(subidea_1_1_1) == {subidea_1_1_1.id}
+    # restore the fixture tree
+    link_1_1_1.tombstone_date = None
+    link.source = subidea_1
+    test_session.flush()
+    check_closure()
+    assert ancestors(subidea_1_1_1) == {
+        subidea_1_1_1.id, subidea_1_1.id, subidea_1.id,
+        subidea_1.source_links[0].source_id}
+
+
+def test_idea_tree_visits():
+    from assembl.models.idea import IdeaTree, AppendingVisitor, IdeaVisitor
+    children_dict = {None: [1], 1: [2, 5], 2: [3, 4], 5: [6]}
+    tree = IdeaTree(children_dict)
+    assert tree.ids.tolist() == [1, 2, 3, 4, 5, 6]
+    assert tree.descendant_ids(2) == [2, 3, 4]
+    assert tree.descendant_ids(5, inclusive=False) == [6]
+    assert tree.visit_depth_first(AppendingVisitor()) == [1, 2, 3, 4, 5, 6]
+    assert tree.visit_breadth_first(AppendingVisitor()) == [1, 2, 5, 3, 4, 6]
+
+    class LevelVisitor(IdeaVisitor):
+        def visit_idea(self, idea_id, level, prev_result):
+            if idea_id == 2:
+                return self.CUT_VISIT
+            return level
+
+        def end_visit(self, idea_id, level, result, child_results):
+            return [(idea_id, level)] + sum(
+                (r for (child_id, r) in child_results), [])
+    assert tree.visit_depth_first(LevelVisitor()) == [
+        (1, 0), (2, 1), (5, 1), (6, 2)]
+    # No recursion limit
+    chain = {None: [0]}
+    chain.update((i, [i + 1]) for i in range(5000))
+    assert len(IdeaTree(chain).visit_depth_first(AppendingVisitor())) == 5001
+
+
+def test_visit_ideas_depth_first(
+        root_idea, subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_2):
+    from assembl.models.idea import AppendingVisitor
+    ideas = subidea_1.visit_ideas_depth_first(AppendingVisitor())
+    assert ideas[0] is subidea_1
+    assert set(ideas) == {subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_2}
+    assert ideas.index(subidea_1_1) < ideas.index(subidea_1_1_1)
@@ -0,0 +1,29 @@
+from datetime import datetime
+
+
+def test_post_terms_stored_and_reset_on_edit(root_post_1, test_session):
+    from assembl.models import PostTermFrequency
+    terms = PostTermFrequency.store_terms(
+        test_session, [root_post_1.id], ['en'])
+    assert terms[root_post_1.id]['title'] == u"a root post"
+    assert test_session.query(PostTermFrequency).filter_by(
+        post_id=root_post_1.id).count() == 1
+    # Storing again replaces the terms
+    PostTermFrequency.store_terms(test_session, [root_post_1.id], ['en'])
+    assert test_session.query(PostTermFrequency).filter_by(
+        post_id=root_post_1.id).count() == 1
+    root_post_1.modification_date = datetime.utcnow()
+    test_session.flush()
+    assert test_session.query(PostTermFrequency).filter_by(
+        post_id=root_post_1.id).count() == 0
+
+
+def test_idea_title_edit_invalidates_keywords(
+        test_session, discussion, subidea_1):
+    from assembl.models.path_utils import get_structure_cache
+    cache = get_structure_cache()
+    version = cache.version(discussion.id, 'texts')
+    entry = subidea_1.title.first_original()
+    entry.value = u"a new title"
+    test_session.flush()
+    assert cache.version(discussion.id, 'texts') != version
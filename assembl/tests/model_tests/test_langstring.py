@@ -673,3 +673,75 @@ def test_clone_langstring_has_same_content_as_original(
     test_session.delete(boba_fett)
     test_session.commit()
 
+
+
+def test_translate_contents_batches_service_calls(
+        discussion, participant1_user, test_session, monkeypatch):
+    from assembl.models import Post, LangString
+    from assembl.nlp import translation_service
+    from assembl.nlp.translation_service import (
+        AbstractTranslationService, TranslationCache)
+    from assembl.tasks.translate import translate_contents
+
+    class FakeTranslationService(AbstractTranslationService):
+        distinct_identify_step = False
+        calls = []
+
+        def canTranslate(self, source, target):
+            return True
+
+        def translate_many(
+                self, texts, target, is_html=False, source=None, db=None):
+            self.calls.append((source, target, len(texts)))
+            return [(u"%s:%s" % (target, text), source) for text in texts]
+
+    monkeypatch.setattr(
+        translation_service, '_translation_cache', TranslationCache())
+    posts = [Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"subject %d" % i, "en"),
+        body=LangString.create(u"body %d" % i, "en"),
+        type="post", message_id="translate%d@example.com" % i)
+        for i in range(3)]
+    test_session.add_all(posts)
+    test_session.flush()
+    try:
+        translate_contents(
+            posts, service=FakeTranslationService(discussion))
+        # one call per target language, for all subjects and bodies
+        assert sorted(FakeTranslationService.calls) == [
+            ("en", "de", 6), ("en", "fr", 6)]
+        for post in posts:
+            assert {e.locale_code for e in post.subject.entries} == {
+                "en", "fr-x-mtfrom-en", "de-x-mtfrom-en"}
+    finally:
+        for post in posts:
+            test_session.delete(post)
+        test_session.flush()
+
+
+def test_locale_registry():
+    from assembl.models.langstrings import Locale, LocaleRegistry
+    registry = LocaleRegistry(
+        {1: 'en', 2: 'fr', 3: 'en_CA', 4: 'fr-x-mtfrom-en'}, 1)
+    assert registry.id_by_code['en_CA'] == 3
+    assert registry.base_code_by_id[4] == 'fr'
+    assert registry.root_code_by_id[3] == 'en'
+    assert registry.machine_translated_ids == {4}
+    assert registry.subsets['fr'] == {'fr', 'fr-x-mtfrom-en'}
+    for (code1, code2) in (('en_CA', 'en'), ('en', 'fr'), ('zh', 'zh_Hans')):
+        assert registry.compatible(code1, code2) == \
+            Locale.compute_compatibility(code1, code2)
+    updated = registry.updated({5: 'it'}, (4,))
+    assert updated.version == 2
+    assert updated.id_by_code['it'] == 5
+    assert 4 not in updated.code_by_id
+    # The original snapshot is unchanged
+    assert 5 not in registry.code_by_id
+
+
+def test_new_locale_in_registry(en_ca_locale):
+    from assembl.models.langstrings import Locale, get_locale_registry
+    assert get_locale_registry().id_by_code['en_CA'] == en_ca_locale.id
+    assert Locale.code_for_id(en_ca_locale.id) == 'en_CA'
+    assert Locale.base_code_for_id(en_ca_locale.id) == 'en_CA'
@@ -448,4 +448,79 @@ Yes!
 
     check_striping_plaintext(original, expected, "Gmail plaintext, circa 2012")
 
-    
\ No newline at end of file
+    
+
+def test_thread_new_mails(test_session, discussion, mailbox):
+    def import_mail(message_id, references=None):
+        headers = [
+            "From: Participant <participant@example.com>",
+            "To: list@example.com",
+            "Subject: Threading",
+            "Date: Tue, 19 Jun 2012 13:39:00 -0400",
+            "Message-ID: <%s>" % message_id]
+        if references:
+            headers.append("References: " + " ".join(
+                "<%s>" % ref for ref in references))
+            headers.append("In-Reply-To: <%s>" % references[-1])
+        (mail, _, error) = mailbox.parse_email(
+            "\r\n".join(headers) + "\r\n\r\nBody\r\n")
+        assert not error
+        test_session.add(mail)
+        test_session.flush()
+        mails.append(mail)
+        AbstractMailbox.thread_new_mails(
+            test_session, discussion.id, [mail.message_id])
+        return mail
+
+    mails = []
+    try:
+        # the reply comes first, it has no known ancestor yet
+        reply = import_mail("reply@example.com", ["root@example.com"])
+        assert [ref.message_id for ref in reply.references] == [
+            "root@example.com"]
+        assert reply.parent is None
+        # the root adopts it
+        root = import_mail("root@example.com")
+        assert reply.parent == root
+        # a missing intermediate message is skipped
+        deep = import_mail("deep@example.com", [
+            "root@example.com", "reply@example.com", "lost@example.com"])
+        assert deep.parent == reply
+        assert deep.ancestor_ids() == [root.id, reply.id]
+    finally:
+        creators = {mail.creator for mail in mails}
+        for mail in reversed(mails):
+            test_session.delete(mail)
+        for creator in creators:
+            test_session.delete(creator)
+        test_session.flush()
+
+
+def test_imap_fetch_messages_in_batch():
+    from assembl.models import IMAPMailbox
+
+    class FakeIMAP(object):
+        def __init__(self, existing=()):
+            self.commands = []
+            self.existing = existing
+
+        def uid(self, command, message_set, parts):
+            self.commands.append((command, message_set or parts))
+            if command == 'search':
+                return 'OK', [' '.join(self.existing)]
+            return 'OK', [
+                ('2 (UID 12 RFC822 {7}', 'second\n'), ')',
+                # the UID can also come after the message
+                ('1 (RFC822 {6}', 'first\n'), ' UID 11)']
+
+    mailbox = FakeIMAP()
+    messages = IMAPMailbox.fetch_messages(mailbox, ['11', '12', '13'])
+    # one round trip, in uid order, without the deleted message
+    assert mailbox.commands == [('fetch', '11,12,13'), ('search', 'UID 13')]
+    assert messages == ([('11', 'first\n'), ('12', 'second\n')], '13')
+    # a message which was not read but still exists is not skipped
+    mailbox = FakeIMAP(['13'])
+    messages = IMAPMailbox.fetch_messages(mailbox, ['11', '13', '12', '14'])
+    assert mailbox.commands == [
+        ('fetch', '11,13,12,14'), ('search', 'UID 13,14')]
+    assert messages == ([('11', 'first\n')], '11')
@@ -10,6 +10,7 @@ from assembl.models import (
     Email,
     User,
     Notification,
+    NotificationSubscription,
     NotificationSubscriptionFollowSyntheses,
     NotificationSubscriptionFollowAllMessages,
     NotificationSubscriptionFollowOwnMessageDirectReplies,
@@ -18,7 +19,8 @@ from assembl.models import (
 )
 
 from assembl.models.notification import (
-    ModelEventWatcherNotificationSubscriptionDispatcher)
+    ModelEventWatcherNotificationSubscriptionDispatcher,
+    NotificationOnPostCreated)
 
 
 def test_subscribe_notification(test_session, discussion, participant1_user,
@@ -269,5 +271,75 @@ def test_notification_multiple_subscriptions_create_single_notification(
     notification_count = test_session.query(Notification).count()
     assert notification_count == initial_notification_count + 1
 
+def test_notification_matching_query(
+        test_session, discussion, participant1_user, participant2_user,
+        root_post_1, reply_post_1, test_app):
+    from assembl.models.notification import CrudVerbs
+    test_session.flush()
+    all_messages = NotificationSubscriptionFollowAllMessages(
+        discussion=discussion, user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED)
+    direct_replies = NotificationSubscriptionFollowOwnMessageDirectReplies(
+        discussion=discussion, user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED)
+    # participant2 wrote reply_post_1, no reply to their posts
+    other_direct_replies = NotificationSubscriptionFollowOwnMessageDirectReplies(
+        discussion=discussion, user=participant2_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED)
+    test_session.add_all([all_messages, direct_replies, other_direct_replies])
+    test_session.flush()
+    applicable = NotificationSubscription.applicable_query(
+        discussion.id, CrudVerbs.CREATE, reply_post_1).all()
+    assert {id for (user_id, id, type, priority) in applicable} == {
+        all_messages.id, direct_replies.id}
+    first = NotificationSubscription.first_applicable_query(
+        discussion.id, CrudVerbs.CREATE, reply_post_1).all()
+    assert [(user_id, id) for (user_id, id, type, priority) in first] == [
+        (participant1_user.id, min(all_messages.id, direct_replies.id))]
+    # syntheses are not followed
+    assert NotificationSubscriptionFollowSyntheses.applicable_query(
+        discussion.id, CrudVerbs.CREATE, reply_post_1) is None
+
+
+def test_notification_rendering_shared_by_recipients(
+        test_session, discussion, participant1_user, participant2_user,
+        root_post_1, reply_post_1, test_app):
+    test_session.flush()
+    subscriptions = {
+        participant1_user.id: [
+            NotificationSubscriptionFollowAllMessages(
+                discussion=discussion, user=participant1_user,
+                creation_origin=NotificationCreationOrigin.USER_REQUESTED),
+            NotificationSubscriptionFollowOwnMessageDirectReplies(
+                discussion=discussion, user=participant1_user,
+                creation_origin=NotificationCreationOrigin.USER_REQUESTED)],
+        participant2_user.id: [
+            NotificationSubscriptionFollowAllMessages(
+                discussion=discussion, user=participant2_user,
+                creation_origin=NotificationCreationOrigin.USER_REQUESTED)],
+    }
+    for user_subscriptions in subscriptions.values():
+        test_session.add_all(user_subscriptions)
+    test_session.flush()
+    Notification.clear_render_caches()
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    dispatcher.processPostCreated(reply_post_1.id)
+    notifications = test_session.query(NotificationOnPostCreated).filter_by(
+        post_id=reply_post_1.id).all()
+    assert len(notifications) == 2
+    for notification in notifications:
+        html_content = notification.render_to_email_html_part()
+        assert "<!-- notification: %d -->" % notification.id in html_content
+        assert "ASSEMBL" not in html_content
+        user_id = notification.first_matching_subscription.user_id
+        for subscription in subscriptions[user_id]:
+            assert "<!-- subscription: %d -->" % subscription.id in html_content
+        assert html_content.count("<!-- subscription:") == len(
+            subscriptions[user_id])
+    # the post was rendered and inlined once
+    assert len([key for key in Notification._shared_renders
+                if key[1] == reply_post_1.id]) == 1
+
+
 # def test_subscribe_notification_access_control
 # TODO: Check that other subscriptions are passed to process method
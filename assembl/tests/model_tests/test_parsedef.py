@@ -60,3 +60,14 @@ def test_load_mailbox(
         test_webrequest, discussion, admin_user, jack_layton_mailbox):
     _test_load_fixture(
         test_webrequest, discussion, admin_user, jack_layton_mailbox)
+
+
+def test_generic_json_plan_is_cached(
+        test_webrequest, discussion, root_post_1):
+    from assembl.lib.sqla import _json_plans
+    plan = root_post_1.get_json_plan('default')
+    assert plan is not None
+    assert _json_plans[(root_post_1.__class__, 'default')][1] is plan
+    assert root_post_1.get_json_plan('default') is plan
+    json = root_post_1.generic_json('default')
+    assert json['@id'] == root_post_1.uri()
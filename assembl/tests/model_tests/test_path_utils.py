@@ -94,6 +94,34 @@ def test_jack_layton_linked_discussion(
     assert not positive
 
 
+def test_bulk_counts_match_per_idea_queries(
+        test_session, test_webrequest, jack_layton_linked_discussion,
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1):
+    from assembl.models.path_utils import PostTreeCounter
+    ideas = (
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1)
+    discussion = subidea_1.discussion
+    counters = subidea_1.prepare_counters(discussion.id, True)
+    assert counters.counted_all
+    tree_counter = PostTreeCounter(
+        test_session, discussion.id, test_webrequest.authenticated_userid)
+    for idea in ideas:
+        path_collection = counters.paths[idea.id]
+        q = path_collection.as_clause(
+            test_session, discussion.id, user_id=counters.user_id,
+            include_deleted=None)
+        expected = tuple(counters.get_counts_for_query(q))
+        assert counters.get_counts(idea.id) == expected
+        assert tree_counter.get_counts(path_collection) == expected
+        posts_of_idea = {id for (id,) in test_session.execute(
+            path_collection.as_clause_base(test_session, include_deleted=None))}
+        assert set(tree_counter.get_post_ids(path_collection)) == posts_of_idea
+
+
 def test_deleted_post_count(
         test_session, test_webrequest, reply_deleted_post_4,
         subidea_1_1, reply_to_deleted_post_5, extract_post_1_to_subidea_1_1):
@@ -158,3 +186,87 @@ def test_delete_posts(
     assert reply_post_2.publication_state == PublicationStates.DELETED_BY_ADMIN
     assert reply_post_2.is_tombstone
     assert reply_post_1.is_tombstone
+
+
+def test_structure_cache_invalidation(
+        test_session, test_webrequest, discussion, root_idea,
+        subidea_1, subidea_1_1):
+    from assembl.models.path_utils import (
+        DiscussionGlobalData, get_structure_cache)
+    # Structure built from uncommitted changes is not shared
+    test_session.commit()
+    data = DiscussionGlobalData(test_session, discussion.id)
+    parent_dict = data.parent_dict
+    raw = data.post_path_collection_raw
+    assert parent_dict[subidea_1_1.id] == subidea_1.id
+    # Another request reuses the structure
+    data2 = DiscussionGlobalData(test_session, discussion.id)
+    assert data2.parent_dict is parent_dict
+    assert data2.post_path_collection_raw is raw
+    # Tombstoning an idea invalidates the hierarchy, but not the links
+    hierarchy_version = data2.structure_version(('hierarchy',))
+    subidea_1_1.is_tombstone = True
+    test_session.commit()
+    data3 = DiscussionGlobalData(test_session, discussion.id)
+    assert data3.structure_version(('hierarchy',)) != hierarchy_version
+    assert subidea_1_1.id not in data3.parent_dict
+    assert data3.post_path_collection_raw is raw
+    get_structure_cache().clear(discussion.id)
+
+
+def test_incremental_post_counts(
+        test_session, test_webrequest, discussion, participant1_user,
+        reply_post_1, subidea_1_1, extract_post_1_to_subidea_1_1):
+    from assembl.models import LangString
+    from assembl.models.path_utils import (
+        DiscussionGlobalData, get_structure_cache)
+    test_session.commit()
+    data = DiscussionGlobalData(test_session, discussion.id)
+    post_counts = data.post_counts
+    posts_version = data.structure_version(('posts',))
+    assert post_counts.get_counts(subidea_1_1.id) == (1, 1)
+    reply = Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"re: reply"),
+        body=LangString.create(u"reply body"),
+        type="post", message_id="msg_incremental@example.com")
+    test_session.add(reply)
+    reply.set_parent(reply_post_1)
+    test_session.commit()
+    # Other processes will recount
+    data = DiscussionGlobalData(test_session, discussion.id)
+    assert data.structure_version(('posts',)) != posts_version
+    # but the counts of this process were incremented, not rebuilt
+    assert data.post_counts is post_counts
+    assert post_counts.get_counts(subidea_1_1.id) == (2, 2)
+    assert subidea_1_1.num_posts == 2
+    # and they do not drift from a full recount
+    new_counts = data.reconcile_post_counts()
+    assert not post_counts.drift(new_counts)
+    test_session.delete(reply)
+    test_session.commit()
+    get_structure_cache().clear(discussion.id)
+
+
+def test_structure_cache_ttl_without_redis():
+    from assembl.models.path_utils import DiscussionStructureCache
+    cache = DiscussionStructureCache(ttl=60)
+    version = (cache.version(1, 'hierarchy'),)
+    cache.set(1, "parent_dict", version, {})
+    assert cache.get(1, "parent_dict", version) == {}
+    # Other processes may have changed the structure since
+    cache.ttl = -1
+    assert cache.get(1, "parent_dict", version) is None
+
+
+def test_structure_cache_rekey():
+    from assembl.models.path_utils import DiscussionStructureCache
+    cache = DiscussionStructureCache()
+    version = cache.version(1, 'posts')
+    cache.set(1, "post_counts", (version,), "counts")
+    new_version = cache.bump(1, 'posts')
+    assert cache.is_next_version(version, new_version)
+    assert cache.get(1, "post_counts", (new_version,)) is None
+    cache.rekey(1, "post_counts", (version,), (new_version,))
+    assert cache.get(1, "post_counts", (new_version,)) == "counts"
+    assert not cache.is_next_version(version, cache.bump(1, 'posts'))
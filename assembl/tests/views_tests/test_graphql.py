@@ -2495,3 +2495,37 @@ query { discussion { homepageUrl }  }
 """
     res = schema.execute(query, context_value=graphql_request)
     assert res.data['discussion']['homepageUrl'] == url
+
+
+def test_original_locale_ignores_tombstoned_entries(
+        request, graphql_request, test_session, discussion, admin_user,
+        fr_locale, en_locale):
+    from datetime import datetime
+    from assembl.graphql.post import PostInterface
+    body = models.LangString.create(u"Corps", "fr")
+    post = models.Post(
+        discussion=discussion, creator=admin_user,
+        subject=models.LangString.create(u"Subject"), body=body,
+        type='post', message_id="original_locale@example.com")
+    test_session.add(post)
+    test_session.flush()
+
+    def fin():
+        test_session.delete(post)
+        test_session.flush()
+    request.addfinalizer(fin)
+
+    # The first entry is edited away
+    body.entries[0].tombstone_date = datetime.utcnow()
+    test_session.add(models.LangStringEntry(
+        langstring_id=body.id, locale=en_locale, value=u"Body",
+        locale_confirmed=True))
+    test_session.flush()
+    test_session.expire(body, ['entries'])
+    resolve = PostInterface.resolve_original_locale.__func__
+    # with the body entries loaded
+    assert [entry.locale_code for entry in body.entries] == ['en']
+    assert resolve(post, {}, graphql_request, None) == u'en'
+    # with the body entries batch loaded
+    test_session.expire(post, ['body'])
+    assert resolve(post, {}, graphql_request, None).get() == u'en'
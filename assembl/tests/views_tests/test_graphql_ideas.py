@@ -588,3 +588,64 @@ query QuestionPosts($id: ID!, $first: Int!, $after: String!) {
     question_posts = result['question']['posts']['edges']
     assert len(question_posts) ==  len_proposals
     assert all(post['node']['id'] in proposals for post in question_posts)
+
+
+def test_graphql_idea_posts_query_count(
+        request, test_session, graphql_request, discussion, admin_user,
+        subidea_1):
+    from sqlalchemy import event
+    from assembl.models import Post, LangString, IdeaRelatedPostLink
+    objects = []
+    for idx in range(200):
+        post = Post(
+            discussion=discussion, creator=admin_user,
+            subject=LangString.create(u"Post %d" % idx),
+            body=LangString.create(u"Body of post %d" % idx),
+            type='post', message_id="query_count_%d@example.com" % idx)
+        link = IdeaRelatedPostLink(
+            idea=subidea_1, creator=admin_user, content=post)
+        test_session.add(post)
+        test_session.add(link)
+        objects.extend((link, post))
+    test_session.flush()
+
+    def fin():
+        for obj in objects:
+            test_session.delete(obj)
+        test_session.flush()
+    request.addfinalizer(fin)
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = test_session.connection().engine
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        res = schema.execute(u"""query {
+            node(id:"%s") {
+                ... on Idea {
+                    contributors { id }
+                    posts {
+                        edges {
+                            node {
+                                ... on Post {
+                                    extracts { id }
+                                    mySentiment
+                                    sentimentCounts { like }
+                                    originalLocale
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }""" % to_global_id('Idea', subidea_1.id),
+            context_value=graphql_request)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+    assert res.errors is None
+    assert len(res.data['node']['posts']['edges']) == 200
+    # One query per field for all posts, not one per post
+    assert len(statements) < 40
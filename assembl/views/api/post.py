@@ -29,7 +29,8 @@ from assembl.views.api import API_DISCUSSION_PREFIX
 from assembl.auth import P_READ, P_ADD_POST
 from assembl.auth.util import get_permissions
 from assembl.tasks.translate import (
-    translate_content,
+    missing_translations,
+    translate_later,
     PrefCollectionTranslationTable)
 from assembl.models import (
     get_database_id, Post, AssemblPost, SynthesisPost,
@@ -79,7 +80,7 @@ def get_posts(request):
         raise HTTPNotFound(localizer.translate(
             _("No discussion found with id=%s")) % discussion_id)
 
-    discussion.import_from_sources()
+    discussion.wake_sources()
 
     user_id = request.authenticated_userid or Everyone
     permissions = get_permissions(user_id, discussion_id)
@@ -457,9 +458,11 @@ def get_posts(request):
 
         if user_id != Everyone:
             viewpost = post.id in read_posts
-            if view_def != "id_only":
-                translate_content(
-                    post, translation_table=translations, service=service)
+            if view_def != "id_only" and translations is not None and any(
+                    missing_translations(post, translations, service)):
+                # Do not wait for the translation service,
+                # translations will come through the changes socket
+                translate_later(request, [post.id])
         no_of_posts += 1
         serializable_post = post.generic_json(
             view_def, user_id, permissions) or {}
@@ -3,7 +3,8 @@ from datetime import datetime, timedelta
 from pyramid.view import view_config
 from pyramid.response import Response, FileIter, _BLOCK_SIZE
 from pyramid.httpexceptions import (
-    HTTPServerError, HTTPNotAcceptable, HTTPRequestRangeNotSatisfiable)
+    HTTPServerError, HTTPNotAcceptable, HTTPRequestRangeNotSatisfiable,
+    HTTPServiceUnavailable)
 from pyramid.security import Everyone
 from pyramid.settings import asbool
 from pyramid.compat import url_quote
@@ -13,7 +14,8 @@ from assembl.auth import P_READ, P_ADD_POST
 from assembl.models import File, Document, Discussion
 from assembl.auth.util import get_permissions
 from assembl.views.traversal import InstanceContext, CollectionContext
-from assembl.lib.raven_client import capture_message
+from assembl.lib.raven_client import capture_message, capture_exception
+from assembl.tasks.antivirus import request_scan
 from . import MULTIPART_HEADER, update_from_form
 
 
@@ -45,6 +47,21 @@ def delete_file(request):
     return {}
 
 
+def check_virus_status(f):
+    """Refuse infected files, and files which are not checked yet.
+    Files are checked in the background: this does not run the antivirus."""
+    if f.infected:
+        raise HTTPNotAcceptable("Infected with a virus")
+    if f.virus_check_pending:
+        # In case the file was uploaded before the discussion required it
+        try:
+            request_scan(f.file_identity)
+        except Exception:
+            capture_exception()
+        raise HTTPServiceUnavailable(
+            "Waiting for the anti-virus check", retry_after=10)
+
+
 @view_config(context=InstanceContext, request_method='HEAD',
              permission=P_READ, ctx_instance_class=File,
              name='data')
@@ -52,8 +69,7 @@ def get_file_header(request):
     ctx = request.context
     document = ctx._instance
     f = File.get(document.id)
-    if f.infected:
-        raise HTTPNotAcceptable("Infected with a virus")
+    check_virus_status(f)
     handoff_to_nginx = asbool(config.get('handoff_to_nginx', False))
 
     return Response(
@@ -76,8 +92,7 @@ def get_file(request):
     ctx = request.context
     document = ctx._instance
     f = File.get(document.id)
-    if f.infected:
-        raise HTTPNotAcceptable("Infected with a virus")
+    check_virus_status(f)
     escaped_double_quotes_filename = (f.title
         .replace(u'"', u'\\"')
         .encode('iso-8859-1', 'replace'))
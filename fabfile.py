@@ -1684,7 +1684,7 @@ def database_restore(backup=False):
     else:
         processes = filter_autostart_processes([
             "dev:pserve", "dev:gulp", "dev:webpack", "edgesense", "elasticsearch", "celery_imap", "changes_router", "celery_notify",
-            "celery_notification_dispatch", "celery_notify_beat", "celery_translate", "source_reader", "maintenance_uwsgi", "metrics",
+            "celery_notification_dispatch", "celery_notify_beat", "celery_translate", "celery_antivirus", "source_reader", "maintenance_uwsgi", "metrics",
             "metrics_py", "prod:uwsgi"])
 
     if(env.wsginame != 'dev.wsgi'):
@@ -64,5 +64,7 @@ setup(name='assembl',
       assembl-pshell  = assembl.scripts.pshell:main
       assembl-pserve   = assembl.scripts.pserve:main
       assembl-reindex-all-contents  = assembl.scripts.reindex_all_contents:main
+      assembl-rethread-mails  = assembl.scripts.rethread_mails:main
+      assembl-rebuild-idea-closure = assembl.scripts.rebuild_idea_closure:main
       """,
       )